@@ -1,16 +1,33 @@
 import os
+import bisect
 import time
 import cv2
 import imutils
+import numpy as np
 import shutil
-import img2pdf
 import glob
+import json
+import math
+import re
+import subprocess
+import tempfile
+import multiprocessing
+import threading
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from skimage.metrics import structural_similarity
 import gradio as gr
-import tempfile
 import whisper
-from moviepy.editor import VideoFileClip
-from PIL import Image, ImageDraw, ImageFont
+
+from pdfwriter import PdfWriter
+from resultcache import ResultCache
+import profiler
+from profiler import stage, timed_iter
+from throttle import throttled, no_progress
+from pipeline import Job, Stage
+import ocrapi
 
 ############# Define constants
 
@@ -24,25 +41,145 @@ DETECT_SHADOWS = False            # If true, the algorithm will detect shadows a
 MIN_PERCENT = 0.1                # min % of diff between foreground and background to detect if motion has stopped
 MAX_PERCENT = 3                  # max % of diff between foreground and background to detect if frame is still in motion
 SSIM_THRESHOLD = 0.9             # SSIM threshold of two consecutive frame
+MOTION_DETECTOR = "mog2"         # engine that measures the motion of the frames: "mog2" (background subtractor) or "blockdiff" (numpy block differences, faster)
+MOTION_WIDTH = 600               # width the frames are resized to for the background subtractor
+BLOCK_WIDTH = 160                # width of the grayscale frames compared by the blockdiff detector
+BLOCK_SIZE = 8                   # pixels per side of the blocks of the blockdiff detector
+BLOCK_DIFF_THRESHOLD = 8         # mean absolute difference (0-255) of a block to the reference from which it is in motion
+BLOCK_REFERENCE_RATE = 0.5       # weight of a new frame in the running reference of the blockdiff detector (1 = the previous frame)
+BLOCK_BATCH = 8                  # frames stacked and compared at once by the blockdiff detector (the decoded frames of a batch are kept in memory)
+BLOCK_MIN_PERCENT = 1.0          # MIN_PERCENT of the blockdiff detector, one 8x8 block is already about 0.5% of a 16:9 frame
+BLOCK_MAX_PERCENT = 3            # MAX_PERCENT of the blockdiff detector
+BLOCK_ACTIVITY_RATE = 1 / 30     # weight of a new frame in the running share of the frames a block is in motion
+BLOCK_PERSISTENT_ACTIVITY = 0.3  # share of the frames from which a block keeps moving (cursor, clock, webcam) and is left out of p_diff
+BLOCK_PERSISTENT_MAX = 0.25      # max share of the blocks left out, when more blocks keep moving the whole video is in motion
+DETECT_ROI = None                # (left, top, right, bottom) fractions (0-1) of the frame that show the slide, motion and slide comparison only look at it (None = whole frame)
+DETECT_MASKS = []                # (left, top, right, bottom) fractions of the frame that are ignored, e.g. a webcam picture-in-picture or a clock
+AUTO_MASK_SECONDS = 0            # learn the regions that keep moving in the first seconds of the video and ignore them (0 = off)
+AUTO_MASK_PERSISTENCE = 0.25     # fraction of the learning frames a pixel has to be in motion to be ignored
+AUTO_MASK_DILATE = 15            # pixels (at MOTION_WIDTH) the learned regions are grown by
+AUTO_MASK_DIFF = 25              # difference (0-255) of a pixel to the previous frame from which it is in motion, catches blinking that MOG2 learns as background
+SSIM_WIDTH = 320                 # width of the grayscale images compared with SSIM
+HASH_SAME_DISTANCE = 4           # dHash distance (0-64) up to which two frames are the same slide without running SSIM
+HASH_DIFF_DISTANCE = 20          # dHash distance (0-64) from which two frames are different slides without running SSIM
+DUPLICATE_POLICY = "drop"        # slides that were saved before: "drop" them, record a "reference" to the first page or "keep" saving them again
+DUPLICATE_HASH_DISTANCE = 10     # dHash distance within which saved slides are compared to find duplicates across the deck
+SLIDE_FORMAT = "png"             # codec of the slide images in the pdf: "png" (lossless) or "jpeg"
+JPEG_QUALITY = 90                # quality (0-100) of the jpeg slides
+SAVE_SLIDE_IMAGES = True         # also write every slide as an image file to the output folder
+FRAME_SAMPLER = "sequential"     # "sequential" decodes the video once and keeps every Nth frame, "seek" seeks to every sampled timestamp (slow, used for variable frame rate files), "ffmpeg" samples and scales the frames in an ffmpeg process (full resolution frames are only decoded at the captures)
 
+DETECT_WORKERS = 1               # no.of processes that detect the slides of the DETECT_CHUNK_SECONDS chunks of a video in parallel (1 = single process)
+DETECT_CHUNK_SECONDS = 120       # videos longer than this are processed in chunks of this length, the same chunks for every number of workers so the slides do not depend on DETECT_WORKERS (None = one pass)
 
-def get_frames(video_path):
-    '''A fucntion to return the frames from a video located at video_path
-    this function skips frames as defined in FRAME_RATE'''
-    
-    
-    # open a pointer to the video file initialize the width and height of the frame
-    vs = cv2.VideoCapture(video_path)
-    if not vs.isOpened():
-        raise Exception(f'unable to open file {video_path}')
+KEYFRAME_SCAN = False            # first decode only the keyframes and process the video at FRAME_RATE only where two keyframes differ
+KEYFRAME_DIFF_THRESHOLD = 1.0    # mean absolute difference (0-255) between two keyframe thumbnails to treat it as a change
+KEYFRAME_WINDOW_TAIL = 5         # seconds decoded after a changed keyframe so that the motion can settle
+KEYFRAME_THUMB_SIZE = (64, 36)   # size of the keyframe thumbnails that are compared
+
+WHISPER_MODEL = "base"           # default whisper model size, can be selected per request
+WHISPER_MODELS = ["tiny", "base", "small", "medium", "large"]
+WHISPER_PRELOAD = []             # whisper model sizes loaded when the app starts
+WHISPER_MEMORY_BUDGET_MB = 4096  # resident whisper models are evicted (least recently used first) above this size
+WHISPER_IDLE_SECONDS = 30 * 60   # whisper models that were not used for this long are evicted
+
+AUDIO_SAMPLE_RATE = 16000        # sample rate whisper works with
+AUDIO_CHUNK_SECONDS = 30         # seconds of audio read from the ffmpeg pipe at once
+
+LONG_AUDIO_SECONDS = 30 * 60     # audio longer than this is split on silence and transcribed in parallel
+TRANSCRIBE_CHUNK_SECONDS = 5 * 60  # target length of the chunks of long audio
+TRANSCRIBE_WORKERS = 2           # no.of processes transcribing the chunks of long audio (1 = no splitting)
+VAD_FRAME_SECONDS = 0.03         # length of the frames the audio energy is measured on
+VAD_MIN_SILENCE = 0.5            # the audio is cut in the quietest stretch of this many seconds
+
+CACHE_DIR = "./cache"            # finished pdfs and transcripts, keyed by the video content and the parameters
+CACHE_MAX_BYTES = 5 * 1024 ** 3  # least recently used results are evicted above this size (0 = no cache)
+SIGNAL_CACHE = True              # keep the per-frame motion signal, re-runs with other thresholds skip the decoding
+SIGNAL_DTYPE = np.dtype([("frame_count", "i4"), ("time", "f8"), ("p_diff", "f4"), ("hash", "u8")])
+OCR_ENABLED = False              # recognize the text of the slides (OCR API of ocrapi.py) and write it as an invisible, searchable text layer of the pdf
+
+JOBS_DIR = os.path.join(OUTPUT_SLIDES_DIR, "jobs")  # every request works in its own folder below JOBS_DIR
+JOB_CONCURRENCY = 2              # videos processed at the same time by the web app, the other requests wait in the queue
+JOB_QUEUE_SIZE = 32              # requests waiting in the queue, further requests are rejected (None = no limit)
+JOB_TTL_SECONDS = 24 * 3600      # job folders untouched for this long are removed
+JOB_CLEANUP_INTERVAL = 600       # seconds between two cleanups of the job folders
+METRICS_PORT = 9108              # port of the Prometheus /metrics endpoint of the web app (None = off)
+METRICS_HOST = "127.0.0.1"       # address of the /metrics endpoint, "0.0.0.0" makes it reachable from other machines
+
+FFMPEG_BIN = "ffmpeg"
+FFPROBE_BIN = "ffprobe"
+FFMPEG_ERROR_TAIL = 2000         # characters of the end of the ffmpeg log in the error of a failed decode
+
+_whisper_models = OrderedDict()  # model size -> {"model", "bytes", "last_used"}, least recently used first
+_whisper_lock = threading.Lock()
+_whisper_load_locks = {}
+_whisper_run_locks = {}          # model size -> lock, a whisper model transcribes one audio at a time
+_transcribe_pool = None          # {"pool", "workers", "last_used"} of the processes that transcribe long audio, kept alive between jobs
+_worker_model_bytes = {}         # pid of a transcription worker -> bytes of its resident whisper models
+WHISPER_METRICS = {"loads": 0, "load_seconds": 0.0, "hits": 0, "misses": 0, "evictions": 0}
+
+RESULT_CACHE = ResultCache(CACHE_DIR, CACHE_MAX_BYTES)
+profiler.register_metrics("result_cache", RESULT_CACHE.stats, {
+    "hits": ("counter", "Lookups of the result cache that found the entry"),
+    "misses": ("counter", "Lookups of the result cache that did not find the entry"),
+    "stores": ("counter", "Entries stored in the result cache"),
+    "evictions": ("counter", "Entries evicted from the result cache"),
+    "errors": ("counter", "Result cache reads and writes that failed, the result was processed again"),
+    "bytes": ("gauge", "Size of the result cache on disk"),
+})
+
+
+def probe_video(video_path):
+    '''Return the ffprobe description of the first video stream of video_path,
+    or an empty dict when ffprobe is not available'''
+    cmd = [FFPROBE_BIN, "-v", "error", "-select_streams", "v:0",
+           "-show_entries", "stream=r_frame_rate,avg_frame_rate,nb_frames,duration:format=duration",
+           "-of", "json", video_path]
+    try:
+        out = subprocess.run(cmd, capture_output=True, check=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return {}
+
+    info = json.loads(out or b"{}")
+    streams = info.get("streams") or [{}]
+    stream = streams[0]
+    stream.setdefault("duration", info.get("format", {}).get("duration"))
+    return stream
 
 
-    total_frames = vs.get(cv2.CAP_PROP_FRAME_COUNT)
-    frame_time = 0
-    frame_count = 0
+def _parse_rate(rate):
+    '''Convert an ffprobe rational such as "30000/1001" to a float'''
+    try:
+        num, _, den = str(rate).partition("/")
+        return float(num) / float(den or 1)
+    except (ValueError, ZeroDivisionError):
+        return 0.0
+
+
+def has_constant_frame_rate(vs, video_path):
+    '''Check whether the container reports a usable, constant frame rate.
+    Variable frame rate files have a nominal rate that differs from the average one'''
+    fps = vs.get(cv2.CAP_PROP_FPS)
+    if not fps or fps <= 0 or fps != fps:
+        return False
+
+    stream = probe_video(video_path)
+    if not stream:
+        return True
+    r_rate = _parse_rate(stream.get("r_frame_rate"))
+    avg_rate = _parse_rate(stream.get("avg_frame_rate"))
+    if r_rate <= 0 or avg_rate <= 0:
+        return True
+    return abs(r_rate - avg_rate) / r_rate < 0.01
+
+
+def _seek_frames(vs, start=0, end=None, frame_count=0):
+    '''Sample frames by seeking to every timestamp, works for any file but the decoder
+    has to restart from the previous keyframe for every sample'''
+    frame_time = math.ceil(start * FRAME_RATE) / FRAME_RATE
 
     # loop over the frames of the video
-    while True:
+    while end is None or frame_time <= end:
         vs.set(cv2.CAP_PROP_POS_MSEC, frame_time * 1000)    # move frame to a timestamp
         frame_time += 1/FRAME_RATE
 
@@ -54,79 +191,1043 @@ def get_frames(video_path):
         frame_count += 1
         yield frame_count, frame_time, frame
 
-    vs.release()
- 
 
+def _sequential_frames(vs, start=0, end=None, frame_count=0):
+    '''Sample frames by decoding the stream in order once. Every frame is grabbed
+    (decoded without conversion) and only the frames whose timestamp reaches the next
+    sample time are retrieved'''
+    fps = vs.get(cv2.CAP_PROP_FPS)
+    next_time = math.ceil(start * FRAME_RATE) / FRAME_RATE
+    if start > 0:
+        vs.set(cv2.CAP_PROP_POS_MSEC, next_time * 1000)
+    index = round(vs.get(cv2.CAP_PROP_POS_FRAMES))
+
+    while vs.grab():
+        # presentation timestamp of the grabbed frame, fall back to index / fps
+        pts = vs.get(cv2.CAP_PROP_POS_MSEC) / 1000
+        if index > 0 and pts <= 0:
+            pts = index / fps
+        index += 1
+
+        if end is not None and pts > end:
+            break
+        # half a frame of tolerance so rounding in the timestamps never skips a sample
+        if pts + 0.5 / fps < next_time:
+            continue
+
+        (ok, frame) = vs.retrieve()
+        if not ok or frame is None:
+            break
+
+        # same timestamps as the seek based sampler
+        next_time += 1/FRAME_RATE
+        frame_count += 1
+        yield frame_count, next_time, frame
+
+
+class FfmpegFrameReader:
+    '''Sample frames with an ffmpeg process: the fps filter selects the frames at FRAME_RATE and
+    the scale filter resizes them to width in the decoder (grayscale with gray). The raw frames
+    are read from the pipe into one preallocated buffer, every frame is a numpy view of that
+    buffer that is only valid until the next frame is read. full_frame() decodes the full
+    resolution frame of a sample with OpenCV, for the few frames that are captured'''
+
+    def __init__(self, video_path, width, gray=False, vs=None):
+        self.video_path = video_path
+        capture = vs or open_video(video_path)
+        (w, h) = (capture.get(cv2.CAP_PROP_FRAME_WIDTH), capture.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        if vs is None:
+            capture.release()
+        height = max(round(h * width / w / 2) * 2, 2)
+        (self.pixel_format, channels) = ("gray", 1) if gray else ("bgr24", 3)
+        self.size = (width, height)
+        self.buffer = bytearray(width * height * channels)
+        shape = (height, width) if gray else (height, width, channels)
+        self.frame = np.frombuffer(self.buffer, dtype=np.uint8).reshape(shape)
+        self.capture = None            # OpenCV capture of the full resolution frames
+
+    def _command(self, start, end):
+        cmd = [FFMPEG_BIN, "-nostdin", "-hide_banner", "-nostats", "-v", "error"]
+        if start > 0:
+            cmd += ["-ss", f"{start:.6f}"]
+        cmd += ["-i", self.video_path]
+        if end is not None:
+            # half a sample more, the sample at end is included like in the other samplers
+            cmd += ["-t", f"{max(end - start, 0) + 0.5 / FRAME_RATE:.6f}"]
+        (width, height) = self.size
+        return cmd + ["-an", "-sn", "-vf", f"fps={FRAME_RATE},scale={width}:{height}:flags=area",
+                      "-pix_fmt", self.pixel_format, "-f", "rawvideo", "-"]
+
+    def frames(self, vs, start=0, end=None, frame_count=0):
+        '''Sampler with the signature of _sequential_frames, vs is not used'''
+        frame_time = math.ceil(start * FRAME_RATE) / FRAME_RATE
+        view = memoryview(self.buffer)
+        # stderr goes to a file, a damaged video can log more than a pipe holds while we only read stdout
+        with tempfile.TemporaryFile() as errors:
+            proc = subprocess.Popen(self._command(frame_time, end), stdout=subprocess.PIPE, stderr=errors, bufsize=0)
+            finished = False
+            try:
+                while True:
+                    read = 0
+                    while read < len(self.buffer):
+                        count = proc.stdout.readinto(view[read:])
+                        if not count:
+                            break
+                        read += count
+                    if read < len(self.buffer):
+                        finished = True
+                        break
+
+                    # same timestamps as the other samplers
+                    frame_time += 1/FRAME_RATE
+                    frame_count += 1
+                    yield frame_count, frame_time, self.frame
+            finally:
+                if not finished:
+                    proc.kill()
+                proc.stdout.close()
+                proc.wait()
+
+            # the stream ended early: only a clean exit of ffmpeg means the video ended there
+            if proc.returncode != 0:
+                errors.seek(0)
+                message = errors.read().decode(errors="replace").strip()[-FFMPEG_ERROR_TAIL:]
+                raise Exception(f"ffmpeg 解码失败（退出码 {proc.returncode}）: {message}")
+
+    def full_frame(self, frame_time):
+        '''The full resolution frame of the sample at frame_time'''
+        if self.capture is None:
+            self.capture = open_video(self.video_path)
+        # frame_time is one sample after the timestamp of the frame
+        self.capture.set(cv2.CAP_PROP_POS_MSEC, (frame_time - 1/FRAME_RATE) * 1000)
+        with stage("decode"):
+            (_, frame) = self.capture.read()
+        return frame
 
-def detect_unique_screenshots(video_path, output_folder_screenshot_path, progress=gr.Progress()):
-    '''Extract unique screenshots from video'''
-    fgbg = cv2.createBackgroundSubtractorMOG2(history=FGBG_HISTORY, varThreshold=VAR_THRESHOLD,detectShadows=DETECT_SHADOWS)
+    def close(self):
+        if self.capture is not None:
+            self.capture.release()
+            self.capture = None
 
+
+def open_video(video_path):
+    '''Open a capture of the video located at video_path'''
+    vs = cv2.VideoCapture(video_path)
+    if not vs.isOpened():
+        raise Exception(f'unable to open file {video_path}')
+    return vs
+
+
+def frame_sampler(sampler=None):
+    '''The sampler (defaults to FRAME_SAMPLER) that can run here, "ffmpeg" falls back to
+    "sequential" when FFMPEG_BIN is not installed'''
+    sampler = sampler or FRAME_SAMPLER
+    if sampler == "ffmpeg" and not shutil.which(FFMPEG_BIN):
+        print(f'{FFMPEG_BIN} not found, decoding the frames with OpenCV')
+        return "sequential"
+    return sampler
+
+
+def get_frames(video_path, sampler=None, windows=None, vs=None, reader=None):
+    '''A fucntion to return the frames from a video located at video_path
+    this function skips frames as defined in FRAME_RATE.
+
+    sampler selects how frames are sampled ("sequential", "seek" or "ffmpeg", defaults to FRAME_SAMPLER),
+    the sequential sampler falls back to seeking for variable frame rate files and the ffmpeg sampler
+    to the sequential one when ffmpeg is not installed. The "ffmpeg" sampler
+    returns the scaled frames of reader (a FfmpegFrameReader, defaults to frames MOTION_WIDTH wide).
+    windows is an optional list of (start, end) seconds, only frames inside them are returned.
+    vs is an already opened capture of the video to read from, it is released at the end'''
+    sampler = frame_sampler(sampler) if reader is None else sampler or FRAME_SAMPLER
+
+    # open a pointer to the video file initialize the width and height of the frame
+    vs = vs or open_video(video_path)
+
+    try:
+        if sampler == "ffmpeg":
+            sample = (reader or FfmpegFrameReader(video_path, MOTION_WIDTH, vs=vs)).frames
+        elif sampler == "sequential" and has_constant_frame_rate(vs, video_path):
+            sample = _sequential_frames
+        else:
+            sample = _seek_frames
+
+        frame_count = 0
+        for start, end in (windows or [(0, None)]):
+            for frame_count, frame_time, frame in sample(vs, start, end, frame_count):
+                yield frame_count, frame_time, frame
+    finally:
+        vs.release()
+
+
+def _scan_keyframes(video_path):
+    '''Decode only the keyframes of the video (ffmpeg -skip_frame nokey) into small
+    grayscale thumbnails, returns (times, thumbnails) or None when ffmpeg is not available'''
+    (w, h) = KEYFRAME_THUMB_SIZE
+    cmd = [FFMPEG_BIN, "-nostdin", "-hide_banner", "-nostats", "-v", "info",
+           "-skip_frame", "nokey", "-i", video_path, "-an", "-vsync", "vfr",
+           "-vf", f"scale={w}:{h},format=gray,showinfo", "-f", "rawvideo", "-"]
+    try:
+        result = subprocess.run(cmd, capture_output=True, check=True)
+    except (OSError, subprocess.CalledProcessError) as e:
+        print(f"keyframe scan unavailable: {e}")
+        return None
+
+    times = [float(t) for t in re.findall(rb"pts_time:\s*(-?[\d.]+)", result.stderr)]
+    thumbs = np.frombuffer(result.stdout, dtype=np.uint8)
+    count = min(len(times), thumbs.size // (w * h))
+    return times[:count], thumbs[:count * w * h].reshape(count, h, w)
+
+
+def find_keyframe_windows(video_path):
+    '''Find the time windows in which the slides may change by comparing consecutive
+    keyframes. Returns a sorted list of (start, end) seconds, or None if the keyframes
+    can not be scanned'''
+    scan = _scan_keyframes(video_path)
+    if scan is None or len(scan[0]) < 2:
+        return None
+    times, thumbs = scan
+
+    lead = (WARMUP + 1) / FRAME_RATE
+    windows = [(0, lead + KEYFRAME_WINDOW_TAIL)]
+    diffs = np.abs(np.diff(thumbs.astype(np.int16), axis=0)).mean(axis=(1, 2))
+    for i in np.flatnonzero(diffs > KEYFRAME_DIFF_THRESHOLD):
+        windows.append((max(times[i] - lead, 0), times[i + 1] + KEYFRAME_WINDOW_TAIL))
+    # changes after the last keyframe can not be seen by the scan
+    windows.append((max(times[-1] - lead, 0), None))
+
+    merged = []
+    for start, end in sorted(windows, key=lambda w: w[0]):
+        if merged and (merged[-1][1] is None or start <= merged[-1][1]):
+            last_end = merged[-1][1]
+            merged[-1] = (merged[-1][0], None if end is None or last_end is None else max(end, last_end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def crop_roi(image, roi):
+    '''The (left, top, right, bottom) fractions roi of image as a view, the whole image when roi is None'''
+    if roi is None:
+        return image
+    (h, w) = image.shape[:2]
+    (left, top, right, bottom) = roi
+    return image[round(top * h):max(round(bottom * h), round(top * h) + 1),
+                 round(left * w):max(round(right * w), round(left * w) + 1)]
+
+
+def motion_frame(frame, region=None):
+    '''The part of frame the background subtractor works on: the ROI of region,
+    resized to MOTION_WIDTH times the width of the ROI'''
+    roi = region["roi"] if region else None
+    width = MOTION_WIDTH if roi is None else max(round(MOTION_WIDTH * (roi[2] - roi[0])), 1)
+    frame = crop_roi(frame, roi)
+    # frames scaled by the decoder already have the width
+    if frame.shape[1] == width:
+        return frame
+    return imutils.resize(frame, width=width)
+
+
+def region_mask(region, shape):
+    '''Mask (255 = used, 0 = ignored) of the pixels of the ROI of region at size shape (h, w),
+    None when no pixel is ignored. The static masks are fractions of the whole frame,
+    the learned mask is resized to shape'''
+    if not region or (not region["masks"] and region["learned"] is None):
+        return None
+    (h, w) = shape[:2]
+    (left, top, right, bottom) = region["roi"] or (0, 0, 1, 1)
+    mask = np.full((h, w), 255, dtype=np.uint8)
+    for (m_left, m_top, m_right, m_bottom) in region["masks"]:
+        # the rectangle in fractions of the ROI
+        x0 = (m_left - left) / (right - left)
+        x1 = (m_right - left) / (right - left)
+        y0 = (m_top - top) / (bottom - top)
+        y1 = (m_bottom - top) / (bottom - top)
+        mask[max(round(y0 * h), 0):max(round(y1 * h), 0), max(round(x0 * w), 0):max(round(x1 * w), 0)] = 0
+    if region["learned"] is not None:
+        learned = cv2.resize(region["learned"], (w, h), interpolation=cv2.INTER_NEAREST)
+        mask[learned > 0] = 0
+    return mask
+
+
+def learn_motion_mask(video_path, region, seconds):
+    '''Run the background subtractor over the first seconds of the video and return the mask
+    (255 = ignored, at the size of motion_frame) of the pixels that are in motion in at least
+    AUTO_MASK_PERSISTENCE of the frames, like a webcam picture, a clock or a blinking cursor.
+    A slide change only moves the pixels for a few frames. None when nothing keeps moving.
+    MOG2 learns a pixel that switches between two values as background, a pixel also counts
+    as moving when it differs from the previous frame by more than AUTO_MASK_DIFF'''
+    fgbg = cv2.createBackgroundSubtractorMOG2(history=FGBG_HISTORY, varThreshold=VAR_THRESHOLD, detectShadows=DETECT_SHADOWS)
+    moving = None
+    count = 0
+    previous = None
+    for frame_count, _, frame in get_frames(video_path, windows=[(0, seconds)]):
+        frame = motion_frame(frame, region)
+        fg_mask = fgbg.apply(frame)
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        changed = cv2.absdiff(gray, gray if previous is None else previous) > AUTO_MASK_DIFF
+        previous = gray
+        # the background model is still empty during the warmup
+        if frame_count <= WARMUP:
+            continue
+        in_motion = (fg_mask > 0) | changed
+        moving = in_motion.astype(np.uint16) if moving is None else moving + in_motion
+        count += 1
+
+    if not count:
+        return None
+    learned = (moving >= AUTO_MASK_PERSISTENCE * count).astype(np.uint8) * 255
+    if not learned.any():
+        return None
+    learned = cv2.dilate(learned, np.ones((AUTO_MASK_DILATE, AUTO_MASK_DILATE), np.uint8))
+    print(f'auto mask: {np.count_nonzero(learned) / learned.size * 100:.1f}% of the slide area keeps moving and is ignored')
+    return learned
+
+
+def detection_region(video_path, roi=None, masks=None, auto_mask_seconds=None):
+    '''The part of the frames the slides are detected in: the ROI (defaults to DETECT_ROI), the static
+    masks (defaults to DETECT_MASKS) and the mask learned over the first auto_mask_seconds
+    (defaults to AUTO_MASK_SECONDS) of the video. None when the whole frame is used'''
+    roi = DETECT_ROI if roi is None else roi
+    masks = DETECT_MASKS if masks is None else masks
+    auto_mask_seconds = AUTO_MASK_SECONDS if auto_mask_seconds is None else auto_mask_seconds
+    if roi is None and not masks and not auto_mask_seconds:
+        return None
+
+    region = {"roi": tuple(roi) if roi is not None else None, "masks": [tuple(mask) for mask in masks],
+              "auto_mask_seconds": auto_mask_seconds, "learned": None}
+    if auto_mask_seconds:
+        with stage("auto_mask"):
+            region["learned"] = learn_motion_mask(video_path, region, auto_mask_seconds)
+    return region
+
+
+def region_params(region):
+    '''The settings of region that change the motion signal, part of the cache keys'''
+    if not region:
+        return None
+    return {"roi": region["roi"], "masks": region["masks"], "auto_mask_seconds": region["auto_mask_seconds"],
+            "AUTO_MASK_PERSISTENCE": AUTO_MASK_PERSISTENCE, "AUTO_MASK_DILATE": AUTO_MASK_DILATE,
+            "AUTO_MASK_DIFF": AUTO_MASK_DIFF}
+
+
+def dhash(gray, hash_size=8):
+    '''Difference hash of a grayscale image as a hash_size * hash_size bit integer'''
+    resized = cv2.resize(gray, (hash_size + 1, hash_size), interpolation=cv2.INTER_AREA)
+    bits = (resized[:, 1:] > resized[:, :-1]).flatten()
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+
+def hash_distance(hash_a, hash_b):
+    '''Hamming distance between two hashes'''
+    return bin(hash_a ^ hash_b).count("1")
+
+
+def slide_signature(image, region=None):
+    '''Return the values used to compare a slide with other slides: the dHash and a
+    grayscale version downscaled to SSIM_WIDTH. Only the ROI of region is compared,
+    its masked pixels are blacked out'''
+    gray = cv2.cvtColor(crop_roi(image, region["roi"] if region else None), cv2.COLOR_BGR2GRAY)
+    if gray.shape[1] > SSIM_WIDTH:
+        gray = imutils.resize(gray, width=SSIM_WIDTH)
+    mask = region_mask(region, gray.shape)
+    if mask is not None:
+        gray = cv2.bitwise_and(gray, mask)
+    return {"hash": dhash(gray), "gray": gray}
+
+
+def new_compare_stats():
+    '''Counters filled by is_same_slide'''
+    return {"comparisons": 0, "ssim_calls": 0, "ssim_skipped": 0}
+
+
+def is_same_slide(signature_a, signature_b, stats=None):
+    '''Check whether two slide signatures show the same slide. The hash distance decides
+    clear cases, SSIM only runs on the downscaled grayscale images when it is ambiguous'''
+    distance = hash_distance(signature_a["hash"], signature_b["hash"])
+    if stats is not None:
+        stats["comparisons"] += 1
+
+    if distance <= HASH_SAME_DISTANCE or distance >= HASH_DIFF_DISTANCE:
+        if stats is not None:
+            stats["ssim_skipped"] += 1
+        return distance <= HASH_SAME_DISTANCE
+
+    if stats is not None:
+        stats["ssim_calls"] += 1
+    with stage("ssim"):
+        image_ssim = structural_similarity(signature_a["gray"], signature_b["gray"], data_range=255)
+    return image_ssim >= SSIM_THRESHOLD
+
+
+class BKTree:
+    '''BK-tree over integer hashes with the hamming distance, finds all the hashes within a
+    radius of a query without comparing it to every stored hash'''
+
+    def __init__(self):
+        self.root = None
+        self.size = 0
+
+    def add(self, hash_value, item):
+        self.size += 1
+        node = (hash_value, item, {})
+        if self.root is None:
+            self.root = node
+            return
+
+        current = self.root
+        while True:
+            distance = hash_distance(hash_value, current[0])
+            child = current[2].get(distance)
+            if child is None:
+                current[2][distance] = node
+                return
+            current = child
+
+    def query(self, hash_value, radius):
+        '''Return the (distance, item) pairs within radius of hash_value, closest first'''
+        found = []
+        stack = [self.root] if self.root is not None else []
+        while stack:
+            node = stack.pop()
+            distance = hash_distance(hash_value, node[0])
+            if distance <= radius:
+                found.append((distance, node[1]))
+            # triangle inequality: only the children in [distance - radius, distance + radius] can match
+            for child_distance, child in node[2].items():
+                if distance - radius <= child_distance <= distance + radius:
+                    stack.append(child)
+        return sorted(found, key=lambda f: f[0])
+
+
+def find_saved_slide(slide_index, signature, stats=None):
+    '''Look up a slide in the index of all saved slides, returns the (page, signature)
+    of the saved slide it duplicates or None'''
+    for _, (page, saved_signature) in slide_index.query(signature["hash"], DUPLICATE_HASH_DISTANCE):
+        if is_same_slide(saved_signature, signature, stats):
+            return page, saved_signature
+    return None
+
+
+def _motion_events(samples, detector=None):
+    '''The capture rule: yields the (frame_count, frame_time, p_diff, data) samples at which
+    the motion has stopped (p_diff below the min percent after having been above the max percent
+    of the thresholds of the detector, defaults to MOTION_DETECTOR)'''
+    (min_percent, max_percent) = MOTION_DETECTORS[detector or MOTION_DETECTOR].thresholds()
     captured = False
+    for sample in samples:
+        (frame_count, _, p_diff, _) = sample
+        if p_diff < min_percent and not captured and frame_count > WARMUP:
+            captured = True
+            yield sample
+
+        elif captured and p_diff >= max_percent:
+            captured = False
+
+
+class MotionDetector:
+    '''Measures the motion of the frames as p_diff, the percentage of the (unmasked) slide area that
+    changed. prepare() reduces a decoded frame to the input of the detector, apply() takes a list of
+    up to batch_size prepared frames and returns their p_diff values. A detector keeps its state
+    (background model, reference frame) from one batch to the next.
+
+    The frame given to prepare() can be a view of the reused buffer of FfmpegFrameReader, a detector
+    with a batch_size above 1 has to return a copy. frame_format() is the (width, gray) the
+    decoder can scale the frames to, thresholds() the (min, max) p_diff of the capture rule'''
+    name = None
+    batch_size = 1
+
+    @classmethod
+    def frame_format(cls):
+        return MOTION_WIDTH, False
+
+    @classmethod
+    def thresholds(cls):
+        return MIN_PERCENT, MAX_PERCENT
+
+    def __init__(self, region=None):
+        self.region = region
+        self.valid = None              # region_mask at the size of the prepared frames
+
+    def prepare(self, frame):
+        raise NotImplementedError
+
+    def apply(self, batch):
+        raise NotImplementedError
+
+    def frame_hash(self, prepared):
+        '''dHash of a prepared frame, recorded in the motion signal'''
+        gray = prepared if prepared.ndim == 2 else cv2.cvtColor(prepared, cv2.COLOR_BGR2GRAY)
+        return dhash(cv2.bitwise_and(gray, self.valid) if self.valid is not None else gray)
+
+
+class Mog2Detector(MotionDetector):
+    '''Gaussian mixture background model of every pixel (cv2 MOG2) of the frames resized to MOTION_WIDTH,
+    p_diff is the share of the pixels that are foreground'''
+    name = "mog2"
+
+    def __init__(self, region=None):
+        super().__init__(region)
+        self.fgbg = cv2.createBackgroundSubtractorMOG2(history=FGBG_HISTORY, varThreshold=VAR_THRESHOLD,detectShadows=DETECT_SHADOWS)
+        self.valid_pixels = None
+
+    def prepare(self, frame):
+        frame = motion_frame(frame, self.region)
+        if self.valid_pixels is None:
+            (H, W) = frame.shape[:2]
+            self.valid = region_mask(self.region, (H, W))
+            self.valid_pixels = max(cv2.countNonZero(self.valid), 1) if self.valid is not None else W * H
+        return frame
+
+    def apply(self, batch):
+        p_diffs = []
+        for frame in batch:
+            mask = self.fgbg.apply(frame)
+            if self.valid is not None:
+                mask = cv2.bitwise_and(mask, self.valid)
+            p_diffs.append((cv2.countNonZero(mask) / float(self.valid_pixels)) * 100)
+        return p_diffs
+
+
+class BlockDiffDetector(MotionDetector):
+    '''Difference of every frame to a running reference, on grayscale frames resized to BLOCK_WIDTH.
+    The reference is the exponential moving average of the frames before (BLOCK_REFERENCE_RATE),
+    a change stays visible for a few frames like in the background model of MOG2 and a moving
+    object that stops for one frame does not look like a still slide. A batch is stacked into
+    one array and compared at once, p_diff is the share of the BLOCK_SIZE x BLOCK_SIZE blocks
+    whose mean absolute difference is above BLOCK_DIFF_THRESHOLD. The block mean ignores the
+    noise of single pixels that the video compression causes.
+
+    A single block is about 0.5% of the frame, far above MIN_PERCENT, so the detector has its own
+    thresholds. The blocks that are in motion in more than BLOCK_PERSISTENT_ACTIVITY of the recent
+    frames (a blinking cursor, a clock, a webcam picture) are left out of p_diff until they calm
+    down, otherwise the motion would never stop. batch_size defaults to BLOCK_BATCH'''
+    name = "blockdiff"
+
+    @classmethod
+    def frame_format(cls):
+        return BLOCK_WIDTH, True
+
+    @classmethod
+    def thresholds(cls):
+        return BLOCK_MIN_PERCENT, BLOCK_MAX_PERCENT
+
+    def __init__(self, region=None, batch_size=None):
+        super().__init__(region)
+        # read when the detector is created, so a changed BLOCK_BATCH is used
+        self.batch_size = batch_size or BLOCK_BATCH
+        self.reference = None          # running reference after the previous batch
+        self.valid_blocks = None
+        self.activity = None           # running share of the frames every block was in motion
+
+    @staticmethod
+    def blocks(stack):
+        '''Mean of every block of a (n, h, w) stack, the pixels at the borders that do not fill a block are left out'''
+        (n, h, w) = stack.shape
+        (hb, wb) = (h // BLOCK_SIZE, w // BLOCK_SIZE)
+        return stack[:, :hb * BLOCK_SIZE, :wb * BLOCK_SIZE].reshape(n, hb, BLOCK_SIZE, wb, BLOCK_SIZE).mean(axis=(2, 4))
+
+    def prepare(self, frame):
+        roi = self.region["roi"] if self.region else None
+        gray = crop_roi(frame, roi)
+        if gray.ndim == 3:
+            gray = cv2.cvtColor(gray, cv2.COLOR_BGR2GRAY)
+        width = max(round(BLOCK_WIDTH * (roi[2] - roi[0] if roi else 1)), BLOCK_SIZE)
+        height = max(round(gray.shape[0] * width / gray.shape[1]), BLOCK_SIZE)
+        if gray.shape == (height, width):
+            # scaled by the decoder, the buffer of the frame is reused for the next frame
+            small = gray.copy()
+        else:
+            small = cv2.resize(gray, (width, height), interpolation=cv2.INTER_AREA)
+
+        if self.valid_blocks is None:
+            self.valid = region_mask(self.region, small.shape)
+            valid = self.valid if self.valid is not None else np.full(small.shape, 255, dtype=np.uint8)
+            # a block only counts when none of its pixels is masked, a masked cursor
+            # that reaches into a block would keep it in motion
+            self.valid_blocks = self.blocks(valid[np.newaxis].astype(np.float32))[0] >= 255
+            self.activity = np.zeros(self.valid_blocks.shape, dtype=np.float32)
+        return small
+
+    @staticmethod
+    def reference_weights(n):
+        '''(n + 1, n + 1) weights of the running references before every frame of a batch of n frames:
+        row k is the reference frame k is compared with, as weights of the previous reference
+        (column 0) and of the frames of the batch (columns 1 to n)'''
+        rate = BLOCK_REFERENCE_RATE
+        weights = np.zeros((n + 1, n + 1), dtype=np.float32)
+        for k in range(n + 1):
+            weights[k, 0] = (1 - rate) ** k
+            for j in range(k):
+                weights[k, j + 1] = rate * (1 - rate) ** (k - 1 - j)
+        return weights
+
+    def apply(self, batch):
+        stack = np.stack(batch).astype(np.float32)
+        (n, h, w) = stack.shape
+        first = self.reference is None
+        if first:
+            self.reference = stack[0]
+
+        # the references of all the frames of the batch in one matrix product, the last row
+        # is the reference after the batch
+        frames = np.concatenate([self.reference[np.newaxis], stack]).reshape(n + 1, -1)
+        references = (self.reference_weights(n) @ frames).reshape(n + 1, h, w)
+        diff = np.abs(stack - references[:-1])
+        self.reference = references[-1]
+
+        moving = (self.blocks(diff) > BLOCK_DIFF_THRESHOLD) & self.valid_blocks
+        max_persistent = BLOCK_PERSISTENT_MAX * self.valid_blocks.sum()
+        p_diffs = []
+        for frame_moving in moving:
+            counted = self.valid_blocks
+            persistent = self.activity > BLOCK_PERSISTENT_ACTIVITY
+            if persistent.sum() <= max_persistent:
+                counted = counted & ~persistent
+            p_diffs.append(float((frame_moving & counted).sum() * 100 / max(int(counted.sum()), 1)))
+            self.activity += BLOCK_ACTIVITY_RATE * (frame_moving - self.activity)
+        if first:
+            # nothing to compare the very first frame with, like an empty background model
+            p_diffs[0] = 100.0
+        return p_diffs
+
+
+MOTION_DETECTORS = {"mog2": Mog2Detector, "blockdiff": BlockDiffDetector}
+
+
+def _motion_samples(frames, progress, total_samples, signal=None, region=None, detector=None, keep_orig=True):
+    '''Run the motion detector (defaults to MOTION_DETECTOR) over frames and yield
+    (frame_count, frame_time, p_diff, orig) for every frame. total_samples is the expected number of
+    frames, only used for the progress. When signal is a list, a (frame_count, frame_time, p_diff, hash)
+    row is appended for every frame. With a region only its ROI is processed and p_diff is the share
+    of its unmasked area in motion. Without keep_orig orig is None, the frames are not kept'''
+    detector = MOTION_DETECTORS[detector or MOTION_DETECTOR](region)
+    pending = []
+
+    def flush():
+        with stage(detector.name, len(pending)):
+            p_diffs = detector.apply([prepared for _, _, prepared, _ in pending])
+        for (frame_count, frame_time, prepared, orig), p_diff in zip(pending, p_diffs):
+            if signal is not None:
+                signal.append((frame_count, frame_time, p_diff, detector.frame_hash(prepared)))
+            yield frame_count, frame_time, p_diff, orig
+        pending.clear()
+
+    for frame_count, frame_time, frame in timed_iter(frames, "decode"):
+        # Update progress, the description is only formatted when the update is reported
+        progress(min(frame_count / total_samples, 1) * 0.7, desc=lambda: f"处理视频帧 {frame_count}/{total_samples}")
+
+        # every decoded frame is a new array, it is kept as it is
+        orig = frame if keep_orig else None
+        with stage("resize", 1):
+            prepared = detector.prepare(frame)
+        pending.append((frame_count, frame_time, prepared, orig))
+        if len(pending) >= detector.batch_size:
+            yield from flush()
+
+    if pending:
+        yield from flush()
+
+
+def _motion_stopped_frames(frames, progress, total_samples, signal=None, region=None, detector=None, full_frame=None):
+    '''Run the motion detector over frames and yield
+    (frame_count, frame_time, orig) every time the motion in the video has stopped.
+    With full_frame the frames are scaled ones, orig is full_frame(frame_time)'''
+    samples = _motion_samples(frames, progress, total_samples, signal, region, detector, keep_orig=full_frame is None)
+    for frame_count, frame_time, _, orig in _motion_events(samples, detector):
+        yield frame_count, frame_time, orig if full_frame is None else full_frame(frame_time)
+
+
+def frame_source(video_path, detector, windows=None, vs=None):
+    '''The sampled frames for the motion detector and the FfmpegFrameReader that decoded them.
+    With the "ffmpeg" FRAME_SAMPLER the frames are scaled to the frame_format of the detector
+    and the reader is used for the full resolution frames of the captures, otherwise the
+    reader is None'''
+    sampler = frame_sampler()
+    if sampler == "ffmpeg":
+        (width, gray) = MOTION_DETECTORS[detector].frame_format()
+        vs = vs or open_video(video_path)
+        reader = FfmpegFrameReader(video_path, width, gray, vs)
+        return get_frames(video_path, "ffmpeg", windows, vs, reader), reader
+    return get_frames(video_path, sampler, windows, vs), None
+
+
+def detector_params(detector):
+    '''The settings the p_diff values of the motion detector depend on'''
+    if detector == "blockdiff":
+        return {"detector": detector, "BLOCK_WIDTH": BLOCK_WIDTH, "BLOCK_SIZE": BLOCK_SIZE,
+                "BLOCK_DIFF_THRESHOLD": BLOCK_DIFF_THRESHOLD, "BLOCK_REFERENCE_RATE": BLOCK_REFERENCE_RATE,
+                "BLOCK_ACTIVITY_RATE": BLOCK_ACTIVITY_RATE, "BLOCK_PERSISTENT_ACTIVITY": BLOCK_PERSISTENT_ACTIVITY,
+                "BLOCK_PERSISTENT_MAX": BLOCK_PERSISTENT_MAX}
+    return {"detector": detector, "FGBG_HISTORY": FGBG_HISTORY, "VAR_THRESHOLD": VAR_THRESHOLD,
+            "DETECT_SHADOWS": DETECT_SHADOWS, "MOTION_WIDTH": MOTION_WIDTH}
+
+
+def signal_cache_key(video_path, region=None, detector=None):
+    '''Result cache key of the motion signal of a video, it only depends on the parameters
+    used to compute p_diff and not on the thresholds applied to it'''
+    params = {"signal": SIGNAL_DTYPE.descr, "FRAME_RATE": FRAME_RATE, "FRAME_SAMPLER": FRAME_SAMPLER,
+              "DETECT_CHUNK_SECONDS": DETECT_CHUNK_SECONDS, "motion": detector_params(detector or MOTION_DETECTOR), "region": region_params(region)}
+    return RESULT_CACHE.key(video_path, params)
+
+
+def load_signal(video_path, output_folder_screenshot_path, region=None, detector=None):
+    '''Return the cached motion signal of the video and its cache key, the signal is None
+    when the video was not processed before'''
+    if not SIGNAL_CACHE or not RESULT_CACHE.enabled:
+        return None, None
+    signal_key = signal_cache_key(video_path, region, detector)
+    signal_path = os.path.join(output_folder_screenshot_path, "signal.npy")
+    if not RESULT_CACHE.get(signal_key, {"signal.npy": signal_path}):
+        return None, signal_key
+    try:
+        return np.load(signal_path), signal_key
+    except (OSError, ValueError) as e:
+        # a damaged cache file, the signal is computed again
+        print(f"cached signal could not be read: {e}")
+        return None, signal_key
+
+
+def save_signal(signal, signal_key, output_folder_screenshot_path):
+    '''Store the motion signal as a numpy structured array in the output folder and the result cache'''
+    signal_path = os.path.join(output_folder_screenshot_path, "signal.npy")
+    np.save(signal_path, np.array(signal, dtype=SIGNAL_DTYPE))
+    RESULT_CACHE.put(signal_key, {"signal.npy": signal_path})
+
+
+def replay_motion_stopped_frames(video_path, signal, vs=None, detector=None):
+    '''Apply the capture rule with the current thresholds of detector to a recorded signal and yield the
+    (frame_time, orig) candidates. Only the frames at the captures are decoded, and captures
+    whose frame hash matches the previous capture are skipped without decoding.
+    vs is an already opened capture of the video, it is released at the end'''
+    vs = vs or open_video(video_path)
+
+    samples = ((i + 1, float(row["time"]), float(row["p_diff"]), int(row["hash"])) for i, row in enumerate(signal))
+    last_hash = None
+    try:
+        for _, frame_time, _, frame_hash in _motion_events(samples, detector):
+            if last_hash is not None and hash_distance(last_hash, frame_hash) <= HASH_SAME_DISTANCE:
+                continue
+            last_hash = frame_hash
+
+            # frame_time is one sample after the timestamp of the frame, see get_frames
+            vs.set(cv2.CAP_PROP_POS_MSEC, (frame_time - 1/FRAME_RATE) * 1000)
+            with stage("decode", 1):
+                (_, orig) = vs.read()
+            if orig is not None:
+                yield frame_time, orig
+    finally:
+        vs.release()
+
+
+def detect_chunks(duration, chunk_seconds=None):
+    '''(start, end) seconds of the chunks of a video of duration seconds, end is None for the last chunk.
+    The chunks only depend on the duration and chunk_seconds (defaults to DETECT_CHUNK_SECONDS),
+    not on the number of workers'''
+    chunk_seconds = chunk_seconds or DETECT_CHUNK_SECONDS
+    count = max(math.ceil(duration / chunk_seconds), 1)
+    return [(i * chunk_seconds, (i + 1) * chunk_seconds if i < count - 1 else None) for i in range(count)]
+
+
+def _chunk_candidates(video_path, start, end, region=None, detector=None):
+    '''Run the motion detection over the (start, end] seconds of the video. Decoding starts
+    FGBG_HISTORY frames earlier so the background subtractor is warmed up, returns the
+    (frame_time, orig) candidates of the chunk after a local duplicate check and the
+    motion signal rows of the chunk'''
+    warmup_start = max(start - FGBG_HISTORY / FRAME_RATE, 0)
+    (frames, reader) = frame_source(video_path, detector or MOTION_DETECTOR, [(warmup_start, end)])
+    full_frame = reader.full_frame if reader else None
+
+    candidates = []
+    signal = []
+    last_signature = None
+    for _, frame_time, orig in _motion_stopped_frames(frames, no_progress, 1, signal, region, detector, full_frame):
+        if frame_time <= start or (end is not None and frame_time > end):
+            continue
+        signature = slide_signature(orig, region)
+        if last_signature is not None and is_same_slide(last_signature, signature):
+            continue
+        last_signature = signature
+        candidates.append((frame_time, orig))
+    if reader is not None:
+        reader.close()
+
+    signal = [row for row in signal if row[1] > start and (end is None or row[1] <= end)]
+    return candidates, signal
+
+
+def _detect_chunk(video_path, start, end, region=None, detector=None):
+    '''Process worker: _chunk_candidates of one chunk, also returns the stage timings of the chunk'''
+    cv2.setNumThreads(1)
+    with profiler.profiling(profiler.Profile()) as profile:
+        (candidates, signal) = _chunk_candidates(video_path, start, end, region, detector)
+    return candidates, signal, profile.stages
+
+
+def _parallel_motion_stopped_frames(video_path, workers, duration, progress, signal=None, region=None, detector=None):
+    '''Process the detect_chunks of the video, in a process pool of workers processes when workers
+    is above 1, yields the (frame_time, orig) candidates of all chunks in time order and extends
+    signal with the motion signal of the chunks. The region (with its learned mask) is shared by all chunks.
+
+    Every chunk starts with a new background model, so the chunks are the same for every number
+    of workers, otherwise a motion that stops just below MIN_PERCENT can be found by some
+    numbers of workers and missed by others'''
+    bounds = detect_chunks(duration)
+    if workers <= 1:
+        for i, (start, end) in enumerate(bounds):
+            (candidates, chunk_signal) = _chunk_candidates(video_path, start, end, region, detector)
+            progress(((i + 1) / len(bounds)) * 0.7, desc=f"处理视频片段 {i + 1}/{len(bounds)}")
+            if signal is not None:
+                signal.extend(chunk_signal)
+            yield from candidates
+        return
+
+    # spawn instead of fork, OpenCV's thread pool does not survive a fork
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=min(workers, len(bounds)), mp_context=context) as pool:
+        futures = [pool.submit(_detect_chunk, video_path, start, end, region, detector) for start, end in bounds]
+        for i, future in enumerate(futures):
+            progress(((i + 1) / len(bounds)) * 0.7, desc=f"处理视频片段 {i + 1}/{len(bounds)}")
+            (candidates, chunk_signal, chunk_stages) = future.result()
+            if signal is not None:
+                signal.extend(chunk_signal)
+            if profiler.current_profile() is not None:
+                profiler.current_profile().merge(chunk_stages)
+            yield from candidates
+
+
+def encode_slide(image):
+    '''Encode a slide with SLIDE_FORMAT, returns the encoded bytes and the file extension'''
+    if SLIDE_FORMAT == "jpeg":
+        return cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, JPEG_QUALITY])[1].tobytes(), "jpg"
+    return cv2.imencode(".png", image)[1].tobytes(), "png"
+
+
+def save_slide(slide, page, image, output_folder_screenshot_path, pdf_writer=None):
+    '''Encode the slide image once, write it to the output folder when SAVE_SLIDE_IMAGES
+    is set and add it as a page to pdf_writer. Returns the encoded image'''
+    with stage("image_encode", 1):
+        data, ext = encode_slide(image)
+
+    if SAVE_SLIDE_IMAGES:
+        filename = f"{page:03}_{round(slide['time']/60, 2)}.{ext}"
+        path = os.path.join(output_folder_screenshot_path, filename)
+        print("saving {}".format(path))
+        with stage("image_write", 1), open(path, "wb") as f:
+            f.write(data)
+        slide["path"] = path
+
+    if pdf_writer is not None:
+        with stage("pdf_assembly", 1):
+            pdf_writer.add_image(data)
+    return data
+
+
+def detect_slides(video_path, output_folder_screenshot_path, progress=gr.Progress(), keyframe_scan=None, workers=None, duplicate_policy=None, pdf_writer=None, keep_data=False, region=None, detector=None):
+    '''Extract unique screenshots from video, returns one {"time", "path", "revisits"} dict
+    per saved slide with the time of the captured frame in seconds
+
+    With keyframe_scan (defaults to KEYFRAME_SCAN) only the keyframes are decoded first,
+    and the video is processed at FRAME_RATE only around the keyframes where the picture changed.
+    A video longer than DETECT_CHUNK_SECONDS is split into time chunks (see detect_chunks), that are
+    processed in parallel with more than one worker (defaults to DETECT_WORKERS). The duplicate
+    slides at the chunk borders are removed with is_same_slide.
+
+    Every saved slide is kept in a BK-tree of hashes, a slide that was already saved earlier
+    is dropped (duplicate_policy "drop", defaults to DUPLICATE_POLICY), also recorded as a reference
+    to the original page in references.json ("reference") or saved again ("keep"). The times a
+    dropped slide was shown again are its "revisits", the captions of that speech go to it.
+
+    Every slide is encoded once with save_slide, written to the output folder when
+    SAVE_SLIDE_IMAGES is set and added to pdf_writer when it is given. With keep_data the
+    encoded image stays in memory in the "data" of the slide, to be added to the pdf later.
+
+    The motion detection and the slide comparison only look at the slide area, region
+    (defaults to detection_region(video_path) of DETECT_ROI, DETECT_MASKS and AUTO_MASK_SECONDS).
+    The slides are always saved with the whole frame. detector selects the engine that
+    measures the motion (defaults to MOTION_DETECTOR, see MOTION_DETECTORS)'''
+    if duplicate_policy is None:
+        duplicate_policy = DUPLICATE_POLICY
+    if keyframe_scan is None:
+        keyframe_scan = KEYFRAME_SCAN
+    if workers is None:
+        workers = DETECT_WORKERS
+    if detector is None:
+        detector = MOTION_DETECTOR
+
     start_time = time.time()
-    (W, H) = (None, None)
+    progress = throttled(progress)
+    if region is None:
+        # the learned mask is learned again on replays, it costs AUTO_MASK_SECONDS of decoding
+        region = detection_region(video_path)
 
-    # Get total frames for progress calculation
-    cap = cv2.VideoCapture(video_path)
-    total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-    cap.release()
+    # The capture is opened once, the frame count for the progress comes from it
+    # and the frames are decoded from it
+    vs = open_video(video_path)
+    total_frames = int(vs.get(cv2.CAP_PROP_FRAME_COUNT))
+    fps = vs.get(cv2.CAP_PROP_FPS)
 
     screenshoots_count = 0
     last_screenshot = None
-    saved_files = []
+    slides = []
+    compare_stats = new_compare_stats()
+    slide_index = BKTree()
+    references = []
     
     progress(0, desc="初始化视频处理...")
-    
-    for frame_count, frame_time, frame in get_frames(video_path):
-        # Update progress
-        progress((frame_count / total_frames) * 0.7, desc=f"处理视频帧 {frame_count}/{total_frames}")
-        
-        orig = frame.copy()
-        frame = imutils.resize(frame, width=600)
-        mask = fgbg.apply(frame)
 
-        if W is None or H is None:
-            (H, W) = mask.shape[:2]
+    windows = None
+    if keyframe_scan:
+        progress(0, desc="扫描关键帧...")
+        windows = find_keyframe_windows(video_path)
+        if windows is not None:
+            print(f'keyframe scan: decoding {len(windows)} windows')
 
-        p_diff = (cv2.countNonZero(mask) / float(W * H)) * 100
+    # the motion signal of a video processed before only needs the thresholds applied again
+    (recorded, signal_key) = load_signal(video_path, output_folder_screenshot_path, region, detector) if windows is None else (None, None)
+    signal = [] if signal_key is not None and recorded is None else None
 
-        if p_diff < MIN_PERCENT and not captured and frame_count > WARMUP:
-            captured = True
-            filename = f"{screenshoots_count:03}_{round(frame_time/60, 2)}.png"
-            path = os.path.join(output_folder_screenshot_path, filename)
-
-            image_ssim = 0.0
-            if last_screenshot is not None:
-                image_ssim = structural_similarity(last_screenshot, orig, channel_axis=2, data_range=255)
-
-            if image_ssim < SSIM_THRESHOLD:
-                try:
-                    progress(0.7 + (screenshoots_count * 0.1), desc=f"保存截图 {screenshoots_count + 1}")
-                    print("saving {}".format(path))
-                    cv2.imwrite(str(path), orig)
-                    last_screenshot = orig
-                    saved_files.append(path)
-                    screenshoots_count += 1
-                except Exception as e:
-                    print(f"Error saving image: {str(e)}")
-                    continue
-
-        elif captured and p_diff >= MAX_PERCENT:
-            captured = False
+    # frames are sampled at FRAME_RATE, not every frame of the video
+    duration = total_frames / fps if fps and fps > 0 else 0
+    sampled = sum((end if end is not None else duration) - start for start, end in (windows or [(0, None)]))
+    total_samples = max(math.ceil(sampled * FRAME_RATE), 1)
+
+    reader = None
+    if recorded is not None:
+        print(f'replaying the motion signal of {len(recorded)} frames')
+        candidates = replay_motion_stopped_frames(video_path, recorded, vs, detector)
+    elif windows is None and DETECT_CHUNK_SECONDS and duration > DETECT_CHUNK_SECONDS:
+        vs.release()
+        print(f'processing {duration:.1f}s of video in chunks of {DETECT_CHUNK_SECONDS}s with {workers} workers')
+        candidates = _parallel_motion_stopped_frames(video_path, workers, duration, progress, signal, region, detector)
+    else:
+        (frames, reader) = frame_source(video_path, detector, windows, vs)
+        full_frame = reader.full_frame if reader else None
+        candidates = ((frame_time, orig) for _, frame_time, orig in _motion_stopped_frames(frames, progress, total_samples, signal, region, detector, full_frame))
+
+    for frame_time, orig in candidates:
+        # frame_time is one sample after the timestamp of the frame, see get_frames
+        capture_time = max(frame_time - 1/FRAME_RATE, 0.0)
+        signature = slide_signature(orig, region)
+        if last_screenshot is not None and is_same_slide(last_screenshot, signature, compare_stats):
+            continue
+
+        # the lecturer went back to a slide that was saved before
+        duplicate = find_saved_slide(slide_index, signature, compare_stats) if duplicate_policy != "keep" else None
+        if duplicate is not None:
+            page, last_screenshot = duplicate
+            print(f"slide at {capture_time:.2f}s duplicates page {page + 1}")
+            slides[page]["revisits"].append(capture_time)
+            if duplicate_policy == "reference":
+                references.append({"time": capture_time, "page": page})
+            continue
+
+        try:
+            # slides are saved while the frames are processed, the fraction stays where the frames are
+            progress(progress.fraction, desc=f"保存截图 {screenshoots_count + 1}")
+            slide = {"time": capture_time, "path": None, "revisits": []}
+            data = save_slide(slide, screenshoots_count, orig, output_folder_screenshot_path, pdf_writer)
+            if keep_data:
+                slide["data"] = data
+            last_screenshot = signature
+            slide_index.add(signature["hash"], (screenshoots_count, signature))
+            slides.append(slide)
+            screenshoots_count += 1
+        except Exception as e:
+            print(f"Error saving image: {str(e)}")
+            continue
+
+    if reader is not None:
+        reader.close()
+    if signal:
+        save_signal(signal, signal_key, output_folder_screenshot_path)
+
+    if references:
+        for reference in references:
+            reference["path"] = slides[reference["page"]]["path"]
+        with open(os.path.join(output_folder_screenshot_path, "references.json"), "w") as f:
+            json.dump(references, f, indent=2)
 
     progress(0.8, desc="截图提取完成")
     print(f'{screenshoots_count} screenshots Captured!')
+    print(f'{compare_stats["comparisons"]} slide comparisons, {compare_stats["ssim_skipped"]} SSIM calls skipped by the hash')
     print(f'Time taken {time.time()-start_time}s')
-    return saved_files
+    return slides
+
+
+def detect_unique_screenshots(video_path, output_folder_screenshot_path, progress=gr.Progress(), **kwargs):
+    '''Extract unique screenshots from video, returns the paths of the saved screenshots'''
+    slides = detect_slides(video_path, output_folder_screenshot_path, progress, **kwargs)
+    return [slide["path"] for slide in slides if slide["path"]]
+
+
+def new_job_folder():
+    '''Create the working folder of a new job, named after a unique job id, so that
+    concurrent requests for videos with the same name never share files'''
+    job_id = f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}"
+    job_folder = os.path.join(JOBS_DIR, job_id)
+    os.makedirs(job_folder)
+    print('new job', job_id)
+    return job_folder
+
+
+def _last_modified(folder):
+    '''Most recent modification time of folder and of everything in it'''
+    last = os.path.getmtime(folder)
+    for root, dirs, files in os.walk(folder):
+        for name in dirs + files:
+            try:
+                last = max(last, os.path.getmtime(os.path.join(root, name)))
+            except OSError:
+                pass
+    return last
+
+
+def cleanup_jobs(ttl=None):
+    '''Remove the job folders that were not modified for ttl seconds (defaults to JOB_TTL_SECONDS),
+    a running job keeps writing to its folder and is not removed. Returns the number of removed jobs'''
+    ttl = JOB_TTL_SECONDS if ttl is None else ttl
+    if not os.path.isdir(JOBS_DIR):
+        return 0
+
+    removed = 0
+    now = time.time()
+    for name in os.listdir(JOBS_DIR):
+        job_folder = os.path.join(JOBS_DIR, name)
+        try:
+            if os.path.isdir(job_folder) and now - _last_modified(job_folder) > ttl:
+                shutil.rmtree(job_folder)
+                removed += 1
+        except OSError as e:
+            print(f"Error removing job {name}: {str(e)}")
+    if removed:
+        print(f'removed {removed} expired jobs')
+    return removed
+
+
+def start_job_cleanup(interval=None):
+    '''Run cleanup_jobs every interval seconds (defaults to JOB_CLEANUP_INTERVAL) in a daemon thread'''
+    interval = interval or JOB_CLEANUP_INTERVAL
 
+    def run():
+        while True:
+            cleanup_jobs()
+            time.sleep(interval)
 
-def initialize_output_folder(video_path):
-    '''Clean the output folder if already exists'''
-    # Create a safe folder name from video filename
+    thread = threading.Thread(target=run, name="job-cleanup", daemon=True)
+    thread.start()
+    return thread
+
+
+def safe_video_name(video_path):
+    '''File name of the video without extension and problematic characters'''
     video_filename = os.path.splitext(os.path.basename(video_path))[0]
-    # Replace potentially problematic characters
-    safe_filename = "".join(x for x in video_filename if x.isalnum() or x in (' ', '-', '_'))
-    output_folder_screenshot_path = os.path.join(OUTPUT_SLIDES_DIR, safe_filename)
+    return "".join(x for x in video_filename if x.isalnum() or x in (' ', '-', '_'))
+
+
+def initialize_output_folder(video_path, job_folder=None):
+    '''Clean the screenshot folder of the video in job_folder (defaults to OUTPUT_SLIDES_DIR)
+    if already exists'''
+    output_folder_screenshot_path = os.path.join(job_folder or OUTPUT_SLIDES_DIR, safe_video_name(video_path))
 
     if os.path.exists(output_folder_screenshot_path):
         shutil.rmtree(output_folder_screenshot_path)
@@ -136,24 +1237,34 @@ def initialize_output_folder(video_path):
     return output_folder_screenshot_path
 
 
+def get_output_pdf_path(video_path, job_folder=None):
+    '''Path of the pdf created for video_path in job_folder (defaults to OUTPUT_SLIDES_DIR)'''
+    return os.path.join(job_folder or OUTPUT_SLIDES_DIR, f"{safe_video_name(video_path)}.pdf")
+
+
+def write_pdf(image_files, output_pdf_path):
+    '''Write the png or jpeg images to a pdf, one page at a time so only one image is in memory'''
+    with PdfWriter(output_pdf_path) as writer:
+        for image_file in image_files:
+            with open(image_file, "rb") as f:
+                writer.add_image(f.read())
+
+
 def convert_screenshots_to_pdf(video_path, output_folder_screenshot_path):
-    # Create a safe filename
-    video_filename = os.path.splitext(os.path.basename(video_path))[0]
-    safe_filename = "".join(x for x in video_filename if x.isalnum() or x in (' ', '-', '_'))
-    output_pdf_path = os.path.join(OUTPUT_SLIDES_DIR, f"{safe_filename}.pdf")
+    output_pdf_path = get_output_pdf_path(video_path, os.path.dirname(output_folder_screenshot_path))
     
     try:
         print('output_folder_screenshot_path', output_folder_screenshot_path)
         print('output_pdf_path', output_pdf_path)
         print('converting images to pdf..')
         
-        # Get all PNG files and ensure they exist
-        png_files = sorted(glob.glob(os.path.join(output_folder_screenshot_path, "*.png")))
-        if not png_files:
-            raise Exception("No PNG files found to convert to PDF")
+        # Get all PNG and JPEG files and ensure they exist
+        image_files = sorted(glob.glob(os.path.join(output_folder_screenshot_path, "*.png")) +
+                             glob.glob(os.path.join(output_folder_screenshot_path, "*.jpg")))
+        if not image_files:
+            raise Exception("No image files found to convert to PDF")
             
-        with open(output_pdf_path, "wb") as f:
-            f.write(img2pdf.convert(png_files))
+        write_pdf(image_files, output_pdf_path)
             
         print('Pdf Created!')
         print('pdf saved at', output_pdf_path)
@@ -163,17 +1274,14 @@ def convert_screenshots_to_pdf(video_path, output_folder_screenshot_path):
         raise
 
 
-def video_to_slides(video_path, progress=gr.Progress()):
-    progress(0.1, desc="准备处理视频...")
-    output_folder_screenshot_path = initialize_output_folder(video_path)
-    saved_files = detect_unique_screenshots(video_path, output_folder_screenshot_path, progress)
-    return output_folder_screenshot_path, saved_files
+def video_to_slides(video_path, progress=gr.Progress(), job_folder=None):
+    job = new_job(video_path, progress, job_folder=job_folder)
+    saved_files = [slide["path"] for slide in job.get("detect") if slide["path"]]
+    return job.get("ingest")["output_folder"], saved_files
 
 
 def slides_to_pdf(video_path, output_folder_screenshot_path, saved_files, progress=gr.Progress()):
-    video_filename = os.path.splitext(os.path.basename(video_path))[0]
-    safe_filename = "".join(x for x in video_filename if x.isalnum() or x in (' ', '-', '_'))
-    output_pdf_path = os.path.join(OUTPUT_SLIDES_DIR, f"{safe_filename}.pdf")
+    output_pdf_path = get_output_pdf_path(video_path, os.path.dirname(output_folder_screenshot_path))
     
     try:
         progress(0.9, desc="正在生成PDF...")
@@ -187,8 +1295,7 @@ def slides_to_pdf(video_path, output_folder_screenshot_path, saved_files, progre
         if not existing_files:
             raise Exception("未找到保存的截图文件")
             
-        with open(output_pdf_path, "wb") as f:
-            f.write(img2pdf.convert(existing_files))
+        write_pdf(existing_files, output_pdf_path)
             
         progress(1.0, desc="处理完成！")
         print('PDF创建成功！')
@@ -199,14 +1306,80 @@ def slides_to_pdf(video_path, output_folder_screenshot_path, saved_files, progre
         raise
 
 
-def run_app(video_path, progress=gr.Progress()):
+def result_cache_params(model_size=None, transcribe=False, ocr=False):
+    '''Parameters that change the result of processing a video, part of the result cache key'''
+    (min_percent, max_percent) = MOTION_DETECTORS[MOTION_DETECTOR].thresholds()
+    return {
+        "FRAME_RATE": FRAME_RATE, "WARMUP": WARMUP, "FRAME_SAMPLER": FRAME_SAMPLER, "DETECT_CHUNK_SECONDS": DETECT_CHUNK_SECONDS,
+        "motion": detector_params(MOTION_DETECTOR), "min_percent": min_percent, "max_percent": max_percent,
+        # the auto mask is learned with the background subtractor whatever the detector
+        "mog2": detector_params("mog2"),
+        "DETECT_ROI": DETECT_ROI, "DETECT_MASKS": DETECT_MASKS, "AUTO_MASK_SECONDS": AUTO_MASK_SECONDS,
+        "AUTO_MASK_PERSISTENCE": AUTO_MASK_PERSISTENCE, "AUTO_MASK_DILATE": AUTO_MASK_DILATE, "AUTO_MASK_DIFF": AUTO_MASK_DIFF,
+        "KEYFRAME_SCAN": KEYFRAME_SCAN, "KEYFRAME_DIFF_THRESHOLD": KEYFRAME_DIFF_THRESHOLD,
+        "KEYFRAME_WINDOW_TAIL": KEYFRAME_WINDOW_TAIL, "KEYFRAME_THUMB_SIZE": KEYFRAME_THUMB_SIZE,
+        "SSIM_THRESHOLD": SSIM_THRESHOLD, "SSIM_WIDTH": SSIM_WIDTH, "HASH_SAME_DISTANCE": HASH_SAME_DISTANCE,
+        "HASH_DIFF_DISTANCE": HASH_DIFF_DISTANCE, "DUPLICATE_POLICY": DUPLICATE_POLICY,
+        "DUPLICATE_HASH_DISTANCE": DUPLICATE_HASH_DISTANCE, "SLIDE_FORMAT": SLIDE_FORMAT, "JPEG_QUALITY": JPEG_QUALITY,
+        "whisper_model": (model_size or WHISPER_MODEL) if transcribe else None,
+        "ocr": bool(ocr),
+    }
+
+
+def get_cached_result(video_path, targets, progress, model_size=None, transcribe=False, ocr=False):
+    '''Look the video up in the result cache and copy the cached files to targets,
+    returns (cache key, hit)'''
+    if not RESULT_CACHE.enabled:
+        return None, False
+    progress(0.05, desc="计算视频指纹...")
+    cache_key = RESULT_CACHE.key(video_path, result_cache_params(model_size, transcribe, ocr))
+    hit = RESULT_CACHE.get(cache_key, targets)
+    if hit:
+        progress(1.0, desc="处理完成（使用缓存结果）！")
+        print('使用缓存结果:', cache_key)
+    return cache_key, hit
+
+
+def profile_job(job_folder):
+    '''Profile the stages of the job that runs in job_folder, the report is written to profile.json'''
+    return profiler.profiling(profiler.Profile(os.path.basename(job_folder)), os.path.join(job_folder, "profile.json"))
+
+
+def video_to_pdf(video_path, progress=gr.Progress(), job_folder=None, ocr=None):
+    '''Detect the slides and write them to the pdf. All files are written to job_folder,
+    a new job folder is created when it is not given. With ocr (defaults to OCR_ENABLED)
+    the text of the slides is added as a searchable text layer'''
+    progress = throttled(progress)
+    ocr = OCR_ENABLED if ocr is None else ocr
+    job = new_job(video_path, progress, job_folder=job_folder, ocr=ocr)
+    ingest = job.get("ingest")
+    output_pdf_path = ingest["pdf_path"]
+    print('output_pdf_path', output_pdf_path)
+
+    with profile_job(ingest["job_folder"]):
+        cache_key, hit = get_cached_result(video_path, {"result.pdf": output_pdf_path}, progress, ocr=ocr)
+        if hit:
+            return output_pdf_path
+
+        print('pipeline:', ' -> '.join(job.plan("assemble")))
+        job.get("assemble")
+
+        if cache_key is not None:
+            RESULT_CACHE.put(cache_key, {"result.pdf": output_pdf_path})
+
+        progress(1.0, desc="处理完成！")
+        print('PDF创建成功！')
+        print('PDF保存位置:', output_pdf_path)
+        return output_pdf_path
+
+
+def run_app(video_path, progress=gr.Progress(), job_folder=None):
     try:
         if not video_path:
             raise gr.Error("请选择要处理的视频文件")
             
         progress(0, desc="开始处理...")
-        output_folder_screenshot_path, saved_files = video_to_slides(video_path, progress)
-        return slides_to_pdf(video_path, output_folder_screenshot_path, saved_files, progress)
+        return video_to_pdf(video_path, progress, job_folder)
     except Exception as e:
         raise gr.Error(f"处理失败: {str(e)}")
 
@@ -222,9 +1395,9 @@ def process_video_file(video_file):
             
         # If it's an uploaded file, create a temporary file
         if video_file is not None:
-            # Generate a unique filename for the temporary video
-            temp_filename = f"temp_video_{int(time.time())}.mp4"
-            temp_path = os.path.join(tempfile.gettempdir(), temp_filename)
+            # The temporary video lives in the folder of its job, so uploads never collide
+            job_folder = new_job_folder()
+            temp_path = os.path.join(job_folder, "temp_video.mp4")
             
             try:
                 if hasattr(video_file, 'name'):  # If it's already a file path
@@ -234,8 +1407,7 @@ def process_video_file(video_file):
                         f.write(video_file)
                 
                 # Process the video
-                output_folder_screenshot_path, saved_files = video_to_slides(temp_path)
-                pdf_path = slides_to_pdf(temp_path, output_folder_screenshot_path, saved_files)
+                pdf_path = video_to_pdf(temp_path, job_folder=job_folder)
                 
                 # Cleanup
                 if os.path.exists(temp_path):
@@ -251,28 +1423,308 @@ def process_video_file(video_file):
         raise gr.Error(f"处理视频时出错: {str(e)}")
 
 
-def extract_audio_and_transcribe(video_path, progress=gr.Progress()):
+def _model_bytes(model):
+    '''Memory used by the parameters and buffers of a torch model'''
+    tensors = list(model.parameters()) + list(model.buffers())
+    return sum(t.numel() * t.element_size() for t in tensors)
+
+
+def _evict_whisper_models(keep=None):
+    '''Drop the models that were idle for WHISPER_IDLE_SECONDS, then the least recently
+    used ones until the resident models fit in WHISPER_MEMORY_BUDGET_MB. The models of the
+    transcription workers count against the budget, the workers are stopped when they were
+    idle for WHISPER_IDLE_SECONDS. Must be called with _whisper_lock held'''
+    now = time.time()
+    if _transcribe_pool is not None and now - _transcribe_pool["last_used"] > WHISPER_IDLE_SECONDS:
+        _shutdown_transcribe_pool()
+    budget = WHISPER_MEMORY_BUDGET_MB * 1024 * 1024 - sum(_worker_model_bytes.values())
+    evicted = False
+
+    for size in list(_whisper_models):
+        if size != keep and now - _whisper_models[size]["last_used"] > WHISPER_IDLE_SECONDS:
+            del _whisper_models[size]
+            evicted = True
+            WHISPER_METRICS["evictions"] += 1
+
+    # _whisper_models is ordered from the least to the most recently used model
+    while sum(entry["bytes"] for entry in _whisper_models.values()) > budget:
+        size = next((s for s in _whisper_models if s != keep), None)
+        if size is None:
+            break
+        del _whisper_models[size]
+        evicted = True
+        WHISPER_METRICS["evictions"] += 1
+
+    if evicted:
+        import torch
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+
+def get_whisper_model(size=None):
+    '''Return the whisper model of the given size (defaults to WHISPER_MODEL), the model is
+    loaded on first use and stays resident for the following requests'''
+    size = size or WHISPER_MODEL
+
+    with _whisper_lock:
+        entry = _whisper_models.get(size)
+        if entry is not None:
+            WHISPER_METRICS["hits"] += 1
+            entry["last_used"] = time.time()
+            _whisper_models.move_to_end(size)
+            return entry["model"]
+        WHISPER_METRICS["misses"] += 1
+        load_lock = _whisper_load_locks.setdefault(size, threading.Lock())
+
+    # load outside of the registry lock so that other model sizes stay available
+    with load_lock:
+        with _whisper_lock:
+            entry = _whisper_models.get(size)
+            if entry is not None:
+                entry["last_used"] = time.time()
+                return entry["model"]
+
+        start_time = time.time()
+        model = whisper.load_model(size)
+        load_seconds = time.time() - start_time
+        print(f'loaded whisper model {size} in {load_seconds:.1f}s')
+
+        with _whisper_lock:
+            WHISPER_METRICS["loads"] += 1
+            WHISPER_METRICS["load_seconds"] += load_seconds
+            _whisper_models[size] = {"model": model, "bytes": _model_bytes(model), "last_used": time.time()}
+            _evict_whisper_models(keep=size)
+        return model
+
+
+def whisper_model_lock(size=None):
+    '''Lock to hold while a shared whisper model transcribes, whisper keeps the decoding
+    state of a transcription in the model so two requests must not use it at the same time'''
+    with _whisper_lock:
+        return _whisper_run_locks.setdefault(size or WHISPER_MODEL, threading.Lock())
+
+
+def warm_whisper_models(sizes=None):
+    '''Load the given model sizes (defaults to WHISPER_PRELOAD) ahead of the first request'''
+    for size in (WHISPER_PRELOAD if sizes is None else sizes):
+        get_whisper_model(size)
+
+
+def whisper_metrics():
+    '''Load time, cache hit rate and resident models of the whisper model registry'''
+    with _whisper_lock:
+        _evict_whisper_models()
+        requests = WHISPER_METRICS["hits"] + WHISPER_METRICS["misses"]
+        return dict(
+            WHISPER_METRICS,
+            hit_rate=WHISPER_METRICS["hits"] / requests if requests else 0.0,
+            resident={size: entry["bytes"] for size, entry in _whisper_models.items()},
+            resident_models=len(_whisper_models),
+            resident_bytes=sum(entry["bytes"] for entry in _whisper_models.values()),
+            worker_bytes=sum(_worker_model_bytes.values()),
+        )
+
+
+profiler.register_metrics("whisper", whisper_metrics, {
+    "loads": ("counter", "Whisper models loaded"),
+    "load_seconds": ("counter", "Time spent loading whisper models"),
+    "hits": ("counter", "Requests of a whisper model that was already loaded"),
+    "misses": ("counter", "Requests of a whisper model that had to be loaded"),
+    "evictions": ("counter", "Whisper models evicted from memory"),
+    "resident_models": ("gauge", "Whisper models in memory (of the process with the most)"),
+    "resident_bytes": ("gauge", "Memory of the resident whisper models (of the process with the most)"),
+    "worker_bytes": ("gauge", "Memory of the whisper models of the transcription workers (of the process with the most)"),
+})
+
+
+def iter_audio_chunks(video_path, chunk_seconds=None):
+    '''Decode the audio track of video_path with ffmpeg straight to 16 kHz mono float32
+    and yield it in chunks of chunk_seconds (defaults to AUDIO_CHUNK_SECONDS)'''
+    chunk_bytes = int((chunk_seconds or AUDIO_CHUNK_SECONDS) * AUDIO_SAMPLE_RATE) * 4
+    cmd = [FFMPEG_BIN, "-nostdin", "-v", "error", "-i", video_path, "-vn",
+           "-ac", "1", "-ar", str(AUDIO_SAMPLE_RATE), "-f", "f32le", "-"]
+    # stderr goes to a file, ffmpeg would block on a full pipe while we only read stdout
+    with tempfile.TemporaryFile() as errors:
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=errors)
+        finished = False
+        try:
+            while True:
+                data = proc.stdout.read(chunk_bytes)
+                if not data:
+                    finished = True
+                    break
+                yield np.frombuffer(data, dtype=np.float32)
+        finally:
+            proc.stdout.close()
+            if not finished:
+                proc.kill()
+            proc.wait()
+
+        # only report ffmpeg errors when the whole stream was read
+        if proc.returncode != 0:
+            errors.seek(0)
+            message = errors.read().decode(errors="replace").strip()[-FFMPEG_ERROR_TAIL:]
+            raise Exception(f"无法提取音频: {message}")
+
+
+def load_audio(video_path):
+    '''Decode the whole audio track into one float32 array, the array is allocated once
+    from the duration reported by ffprobe and filled chunk by chunk'''
+    duration = float(probe_video(video_path).get("duration") or 0)
+    audio = np.empty(int((duration + 1) * AUDIO_SAMPLE_RATE), dtype=np.float32)
+    filled = 0
+
+    for chunk in iter_audio_chunks(video_path):
+        if filled + len(chunk) > len(audio):
+            grown = np.empty(max(len(audio) * 2, filled + len(chunk)), dtype=np.float32)
+            grown[:filled] = audio[:filled]
+            audio = grown
+        audio[filled:filled + len(chunk)] = chunk
+        filled += len(chunk)
+
+    return audio[:filled]
+
+
+def split_on_silence(audio, chunk_seconds=None):
+    '''Split audio into chunks of about chunk_seconds (defaults to TRANSCRIBE_CHUNK_SECONDS).
+    A lightweight energy VAD places every cut at the quietest VAD_MIN_SILENCE long stretch
+    within a quarter chunk of the target position, so no words are cut in half.
+    Returns a list of (start, end) sample indexes'''
+    chunk = int((chunk_seconds or TRANSCRIBE_CHUNK_SECONDS) * AUDIO_SAMPLE_RATE)
+    frame = int(VAD_FRAME_SECONDS * AUDIO_SAMPLE_RATE)
+    n_frames = len(audio) // frame
+    if len(audio) <= chunk * 1.25 or n_frames == 0:
+        return [(0, len(audio))]
+
+    # rms energy per frame, averaged over VAD_MIN_SILENCE
+    rms = np.sqrt(np.mean(np.square(audio[:n_frames * frame].reshape(n_frames, frame)), axis=1))
+    smooth = max(int(VAD_MIN_SILENCE / VAD_FRAME_SECONDS), 1)
+    energy = np.convolve(rms, np.ones(smooth) / smooth, mode="same")
+
+    bounds = []
+    start = 0
+    while len(audio) - start > chunk * 1.25:
+        low = (start + chunk * 3 // 4) // frame
+        high = min((start + chunk * 5 // 4) // frame, n_frames)
+        cut = (low + int(np.argmin(energy[low:high]))) * frame if high > low else start + chunk
+        bounds.append((start, cut))
+        start = cut
+    bounds.append((start, len(audio)))
+    return bounds
+
+
+def _init_transcribe_worker(threads, budget_mb, model_size):
+    '''Process worker initializer: limit the torch threads, give the worker its share of the
+    whisper memory budget and load the model before the first chunk arrives'''
+    global WHISPER_MEMORY_BUDGET_MB
+    import torch
+    torch.set_num_threads(threads)
+    WHISPER_MEMORY_BUDGET_MB = budget_mb
+    get_whisper_model(model_size)
+
+
+def _transcribe_chunk(audio, offset, model_size):
+    '''Process worker: transcribe one audio chunk, the timestamps are shifted by offset
+    seconds to the position of the chunk in the whole audio. Returns the segments, the pid
+    of the worker and the memory of its resident whisper models'''
+    model = get_whisper_model(model_size)
+    result = model.transcribe(audio)
+    segments = [{
+        "start": segment["start"] + offset,
+        "end": segment["end"] + offset,
+        "text": segment["text"].strip()
+    } for segment in result["segments"]]
+    with _whisper_lock:
+        resident = sum(entry["bytes"] for entry in _whisper_models.values())
+    return segments, os.getpid(), resident
+
+
+def _shutdown_transcribe_pool():
+    '''Stop the transcription workers, must be called with _whisper_lock held'''
+    global _transcribe_pool
+    if _transcribe_pool is not None:
+        _transcribe_pool["pool"].shutdown(wait=False, cancel_futures=True)
+        _transcribe_pool = None
+    _worker_model_bytes.clear()
+
+
+def transcription_pool(workers, model_size=None):
+    '''The pool of transcription workers, started on first use and kept alive for the next
+    jobs so that the workers load their whisper model once. The workers and this process
+    share WHISPER_MEMORY_BUDGET_MB, every worker preloads model_size'''
+    global _transcribe_pool
+    with _whisper_lock:
+        if _transcribe_pool is not None and _transcribe_pool["workers"] != workers:
+            _shutdown_transcribe_pool()
+        if _transcribe_pool is None:
+            threads = max((os.cpu_count() or 1) // workers, 1)
+            budget_mb = WHISPER_MEMORY_BUDGET_MB / (workers + 1)
+            pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+                                       initializer=_init_transcribe_worker,
+                                       initargs=(threads, budget_mb, model_size or WHISPER_MODEL))
+            _transcribe_pool = {"pool": pool, "workers": workers, "last_used": time.time()}
+        _transcribe_pool["last_used"] = time.time()
+        return _transcribe_pool["pool"]
+
+
+def transcribe_long_audio(audio, model_size=None, progress=no_progress, chunk_seconds=None, workers=None):
+    '''Split long audio on silence and transcribe the chunks in the pool of workers
+    (defaults to TRANSCRIBE_WORKERS) of transcription_pool, every worker process keeps its own
+    whisper model. Returns the segments of all chunks with timestamps relative to the start of the audio'''
+    workers = workers or TRANSCRIBE_WORKERS
+    bounds = split_on_silence(audio, chunk_seconds)
+    print(f'transcribing {len(audio) / AUDIO_SAMPLE_RATE:.1f}s of audio in {len(bounds)} chunks with {workers} workers')
+
+    pool = transcription_pool(workers, model_size)
+    futures = [pool.submit(_transcribe_chunk, audio[start:end], start / AUDIO_SAMPLE_RATE, model_size)
+               for start, end in bounds]
+    segments = []
+    try:
+        for i, future in enumerate(futures):
+            (chunk_segments, pid, resident) = future.result()
+            segments.extend(chunk_segments)
+            with _whisper_lock:
+                _worker_model_bytes[pid] = resident
+                if _transcribe_pool is not None:
+                    _transcribe_pool["last_used"] = time.time()
+                _evict_whisper_models()
+            progress(0.3 + 0.7 * (i + 1) / len(futures), desc=f"正在转录音频 {i + 1}/{len(futures)}")
+    except BrokenProcessPool:
+        # a worker died, the next job starts new workers
+        with _whisper_lock:
+            if _transcribe_pool is not None and _transcribe_pool["pool"] is pool:
+                _shutdown_transcribe_pool()
+        raise
+    return segments
+
+
+def extract_audio_and_transcribe(video_path, progress=gr.Progress(), model_size=None):
     """Extract audio from video and transcribe it using Whisper"""
     progress(0, desc="正在提取音频...")
     
-    # Load the video and extract audio
-    video = VideoFileClip(video_path)
-    audio = video.audio
-    
-    # Save audio to temporary file
-    temp_audio = tempfile.mktemp(suffix='.wav')
-    audio.write_audiofile(temp_audio)
-    
+    # Decode the audio track in memory, 16 kHz mono as whisper expects it
+    with stage("audio_extraction"):
+        audio = load_audio(video_path)
+
+    return transcribe_audio(audio, progress, model_size)
+
+
+def transcribe_audio(audio, progress=gr.Progress(), model_size=None):
+    """Transcribe 16 kHz mono audio using Whisper, returns the segments with timestamps"""
     progress(0.3, desc="正在转录音频...")
+
+    # Long audio is split on silence and transcribed in parallel
+    if len(audio) > LONG_AUDIO_SECONDS * AUDIO_SAMPLE_RATE and TRANSCRIBE_WORKERS > 1:
+        with stage("transcription"):
+            segments = transcribe_long_audio(audio, model_size, progress)
+        print("完成的转录文本结果如下：" + " ".join(segment["text"] for segment in segments))
+        return segments
     
-    # Load Whisper model and transcribe
-    model = whisper.load_model("base")
-    result = model.transcribe(temp_audio)
-    print("完成的转录文本结果如下："+result)
-    
-    # Clean up
-    os.remove(temp_audio)
-    video.close()
+    # Get the cached Whisper model and transcribe
+    model = get_whisper_model(model_size)
+    with whisper_model_lock(model_size), stage("transcription"):
+        result = model.transcribe(audio)
+    print("完成的转录文本结果如下："+result["text"])
     
     # Process segments with timestamps
     segments = []
@@ -285,82 +1737,187 @@ def extract_audio_and_transcribe(video_path, progress=gr.Progress()):
     
     return segments
 
-def add_text_to_image(image_path, text):
-    """Add text below the image"""
-    # Open image
-    img = Image.open(image_path)
-    width, height = img.size
-    
-    # Create new image with space for text
-    font_size = 30
-    font = ImageFont.truetype("arial.ttf", font_size)
-    text_height = font_size * (text.count('\n') + 2)  # Add padding
-    
-    new_img = Image.new('RGB', (width, height + text_height), 'white')
-    new_img.paste(img, (0, 0))
-    
-    # Add text
-    draw = ImageDraw.Draw(new_img)
-    draw.text((10, height + 10), text, font=font, fill='black')
-    
-    # Save the modified image
-    new_img.save(image_path)
+def assign_captions(slides, segments):
+    '''Assign the transcription segments to the slides. A slide is on screen from its capture
+    time (or one of its revisits) until the next capture, every segment goes to the slide that
+    was on screen at the middle of the segment. Returns the list of texts of every slide'''
+    events = sorted((capture_time, page) for page, slide in enumerate(slides)
+                    for capture_time in [slide["time"]] + slide.get("revisits", []))
+    starts = [capture_time for capture_time, _ in events]
 
-def process_video_with_transcription(video_path, output_folder_screenshot_path, progress=gr.Progress()):
-    """Process video with transcription and add text to images"""
-    # First, get the transcription
-    segments = extract_audio_and_transcribe(video_path, progress)
-    
-    # Then get the frames as before
-    saved_files = detect_unique_screenshots(video_path, output_folder_screenshot_path, progress)
-    
+    captions = [[] for _ in slides]
+    if not events:
+        return captions
+    for segment in sorted(segments, key=lambda segment: segment["start"]):
+        middle = (segment["start"] + segment["end"]) / 2
+        # speech before the first capture belongs to the first slide
+        event = max(bisect.bisect_right(starts, middle) - 1, 0)
+        captions[events[event][1]].append(segment["text"])
+    return captions
+
+
+def _ingest_stage(job, progress):
+    '''Create the job folder and the screenshot folder of the video'''
+    progress(0.1, desc="准备处理视频...")
+    video_path = job.params["video_path"]
+    job_folder = job.params.get("job_folder") or new_job_folder()
+    return {
+        "video_path": video_path,
+        "job_folder": job_folder,
+        "output_folder": initialize_output_folder(video_path, job_folder),
+        "pdf_path": get_output_pdf_path(video_path, job_folder),
+    }
+
+
+def _decode_stage(job, progress):
+    '''Decode the audio track, the video frames are decoded by the detect stage
+    while it processes them and are never kept'''
+    progress(0, desc="正在提取音频...")
+    with stage("audio_extraction"):
+        return load_audio(job.get("ingest")["video_path"])
+
+
+def _transcribe_stage(job, progress):
+    '''Transcribe the decoded audio and write the segments to transcript.json'''
+    segments = transcribe_audio(job.get("decode", progress), progress, job.params.get("model_size"))
+    with open(os.path.join(job.get("ingest")["output_folder"], "transcript.json"), "w", encoding="utf-8") as f:
+        json.dump(segments, f, ensure_ascii=False, indent=2)
+    return segments
+
+
+def _detect_stage(job, progress):
+    '''Detect the slides, the encoded image of every slide is kept in its "data" for the OCR
+    and the pdf. The artifact is shared by the later stages, they must not change it'''
+    ingest = job.get("ingest")
+    return detect_slides(ingest["video_path"], ingest["output_folder"], progress, keep_data=True)
+
+
+def _caption_stage(job, progress):
+    '''Transcribe the audio and detect the slides at the same time, they only meet when
+    the transcription segments are matched to the slides'''
+    (segments, slides) = job.get_parallel(["transcribe", "detect"], progress, scale=0.8)
     progress(0.8, desc="正在添加字幕...")
-    
-    # Match transcription segments with images
-    for i, image_path in enumerate(saved_files):
-        # Extract timestamp from filename (format: 000_1.23.png)
-        timestamp = float(os.path.basename(image_path).split('_')[1].split('.png')[0])
-        
-        # Find relevant text segments for this timestamp
-        relevant_text = []
-        for segment in segments:
-            if segment["start"] <= timestamp * 60 <= segment["end"]:
-                relevant_text.append(segment["text"])
-        
-        # Add text to image
-        if relevant_text:
-            text = "\n".join(relevant_text)
-            add_text_to_image(image_path, text)
-    
-    progress(0.9, desc="处理完成...")
-    return saved_files
+    with stage("caption_matching", len(segments)):
+        return assign_captions(slides, segments)
+
+
+def _ocr_stage(job, progress):
+    '''Recognize the text of the slides with the OCR API, returns the text lines of every slide
+    (None for a slide whose requests failed). Slides that were recognized before come from
+    the OCR cache'''
+    slides = job.get("detect", progress)
+    progress(0.8, desc="正在识别文字...")
+
+    def report(done, total):
+        progress(0.8 + 0.15 * done / total, desc=f"正在识别文字 {done}/{total}")
+
+    with stage("ocr", len(slides)):
+        lines = ocrapi.recognize_images([slide["data"] for slide in slides], progress=report)
+    if slides and all(slide_lines is None for slide_lines in lines):
+        raise Exception(f"OCR服务不可用: {ocrapi.ocr_api_url}")
+    return lines
+
+
+def _assemble_stage(job, progress):
+    '''Write the pdf from the detected slides, every slide with its caption as real pdf text
+    below it and its recognized text as an invisible text layer over it'''
+    ingest = job.get("ingest")
+    # the caption stage runs the detection and the transcription at the same time,
+    # it has to be requested before anything waits for the detection alone
+    captions = job.get("caption", progress) if job.params.get("transcribe") else None
+    text_layers = job.get("ocr", progress) if job.params.get("ocr") else None
+    slides = job.get("detect", progress)
+    captions = captions or [None] * len(slides)
+    text_layers = text_layers or [None] * len(slides)
+    progress(0.95, desc="正在生成PDF...")
+    with PdfWriter(ingest["pdf_path"]) as writer:
+        for slide, texts, text_layer in zip(slides, captions, text_layers):
+            with stage("pdf_assembly", 1):
+                writer.add_image(slide["data"], caption="\n".join(texts) if texts else None,
+                                 text_layer=text_layer)
+
+    if writer.page_count == 0:
+        os.unlink(ingest["pdf_path"])
+        raise Exception("未从视频中捕获到截图")
+    return ingest["pdf_path"]
+
+
+def _assemble_deps(job):
+    deps = ["caption"] if job.params.get("transcribe") else []
+    if job.params.get("ocr"):
+        deps.append("ocr")
+    return deps + ["detect"]
 
-def run_app_with_transcription(video_path, progress=gr.Progress()):
+
+PIPELINE = [
+    Stage("ingest", _ingest_stage),
+    Stage("decode", _decode_stage, ("ingest",)),
+    Stage("transcribe", _transcribe_stage, ("decode",)),
+    Stage("detect", _detect_stage, ("ingest",)),
+    Stage("caption", _caption_stage, ("detect", "transcribe")),
+    Stage("ocr", _ocr_stage, ("detect",)),
+    Stage("assemble", _assemble_stage, _assemble_deps),
+]
+
+
+def new_job(video_path, progress=None, **params):
+    '''A job of the pipeline for video_path, params: job_folder, transcribe, model_size, ocr'''
+    return Job(PIPELINE, progress, video_path=video_path, **params)
+
+
+def video_to_pdf_with_transcription(video_path, progress=gr.Progress(), model_size=None, job_folder=None, ocr=None):
+    """Detect the slides, add the transcription and write every slide to the pdf,
+    all files are written to job_folder (a new job folder when it is not given).
+    With ocr (defaults to OCR_ENABLED) the text of the slides is added as a text layer"""
+    progress = throttled(progress)
+    ocr = OCR_ENABLED if ocr is None else ocr
+    job = new_job(video_path, progress, job_folder=job_folder, transcribe=True, model_size=model_size, ocr=ocr)
+    ingest = job.get("ingest")
+    output_pdf_path = ingest["pdf_path"]
+    transcript_path = os.path.join(ingest["output_folder"], "transcript.json")
+    print('output_pdf_path', output_pdf_path)
+
+    with profile_job(ingest["job_folder"]):
+        cache_files = {"result.pdf": output_pdf_path, "transcript.json": transcript_path}
+        cache_key, hit = get_cached_result(video_path, cache_files, progress, model_size, transcribe=True, ocr=ocr)
+        if hit:
+            return output_pdf_path
+
+        print('pipeline:', ' -> '.join(job.plan("assemble")))
+        job.get("assemble")
+
+        if cache_key is not None:
+            RESULT_CACHE.put(cache_key, cache_files)
+
+        progress(1.0, desc="处理完成！")
+        print('PDF创建成功！')
+        print('PDF保存位置:', output_pdf_path)
+        return output_pdf_path
+
+def run_app_with_transcription(video_path, progress=gr.Progress(), model_size=None, job_folder=None):
     try:
         if not video_path:
             raise gr.Error("请选择要处理的视频文件")
             
         progress(0, desc="开始处理...")
-        output_folder_screenshot_path = initialize_output_folder(video_path)
-        saved_files = process_video_with_transcription(video_path, output_folder_screenshot_path, progress)
-        return slides_to_pdf(video_path, output_folder_screenshot_path, saved_files, progress)
+        return video_to_pdf_with_transcription(video_path, progress, model_size, job_folder)
     except Exception as e:
         raise gr.Error(f"处理失败: {str(e)}")
 
-def process_video_file_with_transcription(video_file):
+def process_video_file_with_transcription(video_file, model_size=None):
     """Handle uploaded video file and return PDF with transcription"""
     try:
         # If video_file is a string (path), use it directly
         if isinstance(video_file, str):
             if video_file.strip() == "":
                 return None
-            return run_app_with_transcription(video_file)
+            return run_app_with_transcription(video_file, model_size=model_size)
             
         # If it's an uploaded file, create a temporary file
         if video_file is not None:
-            # Generate a unique filename for the temporary video
-            temp_filename = f"temp_video_{int(time.time())}.mp4"
-            temp_path = os.path.join(tempfile.gettempdir(), temp_filename)
+            # The temporary video lives in the folder of its job, so uploads never collide
+            job_folder = new_job_folder()
+            temp_path = os.path.join(job_folder, "temp_video.mp4")
             
             try:
                 if hasattr(video_file, 'name'):  # If it's already a file path
@@ -369,10 +1926,8 @@ def process_video_file_with_transcription(video_file):
                     with open(temp_path, 'wb') as f:
                         f.write(video_file)
                 
-                # Process the video
-                output_folder_screenshot_path, saved_files = video_to_slides(temp_path)
-                saved_files = process_video_with_transcription(temp_path, output_folder_screenshot_path)
-                pdf_path = slides_to_pdf(temp_path, output_folder_screenshot_path, saved_files)
+                # Process the video, the pipeline detects the slides once
+                pdf_path = video_to_pdf_with_transcription(temp_path, model_size=model_size, job_folder=job_folder)
                 
                 # Cleanup
                 if os.path.exists(temp_path):
@@ -396,11 +1951,11 @@ def process_video(video, path):
     else:
         raise gr.Error("请上传视频或输入视频路径")
 
-def handle_video_with_transcription(video, path):
+def handle_video_with_transcription(video, path, model_size=None):
     if video:
-        return run_app_with_transcription(video)
+        return run_app_with_transcription(video, model_size=model_size)
     elif path:
-        return run_app_with_transcription(path)
+        return run_app_with_transcription(path, model_size=model_size)
     else:
         raise gr.Error("请上传视频或输入视频路径")
 
@@ -432,7 +1987,8 @@ css = """
 }
 """
 
-if __name__ == "__main__":
+def create_interface(process_fn=process_video, transcription_fn=handle_video_with_transcription):
+    '''Build the web interface, process_fn and transcription_fn handle the two tabs'''
     with gr.Blocks(css=css) as iface:
         gr.Markdown("# 视频转PDF工具")
         
@@ -451,21 +2007,37 @@ if __name__ == "__main__":
                 with gr.Column():
                     video_input_with_transcription = gr.Video(label="上传视频")
                     video_path_with_transcription = gr.Textbox(label="或输入视频路径", placeholder="例如: ./input/video.mp4")
+                    whisper_model_size = gr.Dropdown(choices=WHISPER_MODELS, value=WHISPER_MODEL, label="语音识别模型")
                     convert_btn_with_transcription = gr.Button("开始转换（带字幕）", variant="primary")
                 
             with gr.Row():
                 output_file_with_transcription = gr.File(label="下载PDF（带字幕）")
         
+        # both tabs share one pool of JOB_CONCURRENCY workers
         convert_btn.click(
-            fn=process_video,
+            fn=process_fn,
             inputs=[video_input, video_path],
             outputs=[output_file],
+            concurrency_limit=JOB_CONCURRENCY,
+            concurrency_id="video",
         )
         
         convert_btn_with_transcription.click(
-            fn=handle_video_with_transcription,
-            inputs=[video_input_with_transcription, video_path_with_transcription],
+            fn=transcription_fn,
+            inputs=[video_input_with_transcription, video_path_with_transcription, whisper_model_size],
             outputs=[output_file_with_transcription],
+            concurrency_limit=JOB_CONCURRENCY,
+            concurrency_id="video",
         )
-        
+
+    iface.queue(default_concurrency_limit=JOB_CONCURRENCY, max_size=JOB_QUEUE_SIZE)
+    return iface
+
+
+if __name__ == "__main__":
+    iface = create_interface()
+    warm_whisper_models()
+    start_job_cleanup()
+    if METRICS_PORT:
+        profiler.start_metrics_server(METRICS_PORT, host=METRICS_HOST)
     iface.launch()
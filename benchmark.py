@@ -0,0 +1,209 @@
+'''Benchmarks for the video to pdf pipeline
+
+usage: python benchmark.py frames [video]
+       python benchmark.py detectors [video]
+       python benchmark.py audio [video]
+       python benchmark.py pdf [--pages N] [--width W]
+'''
+import os
+import time
+import argparse
+import resource
+import shutil
+import tempfile
+import multiprocessing
+import tracemalloc
+
+import cv2
+import numpy as np
+
+import app
+import profiler
+
+
+def bench_frames(video_path):
+    '''Compare the decode speed of the seek based, the sequential and the ffmpeg pipe frame samplers,
+    the ffmpeg sampler returns the frames already scaled to MOTION_WIDTH'''
+    vs = cv2.VideoCapture(video_path)
+    fps = vs.get(cv2.CAP_PROP_FPS)
+    total_frames = int(vs.get(cv2.CAP_PROP_FRAME_COUNT))
+    vs.release()
+    duration = total_frames / fps if fps else 0
+    print(f'{video_path}: {total_frames} frames, {fps:.2f} fps, {duration:.1f}s, sampling {app.FRAME_RATE} frames/s')
+
+    samplers = ["seek", "sequential"]
+    if shutil.which(app.FFMPEG_BIN):
+        samplers.append("ffmpeg")
+    else:
+        print(f'{"ffmpeg":>10}: {app.FFMPEG_BIN} not found, skipped')
+    for sampler in samplers:
+        start_time = time.perf_counter()
+        samples = 0
+        for _, _, _ in app.get_frames(video_path, sampler=sampler):
+            samples += 1
+        elapsed = time.perf_counter() - start_time
+
+        # the sequential sampler decodes every frame of the stream, the seek sampler
+        # at least every sampled frame (plus the frames back to the previous keyframe)
+        decoded = total_frames if sampler != "seek" else samples
+        print(f'{sampler:>10}: {samples} samples in {elapsed:.2f}s, '
+              f'{samples / elapsed:.1f} samples/s, >= {decoded / elapsed:.1f} decoded frames/s, '
+              f'{duration / elapsed:.1f}x real-time')
+
+
+def _captures(video_path, detector):
+    '''Run the motion detector over the video, returns the times of the captures that show a new
+    slide (like detect_slides, without the duplicates across the deck), the number of
+    captures before that check and the profile of the run'''
+    captures = []
+    candidates = 0
+    last_signature = None
+    with profiler.profiling(profiler.Profile(detector)) as profile:
+        samples = app._motion_samples(app.get_frames(video_path), app.no_progress, 1, detector=detector)
+        for _, frame_time, _, orig in app._motion_events(samples, detector):
+            candidates += 1
+            signature = app.slide_signature(orig)
+            if last_signature is None or not app.is_same_slide(last_signature, signature):
+                captures.append(frame_time)
+            last_signature = signature
+    return captures, candidates, profile.report()
+
+
+def _matched(reference, captures, tolerance):
+    '''Number of reference capture times with a capture at most tolerance seconds away'''
+    return sum(any(abs(capture - time_) <= tolerance for capture in captures) for time_ in reference)
+
+
+def bench_detectors(video_path, tolerance=2.0):
+    '''Compare the cost per frame and the captured slides of the motion detectors, the slides of
+    MOG2 are the reference: recall is the share of the MOG2 slides that the detector also
+    finds within tolerance seconds, precision the share of its slides that MOG2 finds'''
+    print(f'{video_path}: sampling {app.FRAME_RATE} frames/s, captures matched within {tolerance}s')
+    reference = None
+    for detector in app.MOTION_DETECTORS:
+        captures, candidates, report = _captures(video_path, detector)
+        stages = report["stages"]
+        frames = stages["decode"]["items"]
+        # the detector cost is the frame preparation (resize) and the detector itself, without the decoding
+        wall = stages["resize"]["wall"] + stages[detector]["wall"]
+        cpu = stages["resize"]["cpu"] + stages[detector]["cpu"]
+        line = (f'{detector:>10}: {frames} frames, {wall / frames * 1000:.2f} ms/frame '
+                f'({cpu / frames * 1000:.2f} ms cpu), decode {stages["decode"]["wall"] / frames * 1000:.2f} ms/frame, '
+                f'{candidates} captures, {len(captures)} slides')
+        if reference is None:
+            reference = captures
+        else:
+            recall = _matched(reference, captures, tolerance) / len(reference) if reference else 1.0
+            precision = _matched(captures, reference, tolerance) / len(captures) if captures else 1.0
+            line += f', recall {recall:.0%}, precision {precision:.0%}'
+        print(line)
+        print(f'{"":>12}{" ".join(f"{capture:.1f}" for capture in captures)}')
+
+
+def _audio_wav_path(video_path):
+    '''Previous audio path: moviepy writes a temporary wav that whisper decodes again'''
+    import whisper
+    from moviepy.editor import VideoFileClip
+
+    video = VideoFileClip(video_path)
+    temp_audio = tempfile.mktemp(suffix='.wav')
+    video.audio.write_audiofile(temp_audio, logger=None)
+    audio = whisper.load_audio(temp_audio)
+    os.remove(temp_audio)
+    video.close()
+    return audio
+
+
+def _run_audio_path(name, video_path, queue):
+    start_time = time.perf_counter()
+    audio = _audio_wav_path(video_path) if name == "wav" else app.load_audio(video_path)
+    elapsed = time.perf_counter() - start_time
+
+    # ru_maxrss is in KiB on linux, children covers the ffmpeg processes
+    own_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    child_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+    queue.put((len(audio), elapsed, own_rss, child_rss))
+
+
+def bench_audio(video_path):
+    '''Compare wall-clock time and peak memory of the temporary wav and the ffmpeg pipe audio paths,
+    every path runs in a fresh process so the peak RSS values do not mix'''
+    context = multiprocessing.get_context("spawn")
+    for name in ("wav", "pipe"):
+        queue = context.Queue()
+        proc = context.Process(target=_run_audio_path, args=(name, video_path, queue))
+        proc.start()
+        samples, elapsed, own_rss, child_rss = queue.get()
+        proc.join()
+        print(f'{name:>10}: {samples / app.AUDIO_SAMPLE_RATE:.1f}s of audio in {elapsed:.2f}s, '
+              f'peak RSS {own_rss:.0f} MiB (python) / {child_rss:.0f} MiB (largest child)')
+
+
+def _run_pdf_path(name, png_files, output_pdf_path, queue):
+    tracemalloc.start()
+    start_time = time.perf_counter()
+    if name == "img2pdf":
+        import img2pdf
+        with open(output_pdf_path, "wb") as f:
+            f.write(img2pdf.convert(png_files))
+    else:
+        app.write_pdf(png_files, output_pdf_path)
+    elapsed = time.perf_counter() - start_time
+    queue.put((elapsed, tracemalloc.get_traced_memory()[1] / 1024 / 1024,
+               resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+
+
+def bench_pdf(pages, width):
+    '''Compare the peak memory of building a pdf with img2pdf and with the streaming pdf writer'''
+    height = width * 9 // 16
+    with tempfile.TemporaryDirectory() as folder:
+        # synthetic slides: a gradient background with some text, different on every page
+        png_files = []
+        gradient = np.linspace(0, 255, width, dtype=np.uint8)
+        for i in range(pages):
+            slide = np.dstack([np.tile(gradient, (height, 1))] * 3)
+            cv2.putText(slide, f"slide {i}", (width // 10, height // 2), cv2.FONT_HERSHEY_SIMPLEX, width / 400, (20, 20, 20), 8)
+            png_files.append(os.path.join(folder, f"{i:03}.png"))
+            cv2.imwrite(png_files[-1], slide)
+        size = sum(os.path.getsize(f) for f in png_files) / 1024 / 1024
+        print(f'{pages} pages of {width}x{height}, {size:.1f} MiB of png')
+
+        context = multiprocessing.get_context("spawn")
+        for name in ("img2pdf", "streaming"):
+            queue = context.Queue()
+            output_pdf_path = os.path.join(folder, f"{name}.pdf")
+            proc = context.Process(target=_run_pdf_path, args=(name, png_files, output_pdf_path, queue))
+            proc.start()
+            elapsed, peak_traced, peak_rss = queue.get()
+            proc.join()
+            print(f'{name:>10}: {elapsed:.2f}s, peak python allocations {peak_traced:.1f} MiB, peak RSS {peak_rss:.0f} MiB, '
+                  f'pdf {os.path.getsize(output_pdf_path) / 1024 / 1024:.1f} MiB')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    frames = sub.add_parser("frames", help="decode frames/s of the frame samplers")
+    frames.add_argument("video", nargs="?", default="./input/test01.mp4")
+
+    detectors = sub.add_parser("detectors", help="cost per frame and captures of the motion detectors")
+    detectors.add_argument("video", nargs="?", default="./input/test01.mp4")
+    detectors.add_argument("--tolerance", type=float, default=2.0, help="seconds between two matching captures")
+
+    audio = sub.add_parser("audio", help="wall-clock time and peak memory of the audio extraction")
+    audio.add_argument("video", nargs="?", default="./input/test01.mp4")
+
+    pdf = sub.add_parser("pdf", help="peak memory of the pdf assembly")
+    pdf.add_argument("--pages", type=int, default=100)
+    pdf.add_argument("--width", type=int, default=3840)
+
+    args = parser.parse_args()
+    if args.command == "frames":
+        bench_frames(args.video)
+    elif args.command == "detectors":
+        bench_detectors(args.video, args.tolerance)
+    elif args.command == "audio":
+        bench_audio(args.video)
+    elif args.command == "pdf":
+        bench_pdf(args.pages, args.width)
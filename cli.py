@@ -0,0 +1,247 @@
+'''Convert videos to pdf from the command line, several videos are processed in parallel
+
+usage: python cli.py ./archive/                      every video in a directory
+       python cli.py "./archive/**/*.mp4" --workers 4 --progress jsonl
+       python cli.py lecture.mp4 --transcribe --model small --output ./pdf --summary summary.json
+
+Every video is processed in its own job folder (see app.new_job_folder). With --output
+the pdfs are also copied to one folder, below it every pdf keeps the folder of its video
+relative to the common folder of all videos (week1/lecture.mp4 -> week1/lecture.pdf).
+Videos that would still get the same pdf keep their extension in the name
+(lecture.mp4.pdf and lecture.mkv.pdf). The summary lists the result and the time spent
+in every stage of every video (from the profile.json of the job, see profiler.py),
+the exit code is 1 when a video failed.
+'''
+import os
+import re
+import sys
+import glob
+import json
+import time
+import shutil
+import argparse
+import threading
+import multiprocessing
+from contextlib import redirect_stdout
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import app
+from throttle import throttled, no_progress
+
+VIDEO_EXTENSIONS = (".mp4", ".mkv", ".avi", ".mov", ".webm", ".flv", ".m4v", ".ts")
+PROGRESS_SECONDS = 0.2           # a video reports its progress at most this often
+
+
+def find_videos(inputs):
+    '''Expand the video files, directories and glob patterns of inputs to a sorted list of videos'''
+    videos = []
+    for pattern in inputs:
+        if os.path.isdir(pattern):
+            paths = glob.glob(os.path.join(pattern, "**", "*"), recursive=True)
+        else:
+            paths = glob.glob(pattern, recursive=True) or [pattern]
+        videos += [path for path in paths if os.path.isfile(path) and path.lower().endswith(VIDEO_EXTENSIONS)]
+    return sorted(set(videos))
+
+
+def output_paths(videos, output_folder):
+    '''Path of the pdf of every video in output_folder, see the module docstring'''
+    folders = [os.path.dirname(os.path.abspath(video)) for video in videos]
+    common = os.path.commonpath(folders) if folders else ""
+    paths = {}
+    for video, folder in zip(videos, folders):
+        paths[video] = os.path.join(output_folder, os.path.relpath(folder, common), f"{app.safe_video_name(video)}.pdf")
+    counts = {}
+    for path in paths.values():
+        counts[path] = counts.get(path, 0) + 1
+    for video, path in paths.items():
+        if counts[path] > 1:
+            extension = os.path.splitext(video)[1].lstrip(".")
+            paths[video] = f"{os.path.splitext(path)[0]}.{extension}.pdf"
+    return {video: os.path.normpath(path) for video, path in paths.items()}
+
+
+def stage_name(desc):
+    '''Stage of a progress description: the description without its counters,
+    "处理视频帧 12/300" is the stage "处理视频帧"'''
+    return re.sub(r"[\d/%.:()（）]+", "", desc or "").strip() or "处理中"
+
+
+def progress_events(video_path, events):
+    '''Progress callback that forwards the progress to events, rate limited
+    to one update every PROGRESS_SECONDS (see throttle.py)'''
+    if events is None:
+        return no_progress
+
+    def report(fraction, desc=None, **kwargs):
+        events.put({"event": "progress", "video": video_path, "progress": round(float(fraction), 4), "desc": desc})
+    return throttled(report, min_interval=PROGRESS_SECONDS)
+
+
+def process_video(video_path, transcribe=False, model_size=None, output_path=None, events=None):
+    '''Process worker: convert one video, the pdf is copied to output_path when it is given.
+    Returns the summary of the video'''
+    if events is not None:
+        events.put({"event": "start", "video": video_path})
+    progress = progress_events(video_path, events)
+    start_time = time.perf_counter()
+    summary = {"video": video_path, "status": "done", "pdf": None, "error": None}
+    # the log of the pipeline goes to stderr, stdout is kept for the reports
+    with redirect_stdout(sys.stderr):
+        job_folder = app.new_job_folder()
+    try:
+        with redirect_stdout(sys.stderr):
+            if transcribe:
+                pdf_path = app.run_app_with_transcription(video_path, progress, model_size, job_folder)
+            else:
+                pdf_path = app.run_app(video_path, progress, job_folder)
+        if output_path:
+            os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+            shutil.copyfile(pdf_path, output_path)
+            pdf_path = output_path
+        summary["pdf"] = pdf_path
+    except Exception as e:
+        summary["status"] = "failed"
+        summary["error"] = str(e)
+    summary["seconds"] = round(time.perf_counter() - start_time, 3)
+    summary["profile"] = None
+    profile_path = os.path.join(job_folder, "profile.json")
+    if os.path.isfile(profile_path):
+        with open(profile_path, encoding="utf-8") as f:
+            summary["profile"] = json.load(f)
+    if events is not None:
+        events.put(dict(summary, event="finish"))
+    return summary
+
+
+class NoProgress:
+    '''Progress reporter that reports nothing'''
+
+    def __init__(self, total):
+        self.total = total
+
+    def __call__(self, event):
+        pass
+
+    def close(self):
+        pass
+
+
+class JsonLinesProgress(NoProgress):
+    '''Progress reporter that writes every event as one line of json to stdout'''
+
+    def __call__(self, event):
+        print(json.dumps(dict(event, time=round(time.time(), 3)), ensure_ascii=False), flush=True)
+
+
+class TtyProgress(NoProgress):
+    '''Progress reporter that keeps one status line with all running videos up to date'''
+
+    def __init__(self, total):
+        super().__init__(total)
+        self.running = {}
+        self.finished = 0
+
+    def __call__(self, event):
+        # videos of different folders can have the same name
+        video = event["video"]
+        if event["event"] == "start":
+            self.running[video] = (0.0, "")
+        elif event["event"] == "progress":
+            self.running[video] = (event["progress"], stage_name(event["desc"]))
+        elif event["event"] == "finish":
+            self.running.pop(video, None)
+            self.finished += 1
+            result = event["pdf"] if event["status"] == "done" else f'失败: {event["error"]}'
+            self._write(f'[{self.finished}/{self.total}] {video} ({event["seconds"]:.1f}s) -> {result}\n')
+        running = " | ".join(f"{os.path.basename(video)} {fraction:.0%} {stage}"
+                             for video, (fraction, stage) in self.running.items())
+        self._write(f"[{self.finished}/{self.total}] {running}", status=True)
+
+    def _write(self, text, status=False):
+        width = shutil.get_terminal_size().columns
+        line = text[:width - 1] if status else text
+        sys.stderr.write("\r\033[K" + line)
+        sys.stderr.flush()
+
+    def close(self):
+        sys.stderr.write("\r\033[K")
+        sys.stderr.flush()
+
+
+PROGRESS_REPORTERS = {"tty": TtyProgress, "jsonl": JsonLinesProgress, "none": NoProgress}
+
+
+def _forward_events(events, reporter):
+    for event in iter(events.get, None):
+        reporter(event)
+
+
+def run_batch(videos, workers=1, transcribe=False, model_size=None, output_folder=None, progress="tty"):
+    '''Convert videos in a pool of worker processes, returns the summary of every video in input order'''
+    reporter = PROGRESS_REPORTERS[progress](len(videos))
+    outputs = output_paths(videos, output_folder) if output_folder else {}
+    context = multiprocessing.get_context("spawn")
+    with context.Manager() as manager:
+        events = manager.Queue()
+        forwarder = threading.Thread(target=_forward_events, args=(events, reporter), daemon=True)
+        forwarder.start()
+
+        summaries = {}
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+            futures = {pool.submit(process_video, video, transcribe, model_size, outputs.get(video), events): video
+                       for video in videos}
+            for future in as_completed(futures):
+                summaries[futures[future]] = future.result()
+
+        events.put(None)
+        forwarder.join()
+    reporter.close()
+    return [summaries[video] for video in videos]
+
+
+def print_summary(summaries, elapsed):
+    '''Print the result and the stage timings of every video, then the totals per stage'''
+    totals = {}
+    for summary in summaries:
+        result = summary["pdf"] if summary["status"] == "done" else f'失败: {summary["error"]}'
+        print(f'{summary["video"]}: {summary["seconds"]:.1f}s -> {result}')
+        profile = summary["profile"]
+        if profile is None:
+            continue
+        print(f'    {profile["frames"]} frames, {profile["frames_per_second"]} frames/s, peak RSS {profile["peak_rss_mb"]} MiB')
+        for stage, entry in profile["stages"].items():
+            print(f'    {stage:<18} {entry["wall"]:8.2f}s wall {entry["cpu"]:8.2f}s cpu')
+            totals[stage] = totals.get(stage, 0.0) + entry["wall"]
+
+    failed = sum(summary["status"] != "done" for summary in summaries)
+    print(f'{len(summaries) - failed}/{len(summaries)} videos converted in {elapsed:.1f}s')
+    for stage, seconds in sorted(totals.items(), key=lambda item: -item[1]):
+        print(f'    {stage:<18} {seconds:8.2f}s')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("inputs", nargs="+", help="video files, directories or glob patterns")
+    parser.add_argument("--workers", type=int, default=1, help="videos processed in parallel")
+    parser.add_argument("--transcribe", action="store_true", help="add the transcription below the slides")
+    parser.add_argument("--model", choices=app.WHISPER_MODELS, default=None, help="whisper model size")
+    parser.add_argument("--output", default=None, help="folder the pdfs are copied to")
+    parser.add_argument("--progress", choices=list(PROGRESS_REPORTERS), default="tty" if sys.stderr.isatty() else "none")
+    parser.add_argument("--summary", default=None, help="write the summary as json to this file")
+    args = parser.parse_args()
+
+    videos = find_videos(args.inputs)
+    if not videos:
+        parser.error("no video files found")
+
+    start_time = time.perf_counter()
+    summaries = run_batch(videos, args.workers, args.transcribe, args.model, args.output, args.progress)
+    elapsed = time.perf_counter() - start_time
+
+    if args.progress != "jsonl":
+        print_summary(summaries, elapsed)
+    if args.summary:
+        with open(args.summary, "w", encoding="utf-8") as f:
+            json.dump({"seconds": round(elapsed, 3), "videos": summaries}, f, ensure_ascii=False, indent=2)
+    sys.exit(1 if any(summary["status"] != "done" for summary in summaries) else 0)
@@ -0,0 +1,474 @@
+'''Background jobs: videos are processed by a pool of worker processes that take their
+work from a local queue, so a long video does not tie up a web request and the result
+survives a dropped browser connection.
+
+The queue is a SQLite database, one row per job. Every job works in its own job folder
+(see app.new_job_folder), the id of the job is the name of the folder. The web server
+offers the endpoints
+
+    POST /jobs                  submit a video (upload "file" or server side "path",
+                                "transcribe" and "model_size" form fields)
+    GET  /jobs/<id>             status and progress of a job
+    GET  /jobs/<id>/result      the pdf, with Range requests for resumable downloads
+    GET  /jobs/<id>/profile     the stage timings of a job as json
+    GET  /metrics               the stage timings of all workers in the Prometheus text format
+
+and the Gradio interface at /, whose requests are processed as background jobs too.
+
+usage: python jobs.py [--workers N] [--host HOST] [--port PORT]
+'''
+import os
+import re
+import json
+import time
+import shutil
+import sqlite3
+import argparse
+import threading
+import multiprocessing
+from contextlib import closing
+
+import gradio as gr
+
+import app
+import profiler
+from throttle import throttled
+
+JOBS_DB = os.path.join(app.JOBS_DIR, "jobs.sqlite3")
+# every worker writes its totals to <pid>.json after a job, outside of JOBS_DIR whose folders expire
+METRICS_DIR = os.path.join(app.OUTPUT_SLIDES_DIR, "metrics")
+JOB_WORKERS = 2                  # worker processes, every worker processes one video at a time
+JOB_POLL_SECONDS = 1.0           # idle workers and waiting web requests check the queue this often
+JOB_PROGRESS_SECONDS = 1.0       # a job writes its progress to the queue at most this often
+JOB_MAX_ATTEMPTS = 2             # a job whose worker died this many times (out of memory, crash in ffmpeg or cv2) fails
+JOB_WATCH_SECONDS = 5.0          # the web server checks this often that the worker processes are alive
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+RANGE_PATTERN = re.compile(r"bytes=(\d*)-(\d*)$")
+
+
+class JobQueue:
+    '''Queue of video jobs stored in a SQLite database, safe to use from several processes'''
+
+    def __init__(self, path=JOBS_DB):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with closing(self._connect()) as db:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("""CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                video_path TEXT NOT NULL,
+                transcribe INTEGER NOT NULL DEFAULT 0,
+                model_size TEXT,
+                status TEXT NOT NULL DEFAULT 'queued',
+                progress REAL NOT NULL DEFAULT 0,
+                message TEXT,
+                result TEXT,
+                error TEXT,
+                worker INTEGER,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                created REAL NOT NULL,
+                started REAL,
+                finished REAL)""")
+            # databases of an earlier version
+            columns = [row["name"] for row in db.execute("PRAGMA table_info(jobs)")]
+            if "attempts" not in columns:
+                db.execute("ALTER TABLE jobs ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0")
+
+    def _connect(self):
+        db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        db.row_factory = sqlite3.Row
+        return db
+
+    def submit(self, video_path, transcribe=False, model_size=None, job_folder=None):
+        '''Queue a video, returns the job id. The job works in job_folder,
+        a new job folder is created when it is not given'''
+        job_folder = job_folder or app.new_job_folder()
+        job_id = os.path.basename(job_folder)
+        with closing(self._connect()) as db:
+            db.execute("INSERT INTO jobs (id, video_path, transcribe, model_size, created) VALUES (?, ?, ?, ?, ?)",
+                       (job_id, video_path, int(transcribe), model_size, time.time()))
+        return job_id
+
+    def claim(self):
+        '''Take the oldest queued job for the calling process, returns the job or None'''
+        db = self._connect()
+        try:
+            db.execute("BEGIN IMMEDIATE")
+            row = db.execute("SELECT * FROM jobs WHERE status = 'queued' ORDER BY created LIMIT 1").fetchone()
+            if row is None:
+                db.execute("COMMIT")
+                return None
+            db.execute("UPDATE jobs SET status = 'running', worker = ?, started = ?, message = NULL, "
+                       "attempts = attempts + 1 WHERE id = ?", (os.getpid(), time.time(), row["id"]))
+            db.execute("COMMIT")
+            return dict(row, status="running", attempts=row["attempts"] + 1)
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+        finally:
+            db.close()
+
+    def update(self, job_id, **fields):
+        columns = ", ".join(f"{name} = ?" for name in fields)
+        with closing(self._connect()) as db:
+            db.execute(f"UPDATE jobs SET {columns} WHERE id = ?", (*fields.values(), job_id))
+
+    def get(self, job_id):
+        '''The job as a dict, or None for an unknown job id'''
+        with closing(self._connect()) as db:
+            row = db.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return dict(row) if row is not None else None
+
+    def recover(self, max_attempts=None):
+        '''Queue the running jobs of workers that died again, a job that was already tried
+        max_attempts times (defaults to JOB_MAX_ATTEMPTS) fails instead. Returns the number of
+        recovered jobs'''
+        max_attempts = max_attempts or JOB_MAX_ATTEMPTS
+        recovered = 0
+        with closing(self._connect()) as db:
+            for row in db.execute("SELECT id, worker, attempts FROM jobs WHERE status = 'running'").fetchall():
+                if _process_alive(row["worker"]):
+                    continue
+                if row["attempts"] >= max_attempts:
+                    print(f'job {row["id"]} failed: its worker stopped {row["attempts"]} times')
+                    db.execute("UPDATE jobs SET status = 'failed', worker = NULL, error = ?, finished = ? WHERE id = ?",
+                               (f"处理进程意外退出 {row['attempts']} 次", time.time(), row["id"]))
+                else:
+                    db.execute("UPDATE jobs SET status = 'queued', worker = NULL, progress = 0 WHERE id = ?", (row["id"],))
+                recovered += 1
+        if recovered:
+            print(f'recovered {recovered} jobs of stopped workers')
+        return recovered
+
+    def expire(self, ttl=None):
+        '''Forget the finished jobs older than ttl seconds (defaults to app.JOB_TTL_SECONDS),
+        their job folders are removed by app.cleanup_jobs'''
+        ttl = app.JOB_TTL_SECONDS if ttl is None else ttl
+        with closing(self._connect()) as db:
+            db.execute("DELETE FROM jobs WHERE status IN ('done', 'failed') AND finished < ?", (time.time() - ttl,))
+
+
+def _process_alive(pid):
+    if not pid:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def job_progress(queue, job_id):
+    '''Progress callback of a job, it has the signature of gr.Progress and writes
+    the progress to the queue, rate limited to one update every JOB_PROGRESS_SECONDS
+    (see throttle.py)'''
+    def report(fraction, desc=None, **kwargs):
+        queue.update(job_id, progress=float(fraction), message=desc)
+    return throttled(report, min_interval=JOB_PROGRESS_SECONDS)
+
+
+def run_job(queue, job):
+    '''Process one claimed job and record its result or error in the queue'''
+    job_folder = os.path.join(app.JOBS_DIR, job["id"])
+    progress = job_progress(queue, job["id"])
+    print(f'job {job["id"]}: processing {job["video_path"]}')
+    try:
+        if job["transcribe"]:
+            result = app.run_app_with_transcription(job["video_path"], progress, job["model_size"], job_folder)
+        else:
+            result = app.run_app(job["video_path"], progress, job_folder)
+    except Exception as e:
+        print(f'job {job["id"]} failed: {str(e)}')
+        queue.update(job["id"], status="failed", error=str(e), finished=time.time())
+        return
+    queue.update(job["id"], status="done", progress=1.0, message="处理完成！", result=result, finished=time.time())
+
+
+def write_metrics():
+    '''Write the totals of this worker for the /metrics endpoint of the web server'''
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    path = os.path.join(METRICS_DIR, f"{os.getpid()}.json")
+    with open(path + ".tmp", "w") as f:
+        json.dump(profiler.snapshot(), f)
+    os.replace(path + ".tmp", path)
+
+
+def read_metrics():
+    '''Totals of the web server and of all workers'''
+    snapshots = [profiler.snapshot()]
+    if os.path.isdir(METRICS_DIR):
+        for name in os.listdir(METRICS_DIR):
+            if name.endswith(".json"):
+                try:
+                    with open(os.path.join(METRICS_DIR, name)) as f:
+                        snapshots.append(json.load(f))
+                except (OSError, ValueError):
+                    pass
+    return profiler.merge_snapshots(snapshots)
+
+
+def worker_loop(db_path=JOBS_DB):
+    '''Worker process: process the queued jobs one after the other'''
+    queue = JobQueue(db_path)
+    app.warm_whisper_models()
+    while True:
+        job = queue.claim()
+        if job is None:
+            time.sleep(JOB_POLL_SECONDS)
+            continue
+        run_job(queue, job)
+        write_metrics()
+
+
+def _start_worker(db_path, i):
+    process = multiprocessing.get_context("spawn").Process(target=worker_loop, args=(db_path,), name=f"job-worker-{i}")
+    process.start()
+    return process
+
+
+def start_workers(workers=None, db_path=JOBS_DB):
+    '''Start the worker processes (defaults to JOB_WORKERS), the running jobs of
+    workers from an earlier run are queued again first. The workers are not daemon processes
+    because the detection and the transcription start process pools of their own'''
+    JobQueue(db_path).recover()
+    # the totals of the workers of an earlier run start over
+    shutil.rmtree(METRICS_DIR, ignore_errors=True)
+    processes = [_start_worker(db_path, i) for i in range(workers or JOB_WORKERS)]
+    print(f'started {len(processes)} job workers')
+    return processes
+
+
+def restart_dead_workers(processes, db_path=JOBS_DB):
+    '''Replace the worker processes that died (in place in processes) and queue their jobs
+    again, returns the number of restarted workers'''
+    restarted = 0
+    for i, process in enumerate(processes):
+        if process.is_alive():
+            continue
+        print(f'job worker {process.name} stopped with exit code {process.exitcode}, restarting it')
+        processes[i] = _start_worker(db_path, i)
+        restarted += 1
+    if restarted:
+        JobQueue(db_path).recover()
+    return restarted
+
+
+def start_watchdog(processes, db_path=JOBS_DB, interval=None):
+    '''Restart the worker processes that died every interval seconds (defaults to JOB_WATCH_SECONDS)'''
+    interval = interval or JOB_WATCH_SECONDS
+
+    def run():
+        while True:
+            time.sleep(interval)
+            restart_dead_workers(processes, db_path)
+
+    thread = threading.Thread(target=run, name="job-watchdog", daemon=True)
+    thread.start()
+    return thread
+
+
+def start_cleanup(queue, interval=None):
+    '''Remove the expired job folders and forget the expired jobs every interval seconds'''
+    interval = interval or app.JOB_CLEANUP_INTERVAL
+
+    def run():
+        while True:
+            queue.expire()
+            app.cleanup_jobs()
+            time.sleep(interval)
+
+    thread = threading.Thread(target=run, name="job-cleanup", daemon=True)
+    thread.start()
+    return thread
+
+
+def wait_for_job(queue, job_id, progress):
+    '''Report the progress of a job until it is finished, returns the pdf path.
+    The job goes on in the workers when the waiting request is cancelled. A job whose
+    worker died is queued again or fails, see JobQueue.recover'''
+    while True:
+        job = queue.get(job_id)
+        if job is not None and job["status"] == "running" and not _process_alive(job["worker"]):
+            queue.recover()
+            job = queue.get(job_id)
+        if job is None:
+            raise gr.Error(f"任务 {job_id} 不存在")
+        if job["status"] == "done":
+            return job["result"]
+        if job["status"] == "failed":
+            raise gr.Error(f"处理失败: {job['error']}")
+        waiting = "排队中..." if job["status"] == "queued" else job["message"] or "处理中..."
+        progress(job["progress"], desc=f"任务 {job_id}: {waiting}")
+        time.sleep(JOB_POLL_SECONDS)
+
+
+def interface_handlers(queue):
+    '''Handlers of the two tabs of app.create_interface that submit background jobs'''
+    def process_video(video, path, progress=gr.Progress()):
+        if not (video or path):
+            raise gr.Error("请上传视频或输入视频路径")
+        return wait_for_job(queue, submit_video(queue, video or path), progress)
+
+    def process_video_with_transcription(video, path, model_size=None, progress=gr.Progress()):
+        if not (video or path):
+            raise gr.Error("请上传视频或输入视频路径")
+        job_id = submit_video(queue, video or path, transcribe=True, model_size=model_size)
+        return wait_for_job(queue, job_id, progress)
+
+    return process_video, process_video_with_transcription
+
+
+def submit_video(queue, video_path, transcribe=False, model_size=None):
+    '''Queue a video of the web interface, uploads are copied to the job folder
+    because the web server removes its temporary files'''
+    if not os.path.isfile(video_path):
+        raise gr.Error(f"找不到视频文件: {video_path}")
+    job_folder = app.new_job_folder()
+    job_video_path = os.path.join(job_folder, os.path.basename(video_path))
+    shutil.copyfile(video_path, job_video_path)
+    return queue.submit(job_video_path, transcribe, model_size, job_folder)
+
+
+def parse_range(header, size):
+    '''(start, end) of a "bytes=start-end" Range header, end included.
+    Returns None when the header is missing or not satisfiable'''
+    match = RANGE_PATTERN.match(header.strip()) if header else None
+    if match is None:
+        return None
+    (start, end) = match.groups()
+    if not start:
+        # suffix range: the last <end> bytes
+        if not end:
+            return None
+        start = max(size - int(end), 0)
+        end = size - 1
+    else:
+        start = int(start)
+        end = min(int(end), size - 1) if end else size - 1
+    if start > end or start >= size:
+        return None
+    return start, end
+
+
+def _read_file(path, start, end):
+    with open(path, "rb") as f:
+        f.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            data = f.read(min(DOWNLOAD_CHUNK_SIZE, remaining))
+            if not data:
+                break
+            remaining -= len(data)
+            yield data
+
+
+def create_api(queue):
+    '''FastAPI application with the job endpoints'''
+    from fastapi import FastAPI, File, Form, HTTPException, Request, UploadFile
+    from fastapi.responses import FileResponse, PlainTextResponse, Response, StreamingResponse
+
+    api = FastAPI()
+
+    @api.post("/jobs")
+    def submit(file: UploadFile = File(None), path: str = Form(None),
+               transcribe: bool = Form(False), model_size: str = Form(None)):
+        if model_size is not None and model_size not in app.WHISPER_MODELS:
+            raise HTTPException(400, f"unknown model size {model_size}")
+        if file is not None:
+            job_folder = app.new_job_folder()
+            video_path = os.path.join(job_folder, os.path.basename(file.filename or "video.mp4"))
+            with open(video_path, "wb") as f:
+                shutil.copyfileobj(file.file, f, DOWNLOAD_CHUNK_SIZE)
+            job_id = queue.submit(video_path, transcribe, model_size, job_folder)
+        elif path:
+            if not os.path.isfile(path):
+                raise HTTPException(400, f"video not found: {path}")
+            job_id = queue.submit(path, transcribe, model_size)
+        else:
+            raise HTTPException(400, "upload a file or give a path")
+        return {"id": job_id, "status": "queued"}
+
+    @api.get("/jobs/{job_id}")
+    def status(job_id: str):
+        job = queue.get(job_id)
+        if job is None:
+            raise HTTPException(404, "unknown job")
+        job.pop("worker")
+        job["result_url"] = f"/jobs/{job_id}/result" if job["status"] == "done" else None
+        return job
+
+    @api.get("/jobs/{job_id}/profile")
+    def profile(job_id: str):
+        if queue.get(job_id) is None:
+            raise HTTPException(404, "unknown job")
+        path = os.path.join(app.JOBS_DIR, job_id, "profile.json")
+        if not os.path.isfile(path):
+            raise HTTPException(409, "the job has not finished")
+        return FileResponse(path, media_type="application/json")
+
+    @api.get("/metrics")
+    def metrics():
+        return PlainTextResponse(profiler.prometheus_text(read_metrics()), media_type="text/plain; version=0.0.4")
+
+    @api.get("/jobs/{job_id}/result")
+    def result(job_id: str, request: Request):
+        job = queue.get(job_id)
+        if job is None:
+            raise HTTPException(404, "unknown job")
+        if job["status"] != "done":
+            raise HTTPException(409, f"job is {job['status']}")
+        if not job["result"] or not os.path.isfile(job["result"]):
+            raise HTTPException(410, "the result has expired")
+
+        path = job["result"]
+        size = os.path.getsize(path)
+        headers = {
+            "Accept-Ranges": "bytes",
+            "ETag": f'"{job_id}-{size}"',
+            "Content-Disposition": f'attachment; filename="{os.path.basename(path)}"',
+        }
+        range_header = request.headers.get("range")
+        # a download is only resumed when the client still has the same file
+        if_range = request.headers.get("if-range")
+        if range_header and (if_range is None or if_range == headers["ETag"]):
+            byte_range = parse_range(range_header, size)
+            if byte_range is None:
+                return Response(status_code=416, headers={"Content-Range": f"bytes */{size}"})
+            (start, end) = byte_range
+            headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+            headers["Content-Length"] = str(end - start + 1)
+            return StreamingResponse(_read_file(path, start, end), status_code=206,
+                                     media_type="application/pdf", headers=headers)
+
+        headers["Content-Length"] = str(size)
+        return StreamingResponse(_read_file(path, 0, size - 1), media_type="application/pdf", headers=headers)
+
+    return api
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, default=JOB_WORKERS)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=7860)
+    args = parser.parse_args()
+
+    import uvicorn
+
+    queue = JobQueue()
+    processes = start_workers(args.workers)
+    start_watchdog(processes)
+    start_cleanup(queue)
+
+    api = create_api(queue)
+    (process_fn, transcription_fn) = interface_handlers(queue)
+    iface = app.create_interface(process_fn, transcription_fn)
+    api = gr.mount_gradio_app(api, iface, path="/")
+    try:
+        uvicorn.run(api, host=args.host, port=args.port)
+    finally:
+        for process in processes:
+            process.terminate()
@@ -1,53 +1,156 @@
+'''Client of the OCR HTTP API (Umi-OCR compatible): an image is posted as {"base64": ...}
+to /api/ocr and the response has one {"text", "score", "box", "end"} entry per text line.
+
+The images are sent in batches of OCR_BATCH_SIZE over one pooled async HTTP client,
+at most OCR_CONCURRENCY requests are in flight. Failed requests (connection errors,
+HTTP 429 and 5xx) are retried with exponential backoff. Results are cached on disk by
+the sha256 of the image, a slide that was recognized once is never sent again.
+
+usage: python ocrapi.py [image folder]     print the text of every image of the folder
+'''
 import os
-import base64
-import requests
+import sys
 import json
+import base64
+import random
+import asyncio
+import hashlib
+
+import httpx
 
 # OCR API的URL
 ocr_api_url = "http://127.0.0.1:1224/api/ocr"
 
-# 图像文件夹的路径
-image_folder_path = "output/test01"
-
-# 遍历文件夹中的所有文件
-for filename in os.listdir(image_folder_path):
-    # 检查文件是否是图像
-    if filename.lower().endswith(('.png', '.jpg', '.jpeg', '.bmp', '.gif', '.tiff')):
-        # 构建文件的完整路径
-        file_path = os.path.join(image_folder_path, filename)
-        
-        # 读取图像文件并转换为Base64编码
-        with open(file_path, "rb") as image_file:
-            encoded_string = base64.b64encode(image_file.read()).decode('utf-8')
-        
-        # 构建请求数据
-        data = {
-            "base64": encoded_string,
-          
-        }
-        headers = {"Content-Type": "application/json"}
-        data_str = json.dumps(data)
-        
-        # 发送POST请求
-        response = requests.post(ocr_api_url, data=data_str, headers=headers)
-        
-        # 检查响应状态
-        if response.status_code == 200:
-            # 解析响应内容
-            res_dict = json.loads(response.text)
-            
-            # 检查返回的数据结构
-            if "data" in res_dict and isinstance(res_dict["data"], list):
-                # 遍历每一行的文本
-                for line in res_dict["data"]:
-                    text = line.get("text", "")
-                    score = line.get("score", 0)
-                    end = line.get("end", "")
-                    print(f"文本: {text}")
-                    # 如果不是行尾，输出换行符
-                    if end != "\n":
-                        print()
-            else:
-                print("没有检测到文本行。")
-        else:
-            print(f"请求失败，状态码：{response.status_code}, 文件：{filename}")
\ No newline at end of file
+OCR_CONCURRENCY = 4              # requests in flight at the same time
+OCR_BATCH_SIZE = 16              # images sent together, the progress is reported after every batch
+OCR_RETRIES = 3                  # retries of a failed request
+OCR_BACKOFF = 0.5                # seconds before the first retry, doubled for every further retry
+OCR_TIMEOUT = 60                 # seconds for one request
+OCR_CACHE_DIR = "./cache/ocr"    # recognized text by image hash (None = no cache)
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.gif', '.tiff')
+
+
+class OcrError(Exception):
+    pass
+
+
+class _Retry(Exception):
+    pass
+
+
+def image_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def _cache_path(digest):
+    return os.path.join(OCR_CACHE_DIR, digest[:2], f"{digest}.json")
+
+
+def cached_lines(digest):
+    '''The cached text lines of an image, None when the image was not recognized before'''
+    if not OCR_CACHE_DIR:
+        return None
+    try:
+        with open(_cache_path(digest), encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def cache_lines(digest, lines):
+    if not OCR_CACHE_DIR:
+        return
+    path = _cache_path(digest)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(lines, f, ensure_ascii=False)
+    os.replace(path + ".tmp", path)
+
+
+def parse_response(res_dict):
+    '''The {"text", "score", "box"} text lines of an API response'''
+    # 检查返回的数据结构, code 101 means that the image has no text
+    if res_dict.get("code") == 101:
+        return []
+    if "data" not in res_dict or not isinstance(res_dict["data"], list):
+        raise OcrError(f"unexpected response: {str(res_dict)[:200]}")
+    return [{"text": line.get("text", ""), "score": line.get("score", 0), "box": line.get("box")}
+            for line in res_dict["data"]]
+
+
+async def _recognize(client, semaphore, data, url):
+    '''Recognize one image, retried with exponential backoff'''
+    payload = {"base64": base64.b64encode(data).decode('utf-8')}
+    for attempt in range(OCR_RETRIES + 1):
+        try:
+            async with semaphore:
+                response = await client.post(url, json=payload)
+            if response.status_code == 429 or response.status_code >= 500:
+                raise _Retry(f"状态码 {response.status_code}")
+            if response.status_code != 200:
+                raise OcrError(f"请求失败，状态码：{response.status_code}")
+            return parse_response(response.json())
+        except (httpx.TransportError, _Retry) as e:
+            if attempt == OCR_RETRIES:
+                raise OcrError(f"请求失败: {e!r}")
+            # jitter, so the retries of one batch do not arrive at the same time
+            await asyncio.sleep(OCR_BACKOFF * 2 ** attempt * (1 + random.random() / 2))
+
+
+async def recognize_images_async(images, url=None, progress=None):
+    '''Recognize images (bytes), returns the text lines of every image. An image whose
+    requests failed has None instead of its lines, it is not cached.
+    progress(done, total) is called after every batch'''
+    url = url or ocr_api_url
+    results = [None] * len(images)
+    todo = []
+    for i, data in enumerate(images):
+        digest = image_hash(data)
+        results[i] = cached_lines(digest)
+        if results[i] is None:
+            todo.append((i, digest, data))
+    if not todo:
+        return results
+
+    limits = httpx.Limits(max_connections=OCR_CONCURRENCY, max_keepalive_connections=OCR_CONCURRENCY)
+    semaphore = asyncio.Semaphore(OCR_CONCURRENCY)
+    async with httpx.AsyncClient(limits=limits, timeout=OCR_TIMEOUT) as client:
+        for start in range(0, len(todo), OCR_BATCH_SIZE):
+            batch = todo[start:start + OCR_BATCH_SIZE]
+            answers = await asyncio.gather(*(_recognize(client, semaphore, data, url) for _, _, data in batch),
+                                           return_exceptions=True)
+            for (i, digest, _), lines in zip(batch, answers):
+                if isinstance(lines, Exception):
+                    print(f"OCR error: {str(lines)}")
+                    continue
+                results[i] = lines
+                cache_lines(digest, lines)
+            if progress is not None:
+                progress(min(start + OCR_BATCH_SIZE, len(todo)), len(todo))
+    return results
+
+
+def recognize_images(images, url=None, progress=None):
+    '''Blocking version of recognize_images_async, for code that does not run an event loop'''
+    return asyncio.run(recognize_images_async(images, url, progress))
+
+
+if __name__ == "__main__":
+    # 图像文件夹的路径
+    image_folder_path = sys.argv[1] if len(sys.argv) > 1 else "output/test01"
+
+    filenames = sorted(filename for filename in os.listdir(image_folder_path)
+                       if filename.lower().endswith(IMAGE_EXTENSIONS))
+    images = []
+    for filename in filenames:
+        with open(os.path.join(image_folder_path, filename), "rb") as image_file:
+            images.append(image_file.read())
+
+    for filename, lines in zip(filenames, recognize_images(images)):
+        if lines is None:
+            print(f"请求失败，文件：{filename}")
+        elif not lines:
+            print("没有检测到文本行。")
+        for line in lines or []:
+            print(f"文本: {line['text']}")
@@ -0,0 +1,268 @@
+'''Minimal PDF writer that writes every page to the file as soon as it is added.
+
+Only the object offsets are kept in memory, so the memory used while building a PDF
+is bounded by a single page. Images are embedded without decoding them: JPEG data
+is stored as is (DCTDecode) and the compressed IDAT data of PNG images is copied into
+the PDF with the matching PNG predictor.
+
+Captions are written as real text below the image with the STSong-Light CJK font
+(UniGB-UCS2-H encoding), one of the standard Asian fonts of PDF readers, so Chinese
+and latin text is rendered without embedding a font file and stays searchable.
+Recognized text of the image (OCR) is written with the same font as an invisible text
+layer (text render mode 3) over the image, so the slides can be searched and selected.
+'''
+import re
+import struct
+import zlib
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+PNG_COLORS = {0: (b"/DeviceGray", 1), 2: (b"/DeviceRGB", 3)}   # png color type -> (color space, components)
+JPEG_COLORS = {1: b"/DeviceGray", 3: b"/DeviceRGB"}              # jpeg components -> color space
+
+CAPTION_FONT_SIZE = 12           # points
+CAPTION_LEADING = 1.4            # line height relative to the font size
+CAPTION_MARGIN = 10              # points around the caption text
+
+
+def parse_png(data):
+    '''Return (width, height, color type, bit depth, interlace, idat) of a png file'''
+    if data[:8] != PNG_SIGNATURE:
+        raise ValueError("not a png image")
+
+    pos = 8
+    idat = []
+    header = None
+    while pos < len(data):
+        (length, kind) = struct.unpack(">I4s", data[pos:pos + 8])
+        chunk = data[pos + 8:pos + 8 + length]
+        if kind == b"IHDR":
+            header = struct.unpack(">IIBBBBB", chunk)
+        elif kind == b"IDAT":
+            idat.append(chunk)
+        elif kind == b"IEND":
+            break
+        pos += length + 12
+
+    if header is None:
+        raise ValueError("png image without header")
+    (width, height, bit_depth, color_type, _, _, interlace) = header
+    return width, height, color_type, bit_depth, interlace, b"".join(idat)
+
+
+def parse_jpeg(data):
+    '''Return (width, height, components) of a jpeg file'''
+    if data[:2] != b"\xff\xd8":
+        raise ValueError("not a jpeg image")
+
+    pos = 2
+    while pos + 4 <= len(data):
+        if data[pos] != 0xFF:
+            raise ValueError("corrupt jpeg image")
+        marker = data[pos + 1]
+        if marker == 0xFF:
+            pos += 1
+            continue
+        (length,) = struct.unpack(">H", data[pos + 2:pos + 4])
+        # start of frame markers, except DHT, JPG and DAC
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            (height, width, components) = struct.unpack(">HHB", data[pos + 5:pos + 10])
+            return width, height, components
+        pos += 2 + length
+    raise ValueError("jpeg image without frame header")
+
+
+def text_width(text):
+    '''Width of text in em: latin characters are half width, all others full width'''
+    return sum(0.5 if ord(c) < 0x7F else 1.0 for c in text)
+
+
+def wrap_text(text, max_width):
+    '''Wrap text to lines of at most max_width em, latin words are kept together'''
+    lines = []
+    for paragraph in text.split("\n"):
+        line = ""
+        for word in re.findall(r"[\x21-\x7e]+|\s+|.", paragraph):
+            if text_width(line + word) > max_width and line.strip():
+                lines.append(line.rstrip())
+                line = word.lstrip()
+            else:
+                line += word
+            # a single latin word longer than a line is cut
+            while text_width(line) > max_width:
+                cut = max(int(max_width), 1)
+                lines.append(line[:cut])
+                line = line[cut:]
+        lines.append(line.rstrip())
+    return lines
+
+
+def encode_text(text):
+    '''Hex string of text in the UCS-2 encoding of the caption font'''
+    ucs2 = "".join(c if ord(c) <= 0xFFFF else "?" for c in text)
+    return b"<" + ucs2.encode("utf-16-be").hex().encode() + b">"
+
+
+class PdfWriter:
+    '''Write a PDF one page at a time, use add_image() for every page and close() at the end'''
+
+    def __init__(self, path, dpi=96):
+        self.path = path
+        self.scale = 72 / dpi          # pixels to points, 96 dpi like img2pdf
+        self.file = open(path, "wb")
+        self.offsets = {}
+        self.page_ids = []
+        self.next_id = 3               # 1 is the catalog, 2 the page tree
+        self.font_id = None
+        self.file.write(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    @property
+    def page_count(self):
+        return len(self.page_ids)
+
+    def _new_id(self):
+        self.next_id += 1
+        return self.next_id - 1
+
+    def _write_object(self, obj_id, dictionary, stream=None):
+        self.offsets[obj_id] = self.file.tell()
+        self.file.write(b"%d 0 obj\n" % obj_id)
+        if stream is None:
+            self.file.write(dictionary + b"\nendobj\n")
+            return
+        self.file.write(dictionary[:-2] + b" /Length %d >>\nstream\n" % len(stream))
+        self.file.write(stream)
+        self.file.write(b"\nendstream\nendobj\n")
+
+    def _font(self):
+        '''Object id of the caption font, the font objects are written on first use'''
+        if self.font_id is None:
+            descriptor_id = self._new_id()
+            self._write_object(descriptor_id, b"<< /Type /FontDescriptor /FontName /STSong-Light /Flags 6 "
+                                              b"/FontBBox [-25 -254 1000 880] /ItalicAngle 0 /Ascent 880 "
+                                              b"/Descent -120 /CapHeight 880 /StemV 93 >>")
+            cid_font_id = self._new_id()
+            self._write_object(cid_font_id, b"<< /Type /Font /Subtype /CIDFontType0 /BaseFont /STSong-Light "
+                                            b"/CIDSystemInfo << /Registry (Adobe) /Ordering (GB1) /Supplement 4 >> "
+                                            b"/FontDescriptor %d 0 R /DW 1000 /W [1 95 500 814 939 500] >>"
+                               % descriptor_id)
+            self.font_id = self._new_id()
+            self._write_object(self.font_id, b"<< /Type /Font /Subtype /Type0 /BaseFont /STSong-Light-UniGB-UCS2-H "
+                                             b"/Encoding /UniGB-UCS2-H /DescendantFonts [%d 0 R] >>" % cid_font_id)
+        return self.font_id
+
+    def _caption(self, caption, width):
+        '''Content stream drawing the caption below the image, returns (stream, height)'''
+        leading = CAPTION_FONT_SIZE * CAPTION_LEADING
+        lines = wrap_text(caption, (width - 2 * CAPTION_MARGIN) / CAPTION_FONT_SIZE)
+        height = len(lines) * leading + 2 * CAPTION_MARGIN
+        y = height - CAPTION_MARGIN - CAPTION_FONT_SIZE
+
+        stream = [b"BT /F1 %d Tf %.2f TL %.2f %.2f Td" % (CAPTION_FONT_SIZE, leading, CAPTION_MARGIN, y)]
+        stream += [encode_text(line) + b" Tj T*" for line in lines]
+        stream.append(b"ET")
+        return b"\n".join(stream), height
+
+    def _text_layer(self, lines, top):
+        '''Content stream with the invisible text of the image, lines are {"text", "box"} dicts
+        with the corner points of the text in image pixels, top is the y of the image top in points'''
+        stream = [b"BT 3 Tr"]
+        for line in lines:
+            text = line.get("text", "").strip()
+            box = line.get("box")
+            if not text or not box:
+                continue
+            xs = [point[0] * self.scale for point in box]
+            ys = [point[1] * self.scale for point in box]
+            size = max(max(ys) - min(ys), 1)
+            # stretch the text horizontally over the width of the box
+            scaling = 100 * (max(xs) - min(xs)) / (text_width(text) * size)
+            # the baseline is a little above the bottom of the box, like the font descent
+            baseline = top - max(ys) + size * 0.12
+            stream.append(b"/F1 %.2f Tf %.2f Tz 1 0 0 1 %.2f %.2f Tm %s Tj"
+                          % (size, scaling, min(xs), baseline, encode_text(text)))
+        stream.append(b"ET")
+        return b"\n".join(stream) if len(stream) > 2 else b""
+
+    def _add_page(self, image_id, width, height, caption=None, text_layer=None):
+        (w, h) = (width * self.scale, height * self.scale)
+        (text, text_height) = self._caption(caption, w) if caption else (b"", 0)
+        ocr_text = self._text_layer(text_layer, text_height + h) if text_layer else b""
+
+        content = b"q %.4f 0 0 %.4f 0 %.4f cm /Im0 Do Q\n" % (w, h, text_height) + text
+        if ocr_text:
+            content += b"\n" + ocr_text
+        content_id = self._new_id()
+        self._write_object(content_id, b"<< /Filter /FlateDecode >>", zlib.compress(content))
+
+        fonts = b" /Font << /F1 %d 0 R >>" % self._font() if caption or ocr_text else b""
+        page_id = self._new_id()
+        self._write_object(page_id, b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 %.4f %.4f] "
+                                    b"/Resources << /XObject << /Im0 %d 0 R >>%s >> /Contents %d 0 R >>"
+                           % (w, h + text_height, image_id, fonts, content_id))
+        self.page_ids.append(page_id)
+
+    def add_png(self, data, caption=None, text_layer=None):
+        '''Add a page showing a png image (bytes), 8 bit gray or RGB images are copied
+        without decoding, other pngs are converted first'''
+        (width, height, color_type, bit_depth, interlace, idat) = parse_png(data)
+        if color_type not in PNG_COLORS or bit_depth != 8 or interlace:
+            return self.add_png(_normalize_png(data), caption, text_layer)
+
+        (color_space, colors) = PNG_COLORS[color_type]
+        image_id = self._new_id()
+        self._write_object(image_id, b"<< /Type /XObject /Subtype /Image /Width %d /Height %d "
+                                     b"/ColorSpace %s /BitsPerComponent 8 /Filter /FlateDecode "
+                                     b"/DecodeParms << /Predictor 15 /Colors %d /BitsPerComponent 8 /Columns %d >> >>"
+                           % (width, height, color_space, colors, width), idat)
+        self._add_page(image_id, width, height, caption, text_layer)
+
+    def add_jpeg(self, data, caption=None, text_layer=None):
+        '''Add a page showing a jpeg image (bytes), the jpeg data is embedded as is'''
+        (width, height, components) = parse_jpeg(data)
+        if components not in JPEG_COLORS:
+            raise ValueError(f"unsupported jpeg with {components} components")
+
+        image_id = self._new_id()
+        self._write_object(image_id, b"<< /Type /XObject /Subtype /Image /Width %d /Height %d "
+                                     b"/ColorSpace %s /BitsPerComponent 8 /Filter /DCTDecode >>"
+                           % (width, height, JPEG_COLORS[components]), data)
+        self._add_page(image_id, width, height, caption, text_layer)
+
+    def add_image(self, data, caption=None, text_layer=None):
+        '''Add a page showing a png or jpeg image (bytes), with the caption text below it
+        and the text_layer ({"text", "box"} lines in image pixels) invisible over it'''
+        if data[:2] == b"\xff\xd8":
+            return self.add_jpeg(data, caption, text_layer)
+        return self.add_png(data, caption, text_layer)
+
+    def close(self):
+        '''Write the page tree, the catalog and the cross reference table'''
+        if self.file.closed:
+            return
+        kids = b" ".join(b"%d 0 R" % page_id for page_id in self.page_ids)
+        self._write_object(2, b"<< /Type /Pages /Kids [%s] /Count %d >>" % (kids, len(self.page_ids)))
+        self._write_object(1, b"<< /Type /Catalog /Pages 2 0 R >>")
+
+        xref = self.file.tell()
+        self.file.write(b"xref\n0 %d\n0000000000 65535 f \n" % self.next_id)
+        for obj_id in range(1, self.next_id):
+            self.file.write(b"%010d 00000 n \n" % self.offsets[obj_id])
+        self.file.write(b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (self.next_id, xref))
+        self.file.close()
+
+
+def _normalize_png(data):
+    '''Re-encode a png with a palette, alpha channel, 16 bit depth or interlacing as 8 bit RGB'''
+    import cv2
+    import numpy as np
+
+    image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+    if image is None:
+        raise ValueError("unable to decode png image")
+    return cv2.imencode(".png", image)[1].tobytes()
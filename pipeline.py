@@ -0,0 +1,101 @@
+'''Stages of a job as a DAG with memoized artifacts.
+
+A Stage is a function of the job that returns an artifact, and the names of the stages
+it depends on. A Job asks for the artifacts it needs with job.get(name): the stage runs
+the first time its artifact is requested and the artifact is kept for the rest of the job,
+so no stage ever runs twice per job, also when two threads request it at the same time.
+A stage gets the artifacts of its dependencies with job.get() as well, job.get_parallel()
+runs independent stages in threads at the same time.
+
+Every stage function is called as fn(job, progress), progress has the signature of
+gr.Progress.
+'''
+import time
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from throttle import no_progress
+
+
+class Stage:
+    '''A step of the pipeline: fn(job, progress) returns the artifact of the stage.
+    deps are the names of the stages it uses, or a function of the job that returns them'''
+
+    def __init__(self, name, fn, deps=()):
+        self.name = name
+        self.fn = fn
+        self._deps = deps
+
+    def deps(self, job):
+        return tuple(self._deps(job) if callable(self._deps) else self._deps)
+
+
+class Job:
+    '''One run of the pipeline, params are the inputs of the job (job.params)'''
+
+    def __init__(self, stages, progress=None, **params):
+        self.stages = {stage.name: stage for stage in stages}
+        self.params = params
+        self.progress = progress or no_progress
+        self.artifacts = {}
+        self.timings = {}              # stage -> seconds, in the order the stages finished
+        self.locks = {name: threading.Lock() for name in self.stages}
+
+    def plan(self, *outputs):
+        '''The stages needed for outputs, every stage after the stages it depends on'''
+        order = []
+
+        def visit(name, path):
+            if name in path:
+                raise ValueError(f"cycle in the pipeline: {' -> '.join(path + (name,))}")
+            if name in order:
+                return
+            for dep in self.stages[name].deps(self):
+                visit(dep, path + (name,))
+            order.append(name)
+
+        for name in outputs:
+            visit(name, ())
+        return order
+
+    def done(self, name):
+        return name in self.artifacts
+
+    def get(self, name, progress=None):
+        '''The artifact of the stage name, the stage runs first when it did not run yet'''
+        if name in self.artifacts:
+            return self.artifacts[name]
+        with self.locks[name]:
+            if name not in self.artifacts:
+                start_time = time.perf_counter()
+                self.artifacts[name] = self.stages[name].fn(self, progress or self.progress)
+                self.timings[name] = time.perf_counter() - start_time
+                print(f'stage {name} finished in {self.timings[name]:.2f}s')
+        return self.artifacts[name]
+
+    def get_parallel(self, names, progress=None, scale=1.0):
+        '''Run the stages names at the same time in threads and return their artifacts.
+        Every stage reports to its own slot, the calling thread reports the average
+        progress of the stages, times scale, to progress'''
+        progress = progress or self.progress
+        slots = {name: (1.0, "完成") if self.done(name) else (0.0, "等待...") for name in names}
+
+        def slot_progress(name):
+            def report(fraction, desc=None, **kwargs):
+                slots[name] = (min(fraction, 1.0), desc or slots[name][1])
+            return report
+
+        with ThreadPoolExecutor(max_workers=len(names)) as pool:
+            # every thread runs in a copy of the context, e.g. the profile of the current job
+            futures = {pool.submit(contextvars.copy_context().run, self.get, name, slot_progress(name)): name
+                       for name in names}
+            pending = set(futures)
+            while pending:
+                done, pending = wait(pending, timeout=0.5, return_when=FIRST_COMPLETED)
+                for future in done:
+                    if future.exception() is None:
+                        slots[futures[future]] = (1.0, "完成")
+                fraction = sum(f for f, _ in slots.values()) / len(slots)
+                progress(fraction * scale, desc=" | ".join(desc for _, desc in slots.values()))
+            return [future.result() for future in futures]
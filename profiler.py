@@ -0,0 +1,269 @@
+'''Wall clock and cpu time of the stages of the pipeline.
+
+Code that belongs to a stage runs in `with stage("decode"):` or iterates over
+`timed_iter(frames, "decode")`. The time is added to the profile of the current job,
+set with `with profiling(Profile(job_id)):`, and to the totals of the process that
+are exported in the Prometheus text format.
+
+The cpu time of a stage is the cpu time of the calling thread, the threads started by
+OpenCV or torch for the stage are not included. The cpu time of a job is the cpu time
+of the whole process while the job ran. The profile of a job is a context variable:
+work submitted to a thread pool only counts for the job when it runs in a copy of the
+context (contextvars.copy_context().run), work done in other processes is added with
+Profile.merge.
+
+Other components add their own counters with register_metrics(), e.g. the hits of a cache.
+They are collected with every snapshot and exported next to the stage timings.
+'''
+import json
+import time
+import resource
+import threading
+import contextvars
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+METRICS_PREFIX = "videotopdf"
+
+_current = contextvars.ContextVar("profile", default=None)
+_lock = threading.Lock()
+_totals = {}                     # stage -> {"calls", "wall", "cpu", "items"} of all jobs of the process
+_jobs = {"count": 0, "wall": 0.0, "cpu": 0.0}
+_collectors = {}                 # name -> (collect, {metric: (kind, help)})
+
+
+def _add(stages, name, wall, cpu, items, calls=1):
+    entry = stages.setdefault(name, {"calls": 0, "wall": 0.0, "cpu": 0.0, "items": 0})
+    entry["calls"] += calls
+    entry["wall"] += wall
+    entry["cpu"] += cpu
+    entry["items"] += items
+
+
+def peak_rss_bytes():
+    '''Peak resident memory of the process and of its largest finished child process'''
+    # ru_maxrss is in KiB on linux
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024
+    return own, children
+
+
+class Profile:
+    '''Stage timings of one job'''
+
+    def __init__(self, name=None):
+        self.name = name
+        self.stages = {}
+        self.lock = threading.Lock()
+        self.start_wall = time.perf_counter()
+        self.start_cpu = time.process_time()
+        self.wall = None
+        self.cpu = None
+
+    def add(self, name, wall, cpu, items=0):
+        with self.lock:
+            _add(self.stages, name, wall, cpu, items)
+
+    def merge(self, stages):
+        '''Add the stages of a report of another process, e.g. a worker of a process pool'''
+        with self.lock:
+            for name, entry in stages.items():
+                _add(self.stages, name, entry["wall"], entry["cpu"], entry["items"], entry["calls"])
+        with _lock:
+            for name, entry in stages.items():
+                _add(_totals, name, entry["wall"], entry["cpu"], entry["items"], entry["calls"])
+
+    def stop(self):
+        self.wall = time.perf_counter() - self.start_wall
+        self.cpu = time.process_time() - self.start_cpu
+
+    def report(self):
+        '''The profile as a json serializable dict'''
+        wall = self.wall if self.wall is not None else time.perf_counter() - self.start_wall
+        cpu = self.cpu if self.cpu is not None else time.process_time() - self.start_cpu
+        with self.lock:
+            stages = {name: {
+                "calls": entry["calls"],
+                "wall": round(entry["wall"], 4),
+                "cpu": round(entry["cpu"], 4),
+                "items": entry["items"],
+                "items_per_second": round(entry["items"] / entry["wall"], 2) if entry["items"] and entry["wall"] else None,
+            } for name, entry in self.stages.items()}
+        frames = stages.get("decode", {}).get("items", 0)
+        (own_rss, child_rss) = peak_rss_bytes()
+        return {
+            "job": self.name,
+            "wall": round(wall, 4),
+            "process_cpu": round(cpu, 4),
+            "frames": frames,
+            "frames_per_second": round(frames / wall, 2) if wall else None,
+            "peak_rss_mb": round(own_rss / 1024 / 1024, 1),
+            "peak_child_rss_mb": round(child_rss / 1024 / 1024, 1),
+            "stages": stages,
+        }
+
+    def write(self, path):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.report(), f, ensure_ascii=False, indent=2)
+
+
+@contextmanager
+def profiling(profile, report_path=None):
+    '''Make profile the profile of the current job while the block runs,
+    the report is written to report_path as json at the end'''
+    token = _current.set(profile)
+    try:
+        yield profile
+    finally:
+        _current.reset(token)
+        profile.stop()
+        with _lock:
+            _jobs["count"] += 1
+            _jobs["wall"] += profile.wall
+            _jobs["cpu"] += profile.cpu
+        if report_path is not None:
+            profile.write(report_path)
+
+
+def current_profile():
+    return _current.get()
+
+
+def record(name, wall, cpu, items=0):
+    '''Add a measurement to the current job and to the process totals'''
+    profile = _current.get()
+    if profile is not None:
+        profile.add(name, wall, cpu, items)
+    with _lock:
+        _add(_totals, name, wall, cpu, items)
+
+
+@contextmanager
+def stage(name, items=0):
+    '''Measure the block as one call of the stage name, processing items items'''
+    start_wall = time.perf_counter()
+    start_cpu = time.thread_time()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - start_wall, time.thread_time() - start_cpu, items)
+
+
+def timed_iter(iterable, name):
+    '''Iterate over iterable and measure the time spent producing every item as the stage name'''
+    iterator = iter(iterable)
+    while True:
+        start_wall = time.perf_counter()
+        start_cpu = time.thread_time()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        record(name, time.perf_counter() - start_wall, time.thread_time() - start_cpu, 1)
+        yield item
+
+
+def register_metrics(name, collect, metrics):
+    '''Export the values returned by collect() ({metric: number}) with every snapshot.
+    metrics is {metric: (kind, help)} of the exported values, kind is "counter" (summed over
+    the processes) or "gauge" (the largest value of the processes). They are named
+    <name>_<metric>, counters get a _total suffix'''
+    with _lock:
+        _collectors[name] = (collect, metrics)
+
+
+def _collect():
+    with _lock:
+        collectors = dict(_collectors)
+    collected = {}
+    for name, (collect, metrics) in collectors.items():
+        values = collect()
+        collected[name] = {metric: values[metric] for metric in metrics if metric in values}
+    return collected
+
+
+def snapshot():
+    '''Totals of the process: stages, jobs, peak memory and the registered metrics'''
+    with _lock:
+        stages = {name: dict(entry) for name, entry in _totals.items()}
+        jobs = dict(_jobs)
+    (own_rss, child_rss) = peak_rss_bytes()
+    return {"stages": stages, "jobs": jobs, "peak_rss_bytes": max(own_rss, child_rss), "collected": _collect()}
+
+
+def merge_snapshots(snapshots):
+    '''Sum the snapshots of several processes, the peak memory and the gauges are the largest value'''
+    merged = {"stages": {}, "jobs": {"count": 0, "wall": 0.0, "cpu": 0.0}, "peak_rss_bytes": 0, "collected": {}}
+    for item in snapshots:
+        for name, entry in item["stages"].items():
+            _add(merged["stages"], name, entry["wall"], entry["cpu"], entry["items"], entry["calls"])
+        for key in merged["jobs"]:
+            merged["jobs"][key] += item["jobs"][key]
+        merged["peak_rss_bytes"] = max(merged["peak_rss_bytes"], item["peak_rss_bytes"])
+        for name, values in item.get("collected", {}).items():
+            kinds = _collectors[name][1] if name in _collectors else {}
+            target = merged["collected"].setdefault(name, {})
+            for metric, value in values.items():
+                if kinds.get(metric, ("counter",))[0] == "gauge":
+                    target[metric] = max(target.get(metric, value), value)
+                else:
+                    target[metric] = target.get(metric, 0) + value
+    return merged
+
+
+def prometheus_text(metrics=None):
+    '''The totals (defaults to the snapshot of this process) in the Prometheus text format'''
+    metrics = metrics or snapshot()
+    lines = []
+
+    def metric(name, kind, help_text, samples):
+        lines.append(f"# HELP {METRICS_PREFIX}_{name} {help_text}")
+        lines.append(f"# TYPE {METRICS_PREFIX}_{name} {kind}")
+        for labels, value in samples:
+            lines.append(f"{METRICS_PREFIX}_{name}{labels} {value}")
+
+    stages = sorted(metrics["stages"].items())
+    metric("stage_seconds_total", "counter", "Wall clock time spent in a pipeline stage",
+           [(f'{{stage="{name}"}}', round(entry["wall"], 6)) for name, entry in stages])
+    metric("stage_cpu_seconds_total", "counter", "Cpu time of the calling thread spent in a pipeline stage",
+           [(f'{{stage="{name}"}}', round(entry["cpu"], 6)) for name, entry in stages])
+    metric("stage_calls_total", "counter", "Calls of a pipeline stage",
+           [(f'{{stage="{name}"}}', entry["calls"]) for name, entry in stages])
+    metric("stage_items_total", "counter", "Items (frames, slides, pages) processed by a pipeline stage",
+           [(f'{{stage="{name}"}}', entry["items"]) for name, entry in stages])
+    metric("jobs_total", "counter", "Finished jobs", [("", metrics["jobs"]["count"])])
+    metric("job_seconds_total", "counter", "Wall clock time of the finished jobs", [("", round(metrics["jobs"]["wall"], 6))])
+    metric("job_cpu_seconds_total", "counter", "Process cpu time while the finished jobs ran", [("", round(metrics["jobs"]["cpu"], 6))])
+    metric("peak_rss_bytes", "gauge", "Peak resident memory of the process or of its largest child", [("", metrics["peak_rss_bytes"])])
+    for name, values in sorted(metrics.get("collected", {}).items()):
+        if name not in _collectors:
+            continue
+        for key, (kind, help_text) in _collectors[name][1].items():
+            if key in values:
+                suffix = "_total" if kind == "counter" else ""
+                metric(f"{name}_{key}{suffix}", kind, help_text, [("", round(values[key], 6))])
+    return "\n".join(lines) + "\n"
+
+
+def start_metrics_server(port, metrics=snapshot, host="127.0.0.1"):
+    '''Serve prometheus_text(metrics()) at http://host:port/metrics from a daemon thread,
+    only to the local machine unless another host is given'''
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = prometheus_text(metrics()).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    print(f'metrics at http://{host}:{port}/metrics')
+    return server
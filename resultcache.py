@@ -0,0 +1,164 @@
+'''Persistent cache of finished results, keyed by the content of the video and the
+parameters that were used to process it.
+
+Every entry is a folder <cache dir>/<key>/ with the result files. The modification
+time of the folder is the last use, the least recently used entries are evicted
+when the cache grows over its size limit.
+
+Several processes can share the cache folder. Entries are written to a temporary
+folder and renamed into place, and they are renamed away before they are deleted,
+so an entry is never seen half written. A cache error (a full disk, an entry evicted
+by another process while it is copied) only loses the cached result, get() then
+reports a miss and put() stores nothing.
+'''
+import os
+import json
+import shutil
+import hashlib
+import threading
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def hash_file(path):
+    '''Streaming sha256 of a file'''
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _folder_size(folder):
+    return sum(os.path.getsize(os.path.join(folder, name)) for name in os.listdir(folder))
+
+
+class ResultCache:
+    '''Size bounded LRU cache of result files on disk'''
+
+    def __init__(self, folder, max_bytes):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.file_hashes = {}          # (path, size, mtime) -> sha256, files are hashed once per process
+        self.metrics = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0, "errors": 0}
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def key(self, video_path, params):
+        '''Cache key of a video: the hash of its bytes and of the processing parameters'''
+        stat = os.stat(video_path)
+        file_id = (os.path.abspath(video_path), stat.st_size, stat.st_mtime)
+        if file_id not in self.file_hashes:
+            self.file_hashes[file_id] = hash_file(video_path)
+        params = json.dumps(params, sort_keys=True)
+        return hashlib.sha256(f"{self.file_hashes[file_id]}:{params}".encode()).hexdigest()
+
+    def get(self, key, targets):
+        '''Copy the cached files of key to targets ({cached name: target path}),
+        returns False when the entry is missing'''
+        entry = os.path.join(self.folder, key)
+        with self.lock:
+            if not self.enabled or not all(os.path.exists(os.path.join(entry, name)) for name in targets):
+                self.metrics["misses"] += 1
+                return False
+            try:
+                os.utime(entry)
+                for name, target in targets.items():
+                    os.makedirs(os.path.dirname(target) or ".", exist_ok=True)
+                    shutil.copyfile(os.path.join(entry, name), target)
+            except OSError as e:
+                # evicted or replaced by another process in the meantime
+                print(f"result cache: {key} could not be read: {e}")
+                self.metrics["misses"] += 1
+                self.metrics["errors"] += 1
+                return False
+            self.metrics["hits"] += 1
+        return True
+
+    def put(self, key, files):
+        '''Store files ({cached name: source path}) under key and evict old entries'''
+        if not self.enabled:
+            return
+        entry = os.path.join(self.folder, key)
+        partial = f"{entry}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(partial, exist_ok=True)
+            for name, source in files.items():
+                shutil.copyfile(source, os.path.join(partial, name))
+
+            with self.lock:
+                self._publish(partial, entry)
+                self.metrics["stores"] += 1
+                self._evict()
+        except OSError as e:
+            print(f"result cache: {key} could not be stored: {e}")
+            with self.lock:
+                self.metrics["errors"] += 1
+            shutil.rmtree(partial, ignore_errors=True)
+
+    @staticmethod
+    def _publish(partial, entry):
+        '''Rename the complete partial folder to entry. An existing entry is renamed away first and
+        then deleted, when another process stores the entry at the same time its copy is kept'''
+        try:
+            os.rename(partial, entry)
+            return
+        except OSError:
+            pass
+        trash = f"{partial[:-len('.tmp')]}.old.tmp"
+        try:
+            os.rename(entry, trash)
+        except FileNotFoundError:
+            pass
+        try:
+            os.rename(partial, entry)
+        except OSError:
+            # stored by another process in the meantime, it is the same result
+            shutil.rmtree(partial, ignore_errors=True)
+        shutil.rmtree(trash, ignore_errors=True)
+
+    def _evict(self):
+        '''Remove the least recently used entries until the cache fits in max_bytes'''
+        entries = []
+        for name in os.listdir(self.folder):
+            path = os.path.join(self.folder, name)
+            if name.endswith(".tmp"):
+                continue
+            try:
+                if os.path.isdir(path):
+                    entries.append((os.path.getmtime(path), _folder_size(path), path))
+            except OSError:
+                # removed by another process
+                continue
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            # renamed first, a reader sees the whole entry or none of it
+            trash = f"{path}.{os.getpid()}.{threading.get_ident()}.evicted.tmp"
+            try:
+                os.rename(path, trash)
+            except OSError:
+                continue
+            shutil.rmtree(trash, ignore_errors=True)
+            total -= size
+            self.metrics["evictions"] += 1
+
+    def stats(self):
+        '''Hit/miss counters, hit rate and current size of the cache'''
+        with self.lock:
+            lookups = self.metrics["hits"] + self.metrics["misses"]
+            size = 0
+            if os.path.isdir(self.folder):
+                for name in os.listdir(self.folder):
+                    path = os.path.join(self.folder, name)
+                    try:
+                        if os.path.isdir(path):
+                            size += _folder_size(path)
+                    except OSError:
+                        continue
+            return dict(self.metrics, hit_rate=self.metrics["hits"] / lookups if lookups else 0.0, bytes=size)
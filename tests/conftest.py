@@ -0,0 +1,60 @@
+import os
+import sys
+
+import cv2
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app
+
+
+def make_slide(index, width=640, height=360):
+    '''A synthetic slide: a title bar and a few lines of text, laid out differently on every slide'''
+    slide = np.full((height, width, 3), 250, np.uint8)
+    cv2.rectangle(slide, (0, 0), (width, 50), (120 + 10 * (index % 5), 60, 30), -1)
+    cv2.putText(slide, f"Slide {index}", (20 + 30 * (index % 4), 38), cv2.FONT_HERSHEY_SIMPLEX, 1.1, (255, 255, 255), 2)
+    rng = np.random.default_rng(index)
+    for line in range(2 + index % 4):
+        text = "".join(rng.choice(list("abcdefghij klmnop"), 25))
+        cv2.putText(slide, text, (40, 100 + 45 * line), cv2.FONT_HERSHEY_SIMPLEX, 0.8, (30, 30, 30), 2)
+    if index % 3 == 0:
+        cv2.circle(slide, (520, 250), 60, (40, 160, 40), -1)
+    # a dark block at a different place on every slide, so no two slides look alike
+    (x, y) = (40 + (index * 137) % (width - 160), 90 + (index * 61) % (height - 150))
+    cv2.rectangle(slide, (x, y), (x + 100, y + 50), (60, 60, 60), -1)
+    return slide
+
+
+def write_video(path, slides, seconds=4, fps=25, overlay=None):
+    '''Write slides as a video, every slide is shown for seconds. overlay(frame, index) can draw
+    on every frame, e.g. a blinking cursor'''
+    (height, width) = slides[0].shape[:2]
+    out = cv2.VideoWriter(str(path), cv2.VideoWriter_fourcc(*"mp4v"), fps, (width, height))
+    index = 0
+    for slide in slides:
+        for _ in range(int(seconds * fps)):
+            frame = slide.copy()
+            if overlay is not None:
+                overlay(frame, index)
+            out.write(frame)
+            index += 1
+    out.release()
+    return str(path)
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    '''Run in an empty folder with the caches off'''
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(app, "JOBS_DIR", str(tmp_path / "jobs"))
+    monkeypatch.setattr(app.RESULT_CACHE, "max_bytes", 0)
+    monkeypatch.setattr(app, "SIGNAL_CACHE", False)
+    monkeypatch.setattr(app, "SAVE_SLIDE_IMAGES", False)
+    return tmp_path
+
+
+@pytest.fixture
+def slide_video(workdir):
+    return write_video(workdir / "slides.mp4", [make_slide(i) for i in range(4)])
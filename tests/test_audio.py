@@ -0,0 +1,35 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+import app
+
+FAKE_FFMPEG = '''#!{python}
+import sys
+# warnings of a damaged file, far more than a pipe holds
+sys.stderr.write("warning: damaged packet\\n" * 12000)
+sys.stderr.flush()
+sys.stdout.buffer.write(b"\\0" * 4 * {samples})
+sys.exit({status})
+'''
+
+
+def fake_ffmpeg(tmp_path, status=0, samples=16000):
+    path = tmp_path / "ffmpeg"
+    path.write_text(FAKE_FFMPEG.format(python=sys.executable, samples=samples, status=status))
+    os.chmod(path, 0o755)
+    return str(path)
+
+
+def test_ffmpeg_log_does_not_block_the_audio(tmp_path, monkeypatch):
+    monkeypatch.setattr(app, "FFMPEG_BIN", fake_ffmpeg(tmp_path))
+    audio = np.concatenate(list(app.iter_audio_chunks("video.mp4", chunk_seconds=0.5)))
+    assert len(audio) == 16000
+
+
+def test_ffmpeg_failure_reports_the_end_of_its_log(tmp_path, monkeypatch):
+    monkeypatch.setattr(app, "FFMPEG_BIN", fake_ffmpeg(tmp_path, status=1))
+    with pytest.raises(Exception, match="damaged packet"):
+        list(app.iter_audio_chunks("video.mp4"))
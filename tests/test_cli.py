@@ -0,0 +1,20 @@
+import os
+
+import cli
+
+
+def test_pdfs_of_videos_with_the_same_name_do_not_overwrite_each_other(tmp_path):
+    videos = [str(tmp_path / "week1" / "lecture.mp4"), str(tmp_path / "week2" / "lecture.mp4"),
+              str(tmp_path / "week2" / "lecture.mkv"), str(tmp_path / "week2" / "notes.mp4")]
+    paths = cli.output_paths(videos, "pdf")
+    assert paths == {
+        videos[0]: os.path.join("pdf", "week1", "lecture.pdf"),
+        videos[1]: os.path.join("pdf", "week2", "lecture.mp4.pdf"),
+        videos[2]: os.path.join("pdf", "week2", "lecture.mkv.pdf"),
+        videos[3]: os.path.join("pdf", "week2", "notes.pdf"),
+    }
+
+
+def test_single_video_goes_to_the_output_folder(tmp_path):
+    video = str(tmp_path / "lecture.mp4")
+    assert cli.output_paths([video], "pdf") == {video: os.path.join("pdf", "lecture.pdf")}
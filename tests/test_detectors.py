@@ -0,0 +1,54 @@
+import pytest
+
+import app
+from conftest import make_slide, write_video
+
+
+def blinking_cursor(frame, index):
+    # a text cursor that blinks twice a second, it fills more than one 8x8 block of the blockdiff frames
+    if (index // 6) % 2 == 0:
+        frame[196:228, 598:606] = 0
+
+
+@pytest.fixture
+def cursor_video(workdir):
+    return write_video(workdir / "cursor.mp4", [make_slide(i) for i in range(9)], overlay=blinking_cursor)
+
+
+@pytest.mark.parametrize("detector", sorted(app.MOTION_DETECTORS))
+def test_detectors_find_the_slides(slide_video, detector):
+    slides = app.detect_slides(slide_video, ".", app.no_progress, detector=detector)
+    assert len(slides) == 4
+
+
+@pytest.mark.parametrize("detector", sorted(app.MOTION_DETECTORS))
+def test_blinking_cursor_does_not_hide_the_slides(cursor_video, detector):
+    slides = app.detect_slides(cursor_video, ".", app.no_progress, detector=detector)
+    assert len(slides) == 9
+
+
+def test_auto_mask_covers_the_cursor_blocks(cursor_video):
+    region = app.detection_region(cursor_video, auto_mask_seconds=3)
+    assert region["learned"] is not None
+    slides = app.detect_slides(cursor_video, ".", app.no_progress, detector="blockdiff", region=region)
+    assert len(slides) == 9
+
+
+def test_block_batch_is_read_at_runtime(slide_video, monkeypatch):
+    monkeypatch.setattr(app, "BLOCK_BATCH", 3)
+    sizes = []
+    apply = app.BlockDiffDetector.apply
+    monkeypatch.setattr(app.BlockDiffDetector, "apply", lambda self, batch: sizes.append(len(batch)) or apply(self, batch))
+    slides = app.detect_slides(slide_video, ".", app.no_progress, detector="blockdiff")
+    assert len(slides) == 4
+    assert max(sizes) == 3
+
+
+def test_slides_do_not_depend_on_the_number_of_workers(cursor_video, monkeypatch):
+    monkeypatch.setattr(app, "DETECT_CHUNK_SECONDS", 10)
+    results = {}
+    for workers in (1, 3):
+        slides = app.detect_slides(cursor_video, ".", app.no_progress, workers=workers)
+        results[workers] = [slide["time"] for slide in slides]
+    assert results[1] == results[3]
+    assert len(results[1]) == 9
@@ -0,0 +1,37 @@
+import shutil
+
+import pytest
+
+import app
+
+needs_ffmpeg = pytest.mark.skipif(shutil.which(app.FFMPEG_BIN) is None, reason="ffmpeg is not installed")
+
+
+@needs_ffmpeg
+def test_ffmpeg_reader_samples_the_video(slide_video):
+    reader = app.FfmpegFrameReader(slide_video, app.BLOCK_WIDTH, gray=True)
+    frames = [(frame_count, frame.shape) for frame_count, _, frame in reader.frames(None)]
+    # 4 slides of 4 seconds
+    assert len(frames) == 16 * app.FRAME_RATE
+    assert frames[0][1] == (90, app.BLOCK_WIDTH)
+
+
+@needs_ffmpeg
+def test_ffmpeg_failure_is_reported(slide_video, workdir):
+    broken = workdir / "broken.mp4"
+    with open(slide_video, "rb") as f:
+        broken.write_bytes(f.read()[:2000])
+    reader = app.FfmpegFrameReader(slide_video, app.BLOCK_WIDTH, gray=True)
+    reader.video_path = str(broken)
+    with pytest.raises(Exception, match="ffmpeg"):
+        list(reader.frames(None))
+
+
+def test_missing_ffmpeg_falls_back_to_opencv(slide_video, monkeypatch):
+    monkeypatch.setattr(app, "FRAME_SAMPLER", "ffmpeg")
+    monkeypatch.setattr(app, "FFMPEG_BIN", "ffmpeg-that-is-not-installed")
+    frames = list(app.get_frames(slide_video))
+    assert len(frames) == 16 * app.FRAME_RATE
+    # the auto mask decodes the first seconds with the same sampler
+    region = app.detection_region(slide_video, auto_mask_seconds=2)
+    assert region["learned"] is None
@@ -0,0 +1,81 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+import jobs
+
+
+def dead_pid():
+    process = subprocess.Popen([sys.executable, "-c", "pass"])
+    process.wait()
+    return process.pid
+
+
+@pytest.fixture
+def queue(workdir):
+    return jobs.JobQueue(str(workdir / "jobs.sqlite3"))
+
+
+def test_job_of_a_dead_worker_is_retried_then_fails(queue, monkeypatch):
+    monkeypatch.setattr(jobs, "JOB_MAX_ATTEMPTS", 2)
+    job_id = queue.submit("video.mp4", job_folder="job")
+    for attempt in (1, 2):
+        job = queue.claim()
+        assert (job["id"], job["attempts"]) == (job_id, attempt)
+        queue.update(job_id, worker=dead_pid())
+        assert queue.recover() == 1
+    job = queue.get(job_id)
+    assert job["status"] == "failed"
+    assert queue.claim() is None
+
+
+def test_waiting_for_the_job_of_a_dead_worker_ends(queue, monkeypatch):
+    monkeypatch.setattr(jobs, "JOB_MAX_ATTEMPTS", 1)
+    monkeypatch.setattr(jobs, "JOB_POLL_SECONDS", 0.01)
+    job_id = queue.submit("video.mp4", job_folder="job")
+    queue.claim()
+    queue.update(job_id, worker=dead_pid())
+    with pytest.raises(Exception, match="处理失败"):
+        jobs.wait_for_job(queue, job_id, lambda fraction, desc=None: None)
+
+
+class FakeProcess:
+    def __init__(self, alive):
+        self.alive = alive
+        self.name = "job-worker"
+        self.exitcode = None if alive else -9
+
+    def is_alive(self):
+        return self.alive
+
+
+def test_dead_workers_are_restarted(queue, monkeypatch):
+    monkeypatch.setattr(jobs, "_start_worker", lambda db_path, i: FakeProcess(True))
+    job_id = queue.submit("video.mp4", job_folder="job")
+    queue.claim()
+    queue.update(job_id, worker=dead_pid())
+
+    processes = [FakeProcess(True), FakeProcess(False)]
+    alive = processes[0]
+    assert jobs.restart_dead_workers(processes, queue.path) == 1
+    assert processes[0] is alive and processes[1].is_alive()
+    assert queue.get(job_id)["status"] == "queued"
+
+
+def test_worker_totals_are_not_removed_with_the_jobs():
+    # app.cleanup_jobs removes every folder below JOBS_DIR
+    jobs_dir = os.path.dirname(jobs.JOBS_DB)
+    assert os.path.commonpath([jobs.METRICS_DIR, jobs_dir]) != jobs_dir
+
+
+def test_job_progress_is_rate_limited(queue, monkeypatch):
+    monkeypatch.setattr(jobs, "JOB_PROGRESS_SECONDS", 60)
+    job_id = queue.submit("video.mp4", job_folder="job")
+    progress = jobs.job_progress(queue, job_id)
+    progress(0.1, desc="处理视频帧")
+    progress(0.5, desc="处理视频帧")
+    assert queue.get(job_id)["progress"] == 0.1
+    progress(1.0, desc="处理视频帧")
+    assert queue.get(job_id)["progress"] == 1.0
@@ -0,0 +1,117 @@
+import json
+import time
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import cv2
+import numpy as np
+import pytest
+
+import app
+import ocrapi
+from conftest import make_slide, write_video
+
+
+def _recorder(spans, name, seconds, result):
+    def run(*args, **kwargs):
+        start = time.perf_counter()
+        time.sleep(seconds)
+        spans[name] = (start, time.perf_counter())
+        return result
+    return run
+
+
+def test_transcription_overlaps_detection(slide_video, monkeypatch):
+    spans = {}
+    png = cv2.imencode(".png", np.zeros((36, 64, 3), np.uint8))[1].tobytes()
+    slides = [{"time": 1.0, "path": None, "revisits": [], "data": png}]
+    segments = [{"start": 0.0, "end": 2.0, "text": "hello"}]
+    monkeypatch.setattr(app, "load_audio", lambda video_path: np.zeros(app.AUDIO_SAMPLE_RATE, np.float32))
+    monkeypatch.setattr(app, "transcribe_audio", _recorder(spans, "transcribe", 1.0, segments))
+    monkeypatch.setattr(app, "detect_slides", _recorder(spans, "detect", 1.0, slides))
+
+    job = app.new_job(slide_video, transcribe=True)
+    start = time.perf_counter()
+    pdf_path = job.get("assemble")
+    elapsed = time.perf_counter() - start
+
+    (transcribe_start, transcribe_end) = spans["transcribe"]
+    (detect_start, detect_end) = spans["detect"]
+    assert transcribe_start < detect_end and detect_start < transcribe_end
+    assert elapsed < 1.8
+    assert job.get("caption") == [["hello"]]
+    with open(pdf_path, "rb") as f:
+        assert f.read(5) == b"%PDF-"
+
+
+def test_pipeline_detects_the_slides(slide_video):
+    slides = app.new_job(slide_video).get("detect")
+    assert len(slides) == 4
+
+
+def test_assemble_after_detect(slide_video):
+    fitz = pytest.importorskip("fitz")
+    job = app.new_job(slide_video)
+    slides = job.get("detect")
+    pdf_path = job.get("assemble")
+    with fitz.open(pdf_path) as pdf:
+        assert pdf.page_count == 4
+    # the detect artifact is shared, writing the pdf leaves it as it was
+    assert all(slide["data"] for slide in slides)
+
+
+class FakeOcrHandler(BaseHTTPRequestHandler):
+    '''Umi-OCR style /api/ocr that finds one line of text in every image'''
+
+    def do_POST(self):
+        payload = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        assert payload["base64"]
+        lines = [{"text": "searchable slide text", "score": 0.99, "box": [[40, 80], [400, 80], [400, 110], [40, 110]]}]
+        body = json.dumps({"code": 100, "data": lines}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def ocr_server(monkeypatch, tmp_path):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeOcrHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setattr(ocrapi, "ocr_api_url", f"http://127.0.0.1:{server.server_address[1]}/api/ocr")
+    monkeypatch.setattr(ocrapi, "OCR_CACHE_DIR", str(tmp_path / "ocr-cache"))
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_ocr_text_is_searchable(slide_video, ocr_server):
+    fitz = pytest.importorskip("fitz")
+    pdf_path = app.new_job(slide_video, ocr=True).get("assemble")
+
+    with fitz.open(pdf_path) as pdf:
+        assert pdf.page_count == 4
+        for page in pdf:
+            assert "searchable slide text" in page.get_text()
+            assert page.search_for("searchable")
+
+
+def test_speech_on_a_revisited_slide_goes_to_it(workdir):
+    # A, B, C, D, A, E, four seconds each. The background model of mog2 still knows A when it
+    # comes back and sees no motion, the block differences do
+    video = write_video(workdir / "revisit.mp4", [make_slide(i) for i in (0, 1, 2, 3, 0, 4)])
+    slides = app.detect_slides(video, ".", app.no_progress, duplicate_policy="drop", detector="blockdiff")
+    assert len(slides) == 5
+    assert len(slides[0]["revisits"]) == 1 and 16 <= slides[0]["revisits"][0] < 19
+    # the time of the captured frame, not of the sample after it
+    assert slides[0]["time"] == pytest.approx(app.WARMUP / app.FRAME_RATE)
+    assert not (workdir / "references.json").exists()
+
+    segments = [{"start": 18.5, "end": 19.5, "text": "back to A"}, {"start": 21.0, "end": 23.0, "text": "on E"}]
+    captions = app.assign_captions(slides, segments)
+    assert captions[0] == ["back to A"]
+    assert captions[4] == ["on E"]
@@ -0,0 +1,91 @@
+import multiprocessing
+import shutil
+
+import pytest
+
+import app
+import profiler
+from resultcache import ResultCache
+
+
+def _store_and_read(folder, source, worker):
+    # every worker stores the same two entries and reads them back, the small limit
+    # makes the workers evict each other's entries all the time
+    cache = ResultCache(folder, max_bytes=1500)
+    for i in range(30):
+        key = f"entry{i % 2}"
+        cache.put(key, {"result.pdf": source})
+        cache.get(key, {"result.pdf": f"{folder}-out{worker}/result.pdf"})
+    return cache.metrics
+
+
+def test_processes_share_the_cache(tmp_path):
+    source = tmp_path / "result.pdf"
+    source.write_bytes(b"x" * 1000)
+    folder = str(tmp_path / "cache")
+
+    with multiprocessing.get_context("spawn").Pool(4) as pool:
+        metrics = pool.starmap(_store_and_read, [(folder, str(source), worker) for worker in range(4)])
+
+    # no store fails, a read of an entry that another worker evicted is a miss
+    assert sum(m["stores"] for m in metrics) == 4 * 30
+    assert sum(m["hits"] + m["misses"] for m in metrics) == 4 * 30
+    cache = ResultCache(folder, max_bytes=1500)
+    cache.put("entry0", {"result.pdf": str(source)})
+    assert cache.get("entry0", {"result.pdf": str(tmp_path / "copy.pdf")})
+    assert (tmp_path / "copy.pdf").read_bytes() == source.read_bytes()
+
+
+def test_read_error_is_a_miss(tmp_path, monkeypatch):
+    source = tmp_path / "result.pdf"
+    source.write_bytes(b"pdf")
+    cache = ResultCache(str(tmp_path / "cache"), max_bytes=10 ** 6)
+    cache.put("key", {"result.pdf": str(source)})
+
+    def evicted(*args):
+        raise FileNotFoundError("evicted by another process")
+
+    monkeypatch.setattr(shutil, "copyfile", evicted)
+    assert not cache.get("key", {"result.pdf": str(tmp_path / "copy.pdf")})
+    assert cache.metrics["misses"] == 1 and cache.metrics["errors"] == 1
+
+
+def test_write_error_stores_nothing(tmp_path):
+    cache = ResultCache(str(tmp_path / "cache"), max_bytes=10 ** 6)
+    cache.put("key", {"result.pdf": str(tmp_path / "missing.pdf")})
+    assert cache.metrics["errors"] == 1
+    assert not cache.get("key", {"result.pdf": str(tmp_path / "copy.pdf")})
+
+
+@pytest.mark.parametrize("name, value", [
+    ("WARMUP", 0), ("MOTION_DETECTOR", "blockdiff"), ("DETECT_SHADOWS", True), ("MIN_PERCENT", 0.5),
+    ("DUPLICATE_HASH_DISTANCE", 3), ("KEYFRAME_SCAN", True), ("KEYFRAME_DIFF_THRESHOLD", 2.0),
+    ("KEYFRAME_WINDOW_TAIL", 1), ("KEYFRAME_THUMB_SIZE", (32, 18)), ("DETECT_ROI", (0, 0, 0.5, 1)),
+    ("DETECT_MASKS", [(0.8, 0.8, 1, 1)]), ("AUTO_MASK_SECONDS", 10), ("AUTO_MASK_DIFF", 40),
+])
+def test_detection_settings_change_the_cache_key(monkeypatch, name, value):
+    before = app.result_cache_params()
+    monkeypatch.setattr(app, name, value)
+    assert app.result_cache_params() != before
+
+
+def test_block_thresholds_change_the_cache_key(monkeypatch):
+    monkeypatch.setattr(app, "MOTION_DETECTOR", "blockdiff")
+    before = app.result_cache_params()
+    monkeypatch.setattr(app, "BLOCK_MIN_PERCENT", 2.0)
+    assert app.result_cache_params() != before
+
+
+def test_cache_stats_are_exported(tmp_path, monkeypatch):
+    source = tmp_path / "result.pdf"
+    source.write_bytes(b"pdf")
+    monkeypatch.setattr(app.RESULT_CACHE, "folder", str(tmp_path / "cache"))
+    monkeypatch.setattr(app.RESULT_CACHE, "max_bytes", 10 ** 6)
+    monkeypatch.setattr(app.RESULT_CACHE, "metrics", dict.fromkeys(app.RESULT_CACHE.metrics, 0))
+    app.RESULT_CACHE.put("key", {"result.pdf": str(source)})
+    app.RESULT_CACHE.get("key", {"result.pdf": str(tmp_path / "copy.pdf")})
+
+    text = profiler.prometheus_text(profiler.merge_snapshots([profiler.snapshot()]))
+    assert "videotopdf_result_cache_hits_total 1" in text
+    assert "videotopdf_result_cache_stores_total 1" in text
+    assert "videotopdf_result_cache_bytes 3" in text
@@ -0,0 +1,74 @@
+from collections import OrderedDict
+
+import pytest
+
+import app
+import profiler
+
+
+class FakeTensor:
+    def numel(self):
+        return 1000
+
+    def element_size(self):
+        return 4
+
+
+class FakeModel:
+    def parameters(self):
+        return [FakeTensor()]
+
+    def buffers(self):
+        return []
+
+
+def test_whisper_metrics_are_exported(monkeypatch):
+    monkeypatch.setattr(app, "_whisper_models", OrderedDict())
+    monkeypatch.setattr(app, "WHISPER_METRICS", dict.fromkeys(app.WHISPER_METRICS, 0))
+    monkeypatch.setattr(app.whisper, "load_model", lambda size: FakeModel())
+
+    app.get_whisper_model("tiny")
+    app.get_whisper_model("tiny")
+    metrics = app.whisper_metrics()
+    assert (metrics["loads"], metrics["hits"], metrics["misses"]) == (1, 1, 1)
+    assert metrics["resident_bytes"] == 4000
+
+    # a second worker process with the same counters
+    merged = profiler.merge_snapshots([profiler.snapshot(), profiler.snapshot()])
+    text = profiler.prometheus_text(merged)
+    assert "videotopdf_whisper_loads_total 2" in text
+    assert "videotopdf_whisper_hits_total 2" in text
+    assert "videotopdf_whisper_resident_bytes 4000" in text
+
+
+def test_transcription_pool_is_kept_alive(monkeypatch):
+    monkeypatch.setattr(app, "_transcribe_pool", None)
+    pool = app.transcription_pool(2)
+    try:
+        assert app.transcription_pool(2) is pool
+        # idle workers are stopped like idle models
+        app._transcribe_pool["last_used"] -= app.WHISPER_IDLE_SECONDS + 1
+        with app._whisper_lock:
+            app._evict_whisper_models()
+        assert app._transcribe_pool is None
+    finally:
+        pool.shutdown()
+
+
+def test_worker_models_count_against_the_budget(monkeypatch):
+    # evicting a model releases the cached cuda memory
+    pytest.importorskip("torch")
+    monkeypatch.setattr(app, "_whisper_models", OrderedDict())
+    monkeypatch.setattr(app, "_worker_model_bytes", {})
+    monkeypatch.setattr(app, "WHISPER_METRICS", dict.fromkeys(app.WHISPER_METRICS, 0))
+    monkeypatch.setattr(app.whisper, "load_model", lambda size: FakeModel())
+    monkeypatch.setattr(app, "WHISPER_MEMORY_BUDGET_MB", 10000 / 1024 / 1024)
+
+    app.get_whisper_model("tiny")
+    app.get_whisper_model("base")
+    assert list(app._whisper_models) == ["tiny", "base"]
+    # a worker holds a model of 4000 bytes, only one of the 4000 byte models fits next to it
+    app._worker_model_bytes[12345] = 4000
+    with app._whisper_lock:
+        app._evict_whisper_models()
+    assert list(app._whisper_models) == ["base"]
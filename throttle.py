@@ -0,0 +1,63 @@
+'''Rate limited progress reporting.
+
+Every progress update of a Gradio app is a message over the websocket of the browser,
+reporting every sampled frame costs more than it tells. ThrottledProgress wraps any
+progress callback with the signature of gr.Progress (fraction, desc=None) and only
+forwards an update when at least PROGRESS_MIN_INTERVAL seconds have passed and the
+fraction moved by at least PROGRESS_MIN_DELTA since the last forwarded update.
+
+The description can be a callable that returns the text, it is only called for the
+updates that are forwarded, so per frame messages cost no string formatting. A new text
+description (a stage change like "保存截图 3") and the final update (fraction 1) are
+always forwarded.
+'''
+import time
+
+PROGRESS_MIN_INTERVAL = 0.2      # seconds between two forwarded updates (5 Hz)
+PROGRESS_MIN_DELTA = 0.005       # smallest change of the fraction that is forwarded
+
+
+class ThrottledProgress:
+    '''Progress callback that forwards rate limited updates to progress'''
+
+    def __init__(self, progress, min_interval=None, min_delta=None):
+        self.progress = progress
+        self.min_interval = PROGRESS_MIN_INTERVAL if min_interval is None else min_interval
+        self.min_delta = PROGRESS_MIN_DELTA if min_delta is None else min_delta
+        self.fraction = 0.0            # last requested fraction, forwarded or not
+        self.last_time = None
+        self.last_fraction = None
+        self.last_text = None
+        self.forwarded = 0
+        self.dropped = 0
+
+    def __call__(self, fraction, desc=None, **kwargs):
+        self.fraction = fraction
+        now = time.monotonic()
+        text = desc if isinstance(desc, str) else None
+
+        forward = (self.last_time is None or fraction >= 1
+                   or (text is not None and text != self.last_text)
+                   or (now - self.last_time >= self.min_interval and abs(fraction - self.last_fraction) >= self.min_delta))
+        if not forward:
+            self.dropped += 1
+            return
+
+        self.last_time = now
+        self.last_fraction = fraction
+        if text is not None:
+            self.last_text = text
+        self.forwarded += 1
+        self.progress(fraction, desc=desc() if callable(desc) else desc, **kwargs)
+
+
+def throttled(progress, **kwargs):
+    '''Wrap progress in a ThrottledProgress, a progress that is already throttled is returned as is
+    so nested functions share the rate limit'''
+    if isinstance(progress, ThrottledProgress):
+        return progress
+    return ThrottledProgress(progress, **kwargs)
+
+
+def no_progress(*args, **kwargs):
+    '''Progress callback that reports nothing'''